@@ -14,6 +14,9 @@ from datetime import datetime, timedelta
 from .extensions import db
 from app.models import Asset, User, NetworkType, AssetType, Holding, DepositAddress, Trader, AssetType, MiningAlgorithm, HashrateUnit, MiningPool, MiningDifficulty, HashratePackage, PackageType
 from .dashboard.services import CoinGeckoService
+from .pricing import RateHistoryService
+from .ledger import CostBasisService, DailyBalanceLedger
+from .pricing.vectorized import benchmark_cross_rates
 from sqlalchemy.exc import IntegrityError, SQLAlchemyError, NoResultFound
 from app.utils.network_symbol import get_network_symbol
 
@@ -216,6 +219,358 @@ def fetch_rates_command():
     except Exception as e:
         click.echo(f'Error fetching rates: {str(e)}', err=True)
 
+@click.command('stream-prices')
+@click.option('--interval', type=float, default=None,
+              help='Seconds between polls (defaults to PRICE_STREAMER_INTERVAL)')
+@click.option('--provider', type=click.Choice(['coingecko', 'random']), default='coingecko',
+              help='Price source; "random" is an offline random-walk stand-in')
+@click.option('--ticks', type=int, default=None, help='Stop after this many polls')
+@with_appcontext
+def stream_prices_command(interval, provider, ticks):
+    """Run the background price feed, publishing rates into the rate store."""
+    from flask import current_app
+    from .pricing.streamer import PriceStreamer, CoinGeckoProvider, RandomWalkProvider
+
+    app = current_app._get_current_object()
+    streamer = PriceStreamer(
+        app,
+        provider=RandomWalkProvider() if provider == 'random' else CoinGeckoProvider(),
+        interval=interval or app.config['PRICE_STREAMER_INTERVAL'],
+        max_backoff=app.config['PRICE_STREAMER_MAX_BACKOFF']
+    )
+    click.echo(f'Streaming prices from {provider} every {streamer.interval}s (Ctrl+C to stop)')
+    try:
+        streamer.run(max_ticks=ticks)
+    except KeyboardInterrupt:
+        click.echo('Price streamer stopped')
+
+@click.command('match-orders')
+@click.option('--interval-ms', type=int, default=None,
+              help='Milliseconds to wait for orders when the queue is short (defaults to ORDER_BATCH_INTERVAL_MS)')
+@click.option('--batch-size', type=int, default=None, help='Orders per batch (defaults to ORDER_BATCH_SIZE)')
+@click.option('--batches', type=int, default=None, help='Stop after this many non-empty batches')
+@with_appcontext
+def match_orders_command(interval_ms, batch_size, batches):
+    """Run the batch matching worker for queued limit orders (ORDER_MATCHING_MODE=batch)."""
+    from flask import current_app
+    from .trading.batcher import OrderBatchMatcher
+
+    app = current_app._get_current_object()
+    if app.config['ORDER_MATCHING_MODE'] != 'batch':
+        click.echo('Warning: ORDER_MATCHING_MODE is not "batch", requests still match orders themselves')
+    matcher = OrderBatchMatcher(
+        app,
+        interval=(interval_ms or app.config['ORDER_BATCH_INTERVAL_MS']) / 1000,
+        batch_size=batch_size or app.config['ORDER_BATCH_SIZE']
+    )
+    click.echo(f'Matching queued orders in batches of {matcher.batch_size} (Ctrl+C to stop)')
+    try:
+        matcher.run(max_batches=batches)
+    except KeyboardInterrupt:
+        pass
+    totals = matcher.totals
+    click.echo(f"Matched {totals['orders']} orders in {totals['batches']} batches: "
+               f"{totals['fills']} fills, {totals['rejected']} rejected")
+
+@click.command('rollup-rates')
+@click.option('--retention-days', type=int, default=None,
+              help='Days of raw rates to keep (defaults to RATE_RAW_RETENTION_DAYS)')
+@click.option('--no-prune', is_flag=True, help='Only roll up, keep all raw rates')
+@with_appcontext
+def rollup_rates_command(retention_days, no_prune):
+    """Roll raw exchange rates up into 5m/1h/1d OHLC buckets and prune old raw rows."""
+    try:
+        written = RateHistoryService.rollup()
+        click.echo('Rolled up ' + ', '.join(f'{count} {resolution}' for resolution, count in written.items()) + ' buckets')
+        if not no_prune:
+            pruned = RateHistoryService.prune_raw(retention_days)
+            click.echo(f'Pruned {pruned} raw exchange rates')
+    except Exception as e:
+        click.echo(f'Error rolling up rates: {str(e)}', err=True)
+
+@click.command('rebuild-balance-ledger')
+@click.option('--user-id', type=int, default=None, help='Only rebuild this user (defaults to everyone)')
+@with_appcontext
+def rebuild_balance_ledger_command(user_id):
+    """Rebuild the daily balance ledger from the transactions table."""
+    try:
+        written = DailyBalanceLedger.rebuild(user_id)
+        click.echo(f'Wrote {written} daily balance rows')
+    except Exception as e:
+        db.session.rollback()
+        click.echo(f'Error rebuilding balance ledger: {str(e)}', err=True)
+
+@click.command('rebuild-cost-basis')
+@click.option('--user-id', type=int, default=None, help='Only rebuild this user (defaults to everyone)')
+@with_appcontext
+def rebuild_cost_basis_command(user_id):
+    """Rebuild cost-basis positions by replaying transactions and copy-trade fills."""
+    try:
+        written = CostBasisService.rebuild(user_id)
+        click.echo(f'Wrote {written} cost basis rows')
+    except Exception as e:
+        db.session.rollback()
+        click.echo(f'Error rebuilding cost basis: {str(e)}', err=True)
+
+@click.command('check-cost-basis')
+@click.option('--user-id', type=int, default=None, help='Only check this user (defaults to everyone)')
+@with_appcontext
+def check_cost_basis_command(user_id):
+    """Check that the stored cost-basis positions equal a rebuild from the history."""
+    problems = CostBasisService.check(user_id)
+    for problem in problems:
+        click.echo(problem, err=True)
+    click.echo('FAILED: cost basis differs from a rebuild' if problems else 'OK: cost basis matches a rebuild')
+
+@click.command('benchmark-rates')
+@click.option('--assets', default='150,500,2000', help='Comma-separated asset counts to benchmark')
+def benchmark_rates_command(assets):
+    """Compare the loop and NumPy cross-rate computations (wall time and peak allocations)."""
+    counts = [int(count) for count in assets.split(',') if count.strip()]
+    click.echo(f"{'assets':>7} {'impl':>11} {'rows':>10} {'seconds':>10} {'peak MiB':>10}")
+    for result in benchmark_cross_rates(counts):
+        for impl in ('loop', 'vectorized'):
+            stats = result[impl]
+            click.echo(
+                f"{result['assets']:>7} {impl:>11} {stats['rows']:>10} "
+                f"{stats['seconds']:>10.3f} {stats['peak_bytes'] / (1024 * 1024):>10.1f}"
+            )
+        speedup = result['loop']['seconds'] / result['vectorized']['seconds'] if result['vectorized']['seconds'] else 0
+        click.echo(f"{result['assets']:>7} {'speedup':>11} {'':>10} {speedup:>9.1f}x")
+
+
+@click.command('benchmark-valuation')
+@click.option('--user-id', type=int, required=True, help='User whose portfolio is valued')
+@click.option('--runs', default=50, help='Timed runs per implementation')
+@with_appcontext
+def benchmark_valuation_command(user_id, runs):
+    """Compare the per-asset loop and the single-query SQL portfolio valuation."""
+    from .dashboard.services import PortfolioService
+
+    user = User.query.get(user_id)
+    if not user:
+        click.echo(f'User {user_id} not found', err=True)
+        return
+
+    base_currency_id = user.display_currency_id
+    implementations = (
+        ('loop', PortfolioService.value_holdings),
+        ('sql', PortfolioService.value_holdings_sql),
+    )
+    totals = {}
+    for name, valuate in implementations:
+        valuate(user_id, base_currency_id)  # Warm up the rate index and connection
+        started = time.perf_counter()
+        for _ in range(runs):
+            _, totals[name] = valuate(user_id, base_currency_id)
+        elapsed = (time.perf_counter() - started) / runs
+        click.echo(f"{name:>5}: {elapsed * 1000:8.2f} ms/run  total={totals[name]}")
+
+    if totals['loop'] != totals['sql']:
+        click.echo(f"Warning: totals differ by {totals['loop'] - totals['sql']}")
+
+@click.command('stress-balances')
+@click.option('--users', 'user_count', default=4, help='Temporary users moving funds between each other')
+@click.option('--workers', default=8, help='Concurrent worker threads')
+@click.option('--ops', default=50, help='Transfers or withdrawals per worker')
+@click.option('--initial', default=100, help='Starting balance of every temporary user')
+@click.option('--asset', 'asset_symbol', default='BTC', help='Crypto asset to move around')
+@click.option('--keep', is_flag=True, help='Keep the temporary users and their transactions')
+@with_appcontext
+def stress_balances_command(user_count, workers, ops, initial, asset_symbol, keep):
+    """Run concurrent transfers and withdrawals, then check no balance update was lost."""
+    from concurrent.futures import ThreadPoolExecutor
+    from flask import current_app
+    from sqlalchemy import func
+    from .models import (CostBasis, DailyBalance, InsufficientBalanceError, Transaction, TransactionStatus,
+                         TransactionType, settled_delta)
+    from .wallet.services import WalletService
+
+    asset = Asset.query.filter(
+        func.upper(Asset.symbol) == asset_symbol.upper(),
+        Asset.asset_type == AssetType.CRYPTO,
+        Asset.deleted_at.is_(None)
+    ).first()
+    if not asset:
+        click.echo(f'Crypto asset {asset_symbol} not found', err=True)
+        return
+    if user_count < 2:
+        click.echo('At least two users are needed', err=True)
+        return
+
+    # Temporary verified users, funded through deposits so the projector creates their holdings
+    tag = secrets.token_hex(4)
+    users = []
+    for index in range(user_count):
+        user = User(username=f'stress_{tag}_{index}', email=f'stress_{tag}_{index}@example.com', email_verified=True)
+        user.set_password(secrets.token_hex(16))
+        users.append(user)
+    db.session.add_all(users)
+    db.session.flush()
+    for user in users:
+        db.session.add(Transaction(
+            user_id=user.id, asset_id=asset.id, tx_type=TransactionType.DEPOSIT,
+            amount=Decimal(initial), status=TransactionStatus.SUCCESS, notes='Stress test funding',
+            timestamp=datetime.utcnow()
+        ))
+    db.session.commit()
+    accounts = [(user.id, user.email) for user in users]
+    user_ids = [user_id for user_id, _ in accounts]
+    asset_id = asset.id
+    app = current_app._get_current_object()
+
+    def worker(seed):
+        rng = random.Random(seed)
+        counts = {'transfers': 0, 'withdrawals': 0, 'rejected': 0, 'rejected_at_update': 0, 'errors': 0}
+        with app.app_context():
+            for _ in range(ops):
+                (sender_id, _), (_, recipient_email) = rng.sample(accounts, 2)
+                amount = Decimal(rng.randint(1, max(1, initial // 4)))
+                try:
+                    if rng.random() < 0.2:
+                        WalletService.withdraw_crypto(sender_id, asset.symbol, amount, 'stress-test')
+                        counts['withdrawals'] += 1
+                    else:
+                        WalletService.transfer_between_users(sender_id, recipient_email, asset_id, amount)
+                        counts['transfers'] += 1
+                except InsufficientBalanceError:
+                    # Passed the balance check but lost the race at the conditional debit
+                    counts['rejected_at_update'] += 1
+                except ValueError:
+                    counts['rejected'] += 1
+                except Exception as e:
+                    db.session.rollback()
+                    counts['errors'] += 1
+                    current_app.logger.warning(f'Stress operation failed: {e}')
+            db.session.remove()
+        return counts
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        results = list(pool.map(worker, range(workers)))
+    elapsed = time.perf_counter() - started
+
+    totals = {key: sum(result[key] for result in results) for key in results[0]}
+    click.echo(f"{workers} workers x {ops} ops in {elapsed:.2f}s: " +
+               ', '.join(f'{key}={value}' for key, value in totals.items()))
+
+    # Every holding must equal the sum of its settled transactions, and money only leaves through withdrawals
+    db.session.expire_all()
+    expected = {user_id: Decimal('0') for user_id in user_ids}
+    withdrawn = Decimal('0')
+    for tx in Transaction.query.filter(Transaction.user_id.in_(user_ids), Transaction.asset_id == asset_id):
+        expected[tx.user_id] += settled_delta(tx.tx_type, tx.amount, tx.status, tx.deleted_at)
+        if tx.tx_type == TransactionType.WITHDRAW:
+            withdrawn += tx.amount
+    balances = {holding.user_id: holding.balance for holding in
+                Holding.query.filter(Holding.user_id.in_(user_ids), Holding.asset_id == asset_id)}
+
+    problems = []
+    for user_id in user_ids:
+        balance = balances.get(user_id, Decimal('0'))
+        if balance != expected[user_id]:
+            problems.append(f'user {user_id}: holding {balance} != transactions {expected[user_id]}')
+        if balance < 0:
+            problems.append(f'user {user_id}: negative balance {balance}')
+    total = sum(balances.values(), Decimal('0'))
+    if total != Decimal(initial * user_count) - withdrawn:
+        problems.append(f'total {total} != funded {initial * user_count} - withdrawn {withdrawn}')
+    # Positions recorded fill by fill must equal a rebuild of the same history
+    for user_id in user_ids:
+        problems += CostBasisService.check(user_id)
+
+    if not keep:
+        db.session.query(Transaction).filter(Transaction.user_id.in_(user_ids)).delete(synchronize_session=False)
+        db.session.query(Holding).filter(Holding.user_id.in_(user_ids)).delete(synchronize_session=False)
+        db.session.query(DailyBalance).filter(DailyBalance.user_id.in_(user_ids)).delete(synchronize_session=False)
+        db.session.query(CostBasis).filter(CostBasis.user_id.in_(user_ids)).delete(synchronize_session=False)
+        db.session.query(User).filter(User.id.in_(user_ids)).delete(synchronize_session=False)
+        db.session.commit()
+
+    for problem in problems:
+        click.echo(problem, err=True)
+    click.echo('FAILED: balances drifted' if problems else f'OK: {len(user_ids)} balances consistent, total {total}')
+
+@click.command('explain-order-indexes')
+@click.option('--orders', default=100000, help='Open orders to generate')
+@click.option('--closed', default=100000, help='Filled and cancelled orders generated alongside them')
+@with_appcontext
+def explain_order_indexes_command(orders, closed):
+    """Check the matcher and cancel path queries use index scans on a large order book (rolled back afterwards)."""
+    from itertools import permutations
+    from sqlalchemy import func, text
+    from .models import OrderBook
+    from .trading.services import OrderBookService
+
+    assets = Asset.query.order_by(Asset.id).limit(4).all()
+    if len(assets) < 2:
+        click.echo('At least two assets are needed', err=True)
+        return
+    pairs = list(permutations([asset.id for asset in assets], 2))
+    dialect = db.engine.dialect
+    rng = random.Random(42)
+
+    try:
+        # A throwaway owner, everything below is rolled back
+        user = User(username=f'explain_{secrets.token_hex(4)}', email=f'explain_{secrets.token_hex(4)}@example.com')
+        user.set_password(secrets.token_hex(16))
+        db.session.add(user)
+        db.session.flush()
+
+        started = time.perf_counter()
+        statuses = ['open'] * orders + [rng.choice(['filled', 'cancelled']) for _ in range(closed)] + ['pending'] * 1000
+        now = datetime.utcnow()
+        batch = []
+        for status in statuses:
+            base_asset_id, quote_asset_id = rng.choice(pairs)
+            batch.append({
+                'user_id': user.id, 'base_asset_id': base_asset_id, 'quote_asset_id': quote_asset_id,
+                'order_type': 'limit', 'side': rng.choice(['buy', 'sell']), 'status': status,
+                'amount': Decimal(rng.randint(1, 1000)) / 100, 'price': Decimal(rng.randint(9000, 11000)),
+                'created_at': now,
+            })
+            if len(batch) == 10000:
+                db.session.execute(OrderBook.__table__.insert(), batch)
+                batch = []
+        if batch:
+            db.session.execute(OrderBook.__table__.insert(), batch)
+        db.session.execute(text('ANALYZE order_book' if dialect.name == 'postgresql' else 'ANALYZE'))
+        click.echo(f'Generated {len(statuses)} orders ({orders} open) in {time.perf_counter() - started:.1f}s')
+
+        base_asset_id, quote_asset_id = pairs[0]
+        some_order_id = db.session.query(func.max(OrderBook.id)).scalar()
+        # (name, query, whether its ORDER BY must come from the index rather than a sort)
+        checks = [
+            ('load open orders', OrderBookService.open_orders_query(base_asset_id, quote_asset_id), True),
+            ('newest open order', OrderBookService.newest_open_order_query(base_asset_id, quote_asset_id), False),
+            ('local depth', OrderBookService.local_depth_query(base_asset_id, quote_asset_id), False),
+            ('pending queue', OrderBookService.pending_orders_query(200), True),
+            ('cancel lookup', OrderBookService.cancellable_order_query(user.id, some_order_id), False),
+        ]
+
+        failures = []
+        for name, query, ordered in checks:
+            sql = str(query.statement.compile(dialect=dialect, compile_kwargs={'literal_binds': True}))
+            if dialect.name == 'postgresql':
+                plan = [row[0] for row in db.session.execute(text(f'EXPLAIN {sql}'))]
+                full_scan = any('Seq Scan on order_book' in line for line in plan)
+                sorted_ = ordered and any(line.strip().startswith('Sort') for line in plan)
+            else:
+                plan = [row[-1] for row in db.session.execute(text(f'EXPLAIN QUERY PLAN {sql}'))]
+                full_scan = any(line.startswith('SCAN order_book') and 'INDEX' not in line for line in plan)
+                sorted_ = ordered and any('TEMP B-TREE FOR ORDER BY' in line for line in plan)
+            ok = not full_scan and not sorted_
+            if not ok:
+                failures.append(name)
+            click.echo(f"{'ok' if ok else 'FAIL':>4}  {name}")
+            for line in plan:
+                click.echo(f'      {line}')
+    finally:
+        db.session.rollback()
+
+    if failures:
+        raise click.ClickException(f"Order book queries without an index scan: {', '.join(failures)}")
+    click.echo('All order book queries use index scans')
 
 @click.command('load-crypto-assets')
 @click.argument('json_file', type=click.Path(exists=True))
@@ -1104,6 +1459,16 @@ def init_app(app):
     app.cli.add_command(seed_holdings_command)
     app.cli.add_command(seed_deposit_addresses)
     app.cli.add_command(fetch_rates_command)
+    app.cli.add_command(rollup_rates_command)
+    app.cli.add_command(rebuild_balance_ledger_command)
+    app.cli.add_command(rebuild_cost_basis_command)
+    app.cli.add_command(check_cost_basis_command)
+    app.cli.add_command(stream_prices_command)
+    app.cli.add_command(match_orders_command)
+    app.cli.add_command(benchmark_rates_command)
+    app.cli.add_command(benchmark_valuation_command)
+    app.cli.add_command(stress_balances_command)
+    app.cli.add_command(explain_order_indexes_command)
     app.cli.add_command(load_crypto_assets_command)
     app.cli.add_command(fetch_crypto_images_command)
     app.cli.add_command(seed_traders_command)
@@ -20,6 +20,64 @@ class BaseConfig:
     # Exchange Secret Key
     EXCHANGE_SECRET_KEY = os.getenv("EXCHANGE_SECRET_KEY")
 
+    # Seconds before the in-memory latest-rate index is reloaded from the database
+    RATE_INDEX_MAX_AGE = int(os.getenv("RATE_INDEX_MAX_AGE", 300))
+    # Days of raw exchange_rates kept once rolled up into OHLC buckets (flask rollup-rates)
+    RATE_RAW_RETENTION_DAYS = int(os.getenv("RATE_RAW_RETENTION_DAYS", 7))
+
+    # Shared CoinGecko client (app/pricing/client.py); point the URL at a stub server for testing
+    COINGECKO_API_URL = os.getenv("COINGECKO_API_URL", "https://api.coingecko.com/api/v3")
+    COINGECKO_API_KEY = os.getenv("COINGECKO_API_KEY")
+    COINGECKO_RATE_LIMIT = float(os.getenv("COINGECKO_RATE_LIMIT", 0.5))  # Requests per second
+    COINGECKO_RATE_BURST = int(os.getenv("COINGECKO_RATE_BURST", 5))
+    COINGECKO_TIMEOUT = float(os.getenv("COINGECKO_TIMEOUT", 10))
+    COINGECKO_POOL_SIZE = int(os.getenv("COINGECKO_POOL_SIZE", 10))
+    # Longest a request handler waits for a rate-limit token before failing fast
+    COINGECKO_REQUEST_MAX_WAIT = float(os.getenv("COINGECKO_REQUEST_MAX_WAIT", 2))  # seconds
+
+    # Background price feed (flask stream-prices). When enabled, swap requests stop
+    # fetching live rates and rely on the streamed ones.
+    PRICE_STREAMER_ENABLED = os.getenv("PRICE_STREAMER_ENABLED", "False") == "True"
+    PRICE_STREAMER_INTERVAL = float(os.getenv("PRICE_STREAMER_INTERVAL", 60))  # seconds
+    PRICE_STREAMER_MAX_BACKOFF = float(os.getenv("PRICE_STREAMER_MAX_BACKOFF", 900))  # seconds
+    # Limit order matching: "sync" matches inside the request, "batch" only queues the
+    # order and the matching worker (flask match-orders) matches queued orders in
+    # micro-batches of up to ORDER_BATCH_SIZE orders, at least every ORDER_BATCH_INTERVAL_MS
+    ORDER_MATCHING_MODE = os.getenv("ORDER_MATCHING_MODE", "sync")
+    ORDER_BATCH_INTERVAL_MS = int(os.getenv("ORDER_BATCH_INTERVAL_MS", 50))
+    ORDER_BATCH_SIZE = int(os.getenv("ORDER_BATCH_SIZE", 200))
+    # Order book depth snapshots: served fresh for ORDER_BOOK_MAX_AGE seconds, then
+    # served stale while one background fetch refreshes them, for up to ORDER_BOOK_STALE_TTL
+    ORDER_BOOK_MAX_AGE = float(os.getenv("ORDER_BOOK_MAX_AGE", 2))
+    ORDER_BOOK_STALE_TTL = int(os.getenv("ORDER_BOOK_STALE_TTL", 30))
+    ORDER_BOOK_FETCH_DEPTH = int(os.getenv("ORDER_BOOK_FETCH_DEPTH", 100))  # Levels per side fetched upstream
+    # Value portfolios with one set-based SQL query instead of a per-asset rate loop
+    PORTFOLIO_SQL_VALUATION = os.getenv("PORTFOLIO_SQL_VALUATION", "False") == "True"
+    # Seconds a portfolio snapshot is kept; holdings and rate changes evict it earlier
+    PORTFOLIO_SNAPSHOT_TIMEOUT = int(os.getenv("PORTFOLIO_SNAPSHOT_TIMEOUT", 3600))
+    # Seconds a swap preview's quoted rate stays valid for execution
+    SWAP_QUOTE_TTL = int(os.getenv("SWAP_QUOTE_TTL", 15))
+
+    # Cache backend shared by every worker. SimpleCache is per process; use
+    # FileSystemCache on a single host or RedisCache (needs the redis package)
+    # across hosts, so snapshots, quotes and version keys are seen by all workers.
+    # Cross-worker invalidation is safe on both: version keys are written as fresh
+    # unique values, never read-modify-write. Only Redis makes add() atomic, so on
+    # the filesystem two workers may occasionally both refresh the same order book.
+    CACHE_TYPE = os.getenv("CACHE_TYPE", "SimpleCache")
+    CACHE_DEFAULT_TIMEOUT = int(os.getenv("CACHE_DEFAULT_TIMEOUT", 300))
+    CACHE_THRESHOLD = int(os.getenv("CACHE_THRESHOLD", 5000))  # Max entries for Simple/FileSystem caches
+    CACHE_REDIS_URL = os.getenv("CACHE_REDIS_URL", "redis://localhost:6379/0")
+    # Keys are namespaced per deployment and versioned: bump CACHE_VERSION when the
+    # shape of cached values changes and every worker moves to fresh keys at once
+    CACHE_NAMESPACE = os.getenv("CACHE_NAMESPACE", "bloxxxchain")
+    CACHE_VERSION = os.getenv("CACHE_VERSION", "1")
+    CACHE_KEY_PREFIX = f"{CACHE_NAMESPACE}:v{CACHE_VERSION}:"
+    # The filesystem backend ignores key prefixes, so it gets a directory per namespace and version
+    CACHE_DIR = os.getenv(
+        "CACHE_DIR", str(Path(__file__).parent.parent / "instance" / "cache" / f"{CACHE_NAMESPACE}-v{CACHE_VERSION}")
+    )
+
     # Asset configs
     ASSETS_DEBUG = os.environ.get('ASSETS_DEBUG', 'False') == 'True'
     ASSETS_AUTO_BUILD = True
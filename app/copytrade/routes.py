@@ -1,3 +1,4 @@
+from decimal import Decimal
 from flask import render_template, request, jsonify, flash, redirect, url_for, current_app
 from flask_login import current_user, login_required
 from app.models import CopyTrade, Asset, CopyTradeTransaction, Trader
@@ -6,6 +7,7 @@ from app.copytrade import copytrade_bp
 from app.copytrade.services import get_list_of_traders, get_trader_by_id
 from app.copytrade.forms import CopyTraderForm
 from app.dashboard.services import PortfolioService
+from app.ledger import CostBasisService, COPY_BOOK
 from app.staking.services import AssetService
 
 
@@ -449,7 +451,12 @@ def copy_transactions():
             start_date = now - timedelta(days=30)
             total_pnl = total_pnl.filter(CopyTradeTransaction.transaction_timestamp >= start_date)
     
-    total_pnl = total_pnl.scalar() or 0
+    if period_filter == 'all':
+        # All-time P&L is kept up to date as fills complete
+        positions = CostBasisService.get_positions(current_user.id, book=COPY_BOOK)
+        total_pnl = sum((position['realized_pnl'] for position in positions.values()), Decimal('0'))
+    else:
+        total_pnl = total_pnl.scalar() or 0
     
     profitable_trades = stats_query.filter(CopyTradeTransaction.pnl > 0).count()
     total_trades = stats_query.count()
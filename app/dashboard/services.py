@@ -1,9 +1,15 @@
+import uuid
 from datetime import datetime, timedelta
-import requests
-import os
-from sqlalchemy import func
-from app.models import User, Holding, Asset, ExchangeRate, AssetType, Transaction, TransactionType
+from flask import current_app, has_app_context
+from sqlalchemy import Numeric, and_, case, event, func, literal
+from sqlalchemy.orm import Session, aliased
+from app.models import User, Holding, Asset, ExchangeRate, LatestExchangeRate, AssetType, Transaction
 from app.extensions import db, cache
+from app.events import holdings_changed
+from app.pricing import RateService, RateHistoryService
+from app.pricing.client import get_coingecko_client
+from app.ledger import CostBasisService, DailyBalanceLedger
+from app.pricing.vectorized import build_price_matrix, matrix_to_rows
 from decimal import Decimal
 
 class PortfolioService:
@@ -24,68 +30,121 @@ class PortfolioService:
         return holdings
 
     @staticmethod
-    def get_portfolio_value(user_id, base_currency_id):
-        """Calculate total portfolio value in specified base currency"""
-        # Get all holdings for the user
+    def _valuation_row(asset, balance, rate, value):
+        return {
+            'asset_id': asset.id,
+            'symbol': asset.symbol,
+            'name': asset.name,
+            'images': asset.images,
+            'balance': balance,
+            'rate': rate,
+            'value': value
+        }
+
+    @staticmethod
+    def value_holdings(user_id, base_currency_id):
+        """
+        Value every holding against the latest rates, one rate lookup per asset.
+        Returns (rows of asset fields, balance, rate and value; total value).
+        """
         holdings = PortfolioService.get_user_holdings(user_id)
         
+        rows = []
         total_value = Decimal('0')
         for holding, asset in holdings:
+            balance = Decimal(str(holding.balance))
             if asset.id == base_currency_id:
                 # If the holding is in the base currency, add directly
-                total_value += Decimal(str(holding.balance))
+                rate = Decimal('1')
             else:
                 # Get latest exchange rate to base currency
-                latest_rate = db.session.query(
-                    ExchangeRate.rate
-                ).filter(
-                    ExchangeRate.base_asset_id == asset.id,
-                    ExchangeRate.quote_asset_id == base_currency_id,
-                    ExchangeRate.deleted_at.is_(None)
-                ).order_by(
-                    ExchangeRate.timestamp.desc()
-                ).first()
-                
-                if latest_rate:
-                    total_value += Decimal(str(holding.balance)) * Decimal(str(latest_rate.rate))
+                rate = RateService.get_rate(asset.id, base_currency_id)
+            value = balance * rate if rate else Decimal('0')
+            total_value += value
+            rows.append(PortfolioService._valuation_row(asset, balance, rate, value))
+        
+        return rows, total_value
+
+    @staticmethod
+    def value_holdings_sql(user_id, base_currency_id):
+        """
+        Set-based variant of value_holdings: holdings joined to latest_exchange_rates
+        (the direct pair, or the USD legs for a triangulated cross rate) with the
+        total as a window sum, all in one round trip
+        """
+        direct = aliased(LatestExchangeRate)
+        asset_leg = aliased(LatestExchangeRate)
+        quote_leg = aliased(LatestExchangeRate)
+        pivot_id = RateService.get_pivot_asset_id()
+        
+        if pivot_id is not None and pivot_id != base_currency_id:
+            cross_rate = case(
+                (Holding.asset_id != pivot_id, asset_leg.rate / func.nullif(quote_leg.rate, 0)),
+                else_=None
+            )
+        else:
+            cross_rate = literal(None, Numeric(30, 18))
+        rate = case(
+            (Holding.asset_id == base_currency_id, literal(1, Numeric(30, 18))),
+            else_=func.coalesce(direct.rate, cross_rate)
+        )
+        value = func.coalesce(Holding.balance * rate, 0)
         
-        return total_value
+        query = db.session.query(
+            Holding.balance,
+            Asset,
+            rate.label('rate'),
+            value.label('value'),
+            func.sum(value).over().label('total_value')
+        ).join(
+            Asset, Holding.asset_id == Asset.id
+        ).outerjoin(
+            direct, and_(direct.base_asset_id == Holding.asset_id,
+                         direct.quote_asset_id == base_currency_id)
+        ).outerjoin(
+            asset_leg, and_(asset_leg.base_asset_id == Holding.asset_id,
+                            asset_leg.quote_asset_id == pivot_id)
+        ).outerjoin(
+            quote_leg, and_(quote_leg.base_asset_id == base_currency_id,
+                            quote_leg.quote_asset_id == pivot_id)
+        ).filter(
+            Holding.user_id == user_id,
+            Holding.deleted_at.is_(None)
+        )
+        
+        rows = []
+        total_value = Decimal('0')
+        for row in query.all():
+            total_value = Decimal(str(row.total_value))
+            rows.append(PortfolioService._valuation_row(
+                row.Asset,
+                Decimal(str(row.balance)),
+                Decimal(str(row.rate)) if row.rate is not None else None,
+                Decimal(str(row.value))
+            ))
+        
+        return rows, total_value
+
+    @staticmethod
+    def get_portfolio_value(user_id, base_currency_id):
+        """Calculate total portfolio value in specified base currency"""
+        snapshot = PortfolioSnapshotService.get_snapshot(user_id, base_currency_id)
+        return snapshot['total_value']
 
     @staticmethod
     def get_portfolio_details(user_id, base_currency_id):
         """Get detailed portfolio information including holdings and their values"""
-        holdings = PortfolioService.get_user_holdings(user_id)
-        total_value = PortfolioService.get_portfolio_value(user_id, base_currency_id)
+        snapshot = PortfolioSnapshotService.get_snapshot(user_id, base_currency_id)
+        total_value = snapshot['total_value']
         
         portfolio_details = []
-        for holding, asset in holdings:
-            holding_value = Decimal('0')
-            if asset.id == base_currency_id:
-                holding_value = Decimal(str(holding.balance))
-            else:
-                latest_rate = db.session.query(
-                    ExchangeRate.rate
-                ).filter(
-                    ExchangeRate.base_asset_id == asset.id,
-                    ExchangeRate.quote_asset_id == base_currency_id,
-                    ExchangeRate.deleted_at.is_(None)
-                ).order_by(
-                    ExchangeRate.timestamp.desc()
-                ).first()
-                
-                if latest_rate:
-                    holding_value = Decimal(str(holding.balance)) * Decimal(str(latest_rate.rate))
-            
-            percentage = (holding_value / total_value * 100) if total_value > 0 else Decimal('0')
+        for holding in snapshot['holdings']:
+            percentage = (holding['value'] / total_value * 100) if total_value > 0 else Decimal('0')
             
             portfolio_details.append({
-                'asset': {
-                    'symbol': asset.symbol.upper(),
-                    'name': asset.name,
-                    'image': asset.images.get('small') if asset.images else None
-                },
-                'balance': float(holding.balance),
-                'value': float(holding_value),
+                'asset': holding['asset'],
+                'balance': float(holding['balance']),
+                'value': float(holding['value']),
                 'percentage': float(percentage)
             })
         
@@ -98,54 +157,14 @@ class PortfolioService:
         }
         
     @staticmethod
-    @cache.memoize(timeout=300)  # Cache for 5 minutes
     def get_portfolio_24h_change(user_id, base_currency_id):
         """
         Calculate the 24-hour change for the portfolio
         Returns a tuple of (current_value, previous_value, absolute_change, percentage_change)
         """
-        # Get current portfolio value
-        current_value = PortfolioService.get_portfolio_value(user_id, base_currency_id)
-        
-        # Calculate portfolio value from 24 hours ago
-        now = datetime.utcnow()
-        yesterday = now - timedelta(days=1)
-        
-        holdings = PortfolioService.get_user_holdings(user_id)
-        previous_value = Decimal('0')
-        
-        for holding, asset in holdings:
-            if asset.id == base_currency_id:
-                previous_value += Decimal(str(holding.balance))
-            else:
-                # Get exchange rate from 24 hours ago
-                old_rate = db.session.query(
-                    ExchangeRate.rate
-                ).filter(
-                    ExchangeRate.base_asset_id == asset.id,
-                    ExchangeRate.quote_asset_id == base_currency_id,
-                    ExchangeRate.timestamp <= yesterday,
-                    ExchangeRate.deleted_at.is_(None)
-                ).order_by(
-                    ExchangeRate.timestamp.desc()
-                ).first()
-                
-                if old_rate:
-                    previous_value += Decimal(str(holding.balance)) * Decimal(str(old_rate.rate))
-                else:
-                    # Fallback to latest rate if no historical rate available
-                    latest_rate = db.session.query(
-                        ExchangeRate.rate
-                    ).filter(
-                        ExchangeRate.base_asset_id == asset.id,
-                        ExchangeRate.quote_asset_id == base_currency_id,
-                        ExchangeRate.deleted_at.is_(None)
-                    ).order_by(
-                        ExchangeRate.timestamp.desc()
-                    ).first()
-                    
-                    if latest_rate:
-                        previous_value += Decimal(str(holding.balance)) * Decimal(str(latest_rate.rate))
+        snapshot = PortfolioSnapshotService.get_snapshot(user_id, base_currency_id)
+        current_value = snapshot['total_value']
+        previous_value = snapshot['previous_value']
         
         # Calculate changes
         absolute_change = current_value - previous_value
@@ -185,21 +204,11 @@ class PortfolioService:
         # Get current portfolio value
         current_value = PortfolioService.get_portfolio_value(user_id, base_currency_id)
         
-        # Calculate total investment using transaction history
-        query = db.session.query(
-            func.sum(Transaction.amount * Transaction.price).label('total_investment')
-        ).filter(
-            Transaction.user_id == user_id,
-            Transaction.deleted_at.is_(None),
-            Transaction.tx_type.in_([TransactionType.DEPOSIT, TransactionType.TRADE_BUY])
-        )
-        
-        # Apply time filter if specified
-        if start_date:
-            query = query.filter(Transaction.timestamp >= start_date)
-        
-        result = query.first()
-        total_investment = Decimal(str(result.total_investment)) if result and result.total_investment else Decimal('0')
+        # Money put into the portfolio over the period, precomputed as transactions were recorded
+        positions = CostBasisService.get_positions(user_id, since=start_date)
+        pivot_rate = CostBasisService.pivot_rate(base_currency_id) or Decimal('0')
+        total_investment = sum((position['period_net_deposits'] for position in positions.values()), Decimal('0')) * pivot_rate
+        realized_pnl = sum((position['period_realized_pnl'] for position in positions.values()), Decimal('0')) * pivot_rate
         
         # Calculate profit/loss
         profit_loss = current_value - total_investment
@@ -209,6 +218,7 @@ class PortfolioService:
             'total_investment': float(total_investment),
             'current_value': float(current_value),
             'profit_loss': float(profit_loss),
+            'realized_pnl': float(realized_pnl),
             'roi_percentage': float(roi_percentage),
             'time_period': time_period
         }
@@ -240,6 +250,10 @@ class PortfolioService:
         # Get current holdings
         holdings = PortfolioService.get_user_holdings(user_id)
         
+        # Cost basis of every position, precomputed as transactions were recorded
+        positions = CostBasisService.get_positions(user_id, since=start_date)
+        pivot_rate = CostBasisService.pivot_rate(base_currency_id) or Decimal('0')
+        
         performance_data = []
         for holding, asset in holdings:
             # Skip zero balance holdings
@@ -254,36 +268,15 @@ class PortfolioService:
                 current_value = Decimal(str(holding.balance))
             else:
                 # Get latest exchange rate
-                current_rate = db.session.query(
-                    ExchangeRate.rate
-                ).filter(
-                    ExchangeRate.base_asset_id == asset.id,
-                    ExchangeRate.quote_asset_id == base_currency_id,
-                    ExchangeRate.deleted_at.is_(None)
-                ).order_by(
-                    ExchangeRate.timestamp.desc()
-                ).first()
+                current_rate = RateService.get_latest_rate(asset.id, base_currency_id)
                 
                 if current_rate:
                     current_value = Decimal(str(holding.balance)) * Decimal(str(current_rate.rate))
             
-            # Calculate cost basis from transactions
-            query = db.session.query(
-                func.sum(Transaction.amount * Transaction.price).label('total_cost'),
-                func.sum(Transaction.amount).label('total_amount')
-            ).filter(
-                Transaction.user_id == user_id,
-                Transaction.asset_id == asset.id,
-                Transaction.deleted_at.is_(None),
-                Transaction.tx_type == TransactionType.TRADE_BUY
-            )
-            
-            # Apply time filter if specified
-            if start_date:
-                query = query.filter(Transaction.timestamp >= start_date)
-            
-            result = query.first()
-            total_cost = Decimal(str(result.total_cost)) if result and result.total_cost else Decimal('0')
+            # Average cost of the quantity still held, and P&L realized over the period
+            position = positions.get(asset.id)
+            total_cost = position['cost_basis'] * pivot_rate if position else Decimal('0')
+            realized_pnl = position['period_realized_pnl'] * pivot_rate if position else Decimal('0')
             
             # Calculate profit/loss for this asset
             profit_loss = current_value - total_cost
@@ -297,19 +290,12 @@ class PortfolioService:
             
             if asset.id != base_currency_id and current_rate:
                 # Get rate from 24 hours ago
-                old_rate = db.session.query(
-                    ExchangeRate.rate
-                ).filter(
-                    ExchangeRate.base_asset_id == asset.id,
-                    ExchangeRate.quote_asset_id == base_currency_id,
-                    ExchangeRate.timestamp <= (now - timedelta(days=1)),
-                    ExchangeRate.deleted_at.is_(None)
-                ).order_by(
-                    ExchangeRate.timestamp.desc()
-                ).first()
+                old_rate = RateHistoryService.get_rate_at(
+                    asset.id, base_currency_id, now - timedelta(days=1), granularity=timedelta(hours=1)
+                )
                 
                 if old_rate:
-                    old_price = Decimal(str(old_rate.rate))
+                    old_price = old_rate
                     current_price = Decimal(str(current_rate.rate))
                     change = current_price - old_price
                     percentage_change = (change / old_price * 100) if old_price > 0 else Decimal('0')
@@ -326,6 +312,7 @@ class PortfolioService:
                 'current_value': float(current_value),
                 'cost_basis': float(total_cost),
                 'profit_loss': float(profit_loss),
+                'realized_pnl': float(realized_pnl),
                 'roi_percentage': float(roi_percentage),
                 'price_data': price_change
             })
@@ -350,52 +337,42 @@ class PortfolioService:
         start_date = datetime.utcnow() - timedelta(days=days)
         
         # Get distinct dates with exchange rate data
-        distinct_dates = db.session.query(
-            func.date(ExchangeRate.timestamp).label('date')
-        ).filter(
-            ExchangeRate.timestamp >= start_date,
-            ExchangeRate.deleted_at.is_(None)
-        ).group_by(
-            func.date(ExchangeRate.timestamp)
-        ).order_by(
-            func.date(ExchangeRate.timestamp)
-        ).all()
-        
-        # Get all assets the user holds
-        holdings = PortfolioService.get_user_holdings(user_id)
+        distinct_dates = RateHistoryService.get_history_dates(start_date)
+        if not distinct_dates:
+            return []
+        
+        # Closing balance of every asset the user held on each date, merged from the daily ledger
+        changes = DailyBalanceLedger.get_balance_changes(user_id, distinct_dates[0], distinct_dates[-1])
+        balances = DailyBalanceLedger.closing_balances(changes, distinct_dates)
+        
+        end_of_days = [datetime.combine(date, datetime.max.time()) for date in distinct_dates]
+        
+        # Rates of every held asset at the end of every day, in one query on the daily buckets
+        rates = RateHistoryService.get_rates_as_of(
+            [asset_id for asset_id in balances if asset_id != base_currency_id],
+            base_currency_id,
+            end_of_days,
+            granularity=timedelta(days=1)
+        )
         
         historical_values = []
-        for date_obj in distinct_dates:
-            date = date_obj.date
-            end_of_day = datetime.combine(date, datetime.max.time())
-            
+        for index, (date, end_of_day) in enumerate(zip(distinct_dates, end_of_days)):
             # Calculate portfolio value at this date
             portfolio_value = Decimal('0')
             
-            for holding, asset in holdings:
+            for asset_id, series in balances.items():
+                balance = series[index]
                 # Skip zero balance holdings
-                if Decimal(str(holding.balance)) == 0:
+                if balance == 0:
                     continue
                 
-                if asset.id == base_currency_id:
-                    portfolio_value += Decimal(str(holding.balance))
+                if asset_id == base_currency_id:
+                    portfolio_value += balance
                 else:
-                    # Get the exchange rate for this date
-                    rate = db.session.query(
-                        ExchangeRate.rate
-                    ).filter(
-                        ExchangeRate.base_asset_id == asset.id,
-                        ExchangeRate.quote_asset_id == base_currency_id,
-                        ExchangeRate.timestamp <= end_of_day,
-                        ExchangeRate.deleted_at.is_(None)
-                    ).order_by(
-                        ExchangeRate.timestamp.desc()
-                    ).first()
+                    rate = rates.get((asset_id, end_of_day))
                     
                     if rate:
-                        # Need to adjust for transactions that occurred after this date
-                        # This is a simplified approach - for full accuracy, transaction history should be considered
-                        portfolio_value += Decimal(str(holding.balance)) * Decimal(str(rate.rate))
+                        portfolio_value += balance * rate
             
             historical_values.append({
                 'date': date.isoformat(),
@@ -404,12 +381,133 @@ class PortfolioService:
         
         return historical_values
     
+class PortfolioSnapshotService:
+    """
+    Per-user portfolio valuation (holdings x latest rates, plus the value 24 hours
+    ago) computed once and kept in the cache, one entry per user with a snapshot per
+    base currency. Snapshots are stamped with the user's holdings version and the
+    published rates version: a holdings-changed event evicts the user's entry, and a
+    rate refresh makes every older stamp stale, so entries can be kept for long.
+    """
+    DEFAULT_SNAPSHOT_TIMEOUT = 3600  # seconds
+
+    @staticmethod
+    def _snapshot_timeout():
+        return current_app.config.get('PORTFOLIO_SNAPSHOT_TIMEOUT', PortfolioSnapshotService.DEFAULT_SNAPSHOT_TIMEOUT)
+
+    @staticmethod
+    def _holdings_version_key(user_id):
+        return f"portfolio:holdings_version:{user_id}"
+
+    @staticmethod
+    def _snapshot_key(user_id):
+        return f"portfolio:snapshot:{user_id}"
+
+    @staticmethod
+    def _versions(user_id):
+        key = PortfolioSnapshotService._holdings_version_key(user_id)
+        holdings_version = cache.get(key)
+        if holdings_version is None:
+            # Never bumped, or pruned by a size-capped backend (CACHE_THRESHOLD): start
+            # a new version, so no snapshot stamped before the key went missing matches
+            cache.add(key, uuid.uuid4().hex, timeout=0)
+            holdings_version = cache.get(key)
+        rates_version = RateService.rates_version()
+        return holdings_version, rates_version.timestamp() if rates_version else 0
+
+    @staticmethod
+    def invalidate_user(user_id):
+        """Evict every snapshot of a user after their holdings changed"""
+        # The version bump also outdates a snapshot another worker is building from
+        # the old holdings right now and stores after the delete
+        PortfolioSnapshotService._bump_holdings_version(user_id)
+        cache.delete(PortfolioSnapshotService._snapshot_key(user_id))
+
+    @staticmethod
+    def _bump_holdings_version(user_id):
+        """
+        Give the user's holdings a new version. Snapshots only compare stamps for
+        equality, so the version is a fresh unique token rather than a counter:
+        two workers bumping at once can't both write the same value, whatever the
+        backend. It never expires, a version that disappeared could match an older
+        snapshot's stamp again.
+        """
+        key = PortfolioSnapshotService._holdings_version_key(user_id)
+        cache.set(key, uuid.uuid4().hex, timeout=0)
+
+    @staticmethod
+    def build_snapshot(user_id, base_currency_id):
+        """Load holdings and rates once and value every holding in the base currency"""
+        if current_app.config.get('PORTFOLIO_SQL_VALUATION'):
+            valuations, total_value = PortfolioService.value_holdings_sql(user_id, base_currency_id)
+        else:
+            valuations, total_value = PortfolioService.value_holdings(user_id, base_currency_id)
+        
+        # Rates from 24 hours ago for all held assets, in one query
+        yesterday = datetime.utcnow() - timedelta(days=1)
+        previous_rates = RateHistoryService.get_rates_as_of(
+            [row['asset_id'] for row in valuations if row['asset_id'] != base_currency_id],
+            base_currency_id,
+            [yesterday],
+            granularity=timedelta(hours=1)
+        )
+        
+        previous_value = Decimal('0')
+        snapshot_holdings = []
+        for row in valuations:
+            # Fallback to latest rate if no historical rate available
+            old_rate = previous_rates.get((row['asset_id'], yesterday)) or row['rate']
+            if row['asset_id'] == base_currency_id:
+                previous_value += row['balance']
+            elif old_rate:
+                previous_value += row['balance'] * old_rate
+            
+            snapshot_holdings.append({
+                'asset': {
+                    'symbol': row['symbol'].upper(),
+                    'name': row['name'],
+                    'image': row['images'].get('small') if row['images'] else None
+                },
+                'asset_id': row['asset_id'],
+                'balance': row['balance'],
+                'value': row['value']
+            })
+        
+        return {
+            'user_id': user_id,
+            'base_currency_id': base_currency_id,
+            'total_value': total_value,
+            'previous_value': previous_value,
+            'holdings': snapshot_holdings,
+            'computed_at': datetime.utcnow()
+        }
+
+    @staticmethod
+    def get_snapshot(user_id, base_currency_id):
+        """The cached snapshot, rebuilt when holdings or rates have changed since"""
+        # Versions are read before building, so a change committed meanwhile leaves the result stale
+        versions = PortfolioSnapshotService._versions(user_id)
+        key = PortfolioSnapshotService._snapshot_key(user_id)
+        entry = cache.get(key) or {}
+        cached = entry.get(base_currency_id)
+        if cached is not None and cached[0] == versions:
+            return cached[1]
+
+        snapshot = PortfolioSnapshotService.build_snapshot(user_id, base_currency_id)
+        entry = {base_id: stamped for base_id, stamped in entry.items() if stamped[0] == versions}
+        entry[base_currency_id] = (versions, snapshot)
+        cache.set(key, entry, timeout=PortfolioSnapshotService._snapshot_timeout())
+        return snapshot
+
+
 class CoinGeckoService:
-    COINGECKO_API = "https://api.coingecko.com/api/v3"
-    
     @staticmethod
-    def fetch_and_store_rates():
-        """Get the latest exchange rates for crypto-to-fiat and crypto-to-crypto pairs"""
+    def fetch_and_store_rates(fetch_prices=None, source="coingecko"):
+        """
+        Get the latest crypto-to-fiat exchange rates (crypto-to-crypto is triangulated on read).
+        fetch_prices(coin_ids, vs_currencies) can replace the CoinGecko request with any
+        source of /simple/price shaped data, e.g. the price streamer's providers.
+        """
         
         # Get all assets that have CoinGecko IDs
         crypto_assets = Asset.query.filter(
@@ -430,71 +528,69 @@ class CoinGeckoService:
         vs_currencies = [asset.symbol.lower() for asset in fiat_assets]
 
         # Make API request for crypto-to-fiat rates
-        url = f"{CoinGeckoService.COINGECKO_API}/simple/price"
-        params = {
-            "ids": ",".join(coin_ids),
-            "vs_currencies": ",".join(vs_currencies),
-            "include_last_updated_at": True
-        }
-        
-        if os.getenv("COINGECKO_API_KEY"):
-            params["x_cg_pro_api_key"] = os.getenv("COINGECKO_API_KEY")
-
-        response = requests.get(url, params=params)
-        response.raise_for_status()
-        data = response.json()
+        if fetch_prices is None:
+            data = get_coingecko_client().simple_price(coin_ids, vs_currencies, include_last_updated_at='true')
+        else:
+            data = fetch_prices(coin_ids, vs_currencies)
 
-        # Process response for crypto-to-fiat rates
+        # Process response for crypto-to-fiat rates: one price matrix for the whole
+        # response, converted to Decimal only for the rows that get stored
         timestamp = datetime.utcnow()
-        new_rates = []
+        price_matrix = build_price_matrix(data, coin_ids, vs_currencies)
+        new_rates = matrix_to_rows(
+            price_matrix,
+            [asset.id for asset in crypto_assets],
+            [asset.id for asset in fiat_assets],
+            timestamp,
+            source
+        )
 
-        for crypto in crypto_assets:
-            coin_data = data.get(crypto.coingecko_id, {})
-            
-            for fiat in fiat_assets:
-                rate = coin_data.get(fiat.symbol.lower())
-                if rate is None:
-                    continue
+        # Crypto-to-crypto rates are not stored, RateService derives them
+        # on demand from the USD legs above
 
-                # Create ExchangeRate entry
-                new_rate = ExchangeRate(
-                    base_asset_id=crypto.id,
-                    quote_asset_id=fiat.id,
-                    rate=rate,
-                    timestamp=timestamp,
-                    source="coingecko"
-                )
-                new_rates.append(new_rate)
-
-        # Calculate and store crypto-to-crypto rates using USD as intermediate
-        usd_asset = Asset.query.filter_by(symbol="USD", asset_type=AssetType.FIAT).first()
-        if usd_asset:
-            for base_crypto in crypto_assets:
-                base_usd_rate = data.get(base_crypto.coingecko_id, {}).get("usd")
-                if not base_usd_rate:
-                    continue
-                    
-                for quote_crypto in crypto_assets:
-                    if base_crypto.id == quote_crypto.id:
-                        continue
-                        
-                    quote_usd_rate = data.get(quote_crypto.coingecko_id, {}).get("usd")
-                    if not quote_usd_rate:
-                        continue
-                        
-                    # Calculate rate between the two cryptos using USD as intermediate
-                    rate = Decimal(str(base_usd_rate)) / Decimal(str(quote_usd_rate))
-                    
-                    new_rate = ExchangeRate(
-                        base_asset_id=base_crypto.id,
-                        quote_asset_id=quote_crypto.id,
-                        rate=rate,
-                        timestamp=timestamp,
-                        source="coingecko"
-                    )
-                    new_rates.append(new_rate)
-
-        # Bulk insert
-        db.session.bulk_save_objects(new_rates)
+        # Bulk insert, and upsert the current-rate table in the same transaction
+        db.session.bulk_insert_mappings(ExchangeRate, new_rates)
+        RateService.upsert_latest_rates(new_rates)
         db.session.commit()
+
+        # Bulk inserts skip the ORM insert events, so announce the new rates version:
+        # this process reloads its latest-rate index from the rates_refreshed event,
+        # other processes from the version in the shared cache
+        RateService.publish_rates_version()
         return len(new_rates)
+
+
+# ----- Event listeners -----
+# Holding changes are staged per session and only announced on the invalidation
+# bus once the transaction commits, so a rolled back swap never evicts anything.
+
+# Transactions move balances with Core updates from the balance projector, which
+# skip the Holding mapper events, so they stage their user as well
+@event.listens_for(Holding, 'after_insert')
+@event.listens_for(Holding, 'after_update')
+@event.listens_for(Holding, 'after_delete')
+@event.listens_for(Transaction, 'after_insert')
+@event.listens_for(Transaction, 'after_update')
+@event.listens_for(Transaction, 'after_delete')
+def stage_holding_change(mapper, connection, target):
+    session = Session.object_session(target)
+    if session is not None:
+        session.info.setdefault('changed_holding_users', set()).add(target.user_id)
+
+
+@event.listens_for(Session, 'after_commit')
+def invalidate_snapshots_after_commit(session):
+    user_ids = session.info.pop('changed_holding_users', None)
+    if user_ids and has_app_context():
+        for user_id in user_ids:
+            holdings_changed.send(user_id)
+
+
+@event.listens_for(Session, 'after_rollback')
+def discard_holding_changes_after_rollback(session):
+    session.info.pop('changed_holding_users', None)
+
+
+@holdings_changed.connect
+def evict_snapshots_on_holdings_change(user_id):
+    PortfolioSnapshotService.invalidate_user(user_id)
@@ -0,0 +1,16 @@
+# app/events.py
+"""
+In-process invalidation bus. Services send these signals once their changes are
+committed; caches subscribe and evict exactly the entries the change affects.
+Other workers learn about the same changes through the version keys kept in the
+shared cache.
+"""
+from blinker import Namespace
+
+_signals = Namespace()
+
+# A commit changed a user's balances, sent with the user id as sender
+holdings_changed = _signals.signal('holdings-changed')
+
+# Fresh exchange rates were committed, sent with the new rates version as sender
+rates_refreshed = _signals.signal('rates-refreshed')
@@ -10,7 +10,7 @@ db = SQLAlchemy()
 migrate = Migrate()
 login_manager = LoginManager()
 login_manager.login_view = "auth.login"
-cache = Cache(config={'CACHE_TYPE': 'SimpleCache'})
+cache = Cache()  # Backend chosen by CACHE_TYPE in the app config
 assets = Environment()
 mail = Mail()
 csrf = CSRFProtect()
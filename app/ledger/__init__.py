@@ -0,0 +1,4 @@
+# app/ledger/__init__.py
+
+from .balances import DailyBalanceLedger, settled_delta
+from .cost_basis import CostBasisService, SPOT_BOOK, COPY_BOOK
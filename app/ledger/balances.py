@@ -0,0 +1,224 @@
+# app/ledger/balances.py
+from collections import defaultdict
+from datetime import date, datetime
+from decimal import Decimal
+from typing import Dict, List, Optional, Sequence, Tuple
+from sqlalchemy import and_, case, event, func, or_, select
+from sqlalchemy.dialects import postgresql, sqlite
+from app.models import (DailyBalance, Transaction, TransactionStatus, BALANCE_INFLOWS, BALANCE_OUTFLOWS,
+                        previous_transaction_state, settled_delta, transaction_changed_balance)
+from app.extensions import db
+
+
+def _ledger_day(timestamp: Optional[datetime]) -> date:
+    return (timestamp or datetime.utcnow()).date()
+
+
+class DailyBalanceLedger:
+    """
+    Per user, asset and day ledger of settled transaction flow with a running
+    closing balance, kept up to date from Transaction inserts, updates and deletes
+    in the same database transaction. A transaction counts on the day of its
+    timestamp; a backdated one also shifts the running balance of every later day.
+    """
+
+    @staticmethod
+    def apply(user_id: int, asset_id: int, day: date, delta: Decimal, tx_count: int = 1, connection=None):
+        """Add delta to the user's asset flow on day and to the closing balance of that and every later day"""
+        connection = connection if connection is not None else db.session.connection()
+        table = DailyBalance.__table__
+        now = datetime.utcnow()
+        key_filter = and_(table.c.user_id == user_id, table.c.asset_id == asset_id)
+
+        connection.execute(
+            table.update().where(key_filter, table.c.day > day).values(
+                balance=table.c.balance + delta,
+                updated_at=now
+            )
+        )
+
+        opening = connection.execute(
+            select(table.c.balance).where(key_filter, table.c.day < day).order_by(table.c.day.desc()).limit(1)
+        ).scalar()
+        value = {
+            'user_id': user_id,
+            'asset_id': asset_id,
+            'day': day,
+            'delta': delta,
+            'balance': Decimal(str(opening or 0)) + delta,
+            'tx_count': tx_count,
+            'created_at': now,
+            'updated_at': now,
+        }
+
+        dialect = connection.dialect.name
+        if dialect in ('postgresql', 'sqlite'):
+            insert = postgresql.insert if dialect == 'postgresql' else sqlite.insert
+            stmt = insert(table).values(**value)
+            stmt = stmt.on_conflict_do_update(
+                index_elements=[table.c.user_id, table.c.asset_id, table.c.day],
+                set_={
+                    'delta': table.c.delta + stmt.excluded.delta,
+                    'balance': table.c.balance + stmt.excluded.delta,
+                    'tx_count': table.c.tx_count + stmt.excluded.tx_count,
+                    'updated_at': stmt.excluded.updated_at,
+                }
+            )
+            connection.execute(stmt)
+        else:
+            result = connection.execute(
+                table.update().where(key_filter, table.c.day == day).values(
+                    delta=table.c.delta + delta,
+                    balance=table.c.balance + delta,
+                    tx_count=table.c.tx_count + tx_count,
+                    updated_at=now
+                )
+            )
+            if result.rowcount == 0:
+                connection.execute(table.insert().values(**value))
+
+    @staticmethod
+    def rebuild(user_id: Optional[int] = None) -> int:
+        """
+        Recompute the ledger from the transactions table (for one user or everyone)
+        with one grouped query, returns the number of daily rows written
+        """
+        signed_amount = case(
+            (Transaction.tx_type.in_(BALANCE_INFLOWS), Transaction.amount),
+            else_=-Transaction.amount
+        )
+        day = func.date(Transaction.timestamp)
+        query = db.session.query(
+            Transaction.user_id,
+            Transaction.asset_id,
+            day.label('day'),
+            func.sum(signed_amount).label('delta'),
+            func.count(Transaction.id).label('tx_count')
+        ).filter(
+            Transaction.tx_type.in_(BALANCE_INFLOWS | BALANCE_OUTFLOWS),
+            Transaction.deleted_at.is_(None),
+            or_(Transaction.status.is_(None), Transaction.status != TransactionStatus.PENDING)
+        )
+        if user_id is not None:
+            query = query.filter(Transaction.user_id == user_id)
+        rows = query.group_by(
+            Transaction.user_id, Transaction.asset_id, day
+        ).order_by(
+            Transaction.user_id, Transaction.asset_id, day
+        ).all()
+
+        ledger = []
+        running = defaultdict(Decimal)
+        now = datetime.utcnow()
+        for row in rows:
+            # func.date returns a string on SQLite
+            row_day = row.day if not isinstance(row.day, str) else datetime.strptime(row.day, '%Y-%m-%d').date()
+            delta = Decimal(str(row.delta))
+            running[(row.user_id, row.asset_id)] += delta
+            ledger.append({
+                'user_id': row.user_id,
+                'asset_id': row.asset_id,
+                'day': row_day,
+                'delta': delta,
+                'balance': running[(row.user_id, row.asset_id)],
+                'tx_count': row.tx_count,
+                'created_at': now,
+                'updated_at': now,
+            })
+
+        delete = DailyBalance.query
+        if user_id is not None:
+            delete = delete.filter(DailyBalance.user_id == user_id)
+        delete.delete(synchronize_session=False)
+        if ledger:
+            db.session.bulk_insert_mappings(DailyBalance, ledger)
+        db.session.commit()
+        return len(ledger)
+
+    @staticmethod
+    def get_balance_changes(user_id: int, start_day: date, end_day: Optional[date] = None) -> Dict[int, List[Tuple[date, Decimal]]]:
+        """
+        Closing balances per asset for every day with activity between start_day and
+        end_day, led by the last row before start_day as the opening balance, in one
+        query. Returns {asset_id: [(day, balance), ...]} ordered by day.
+        """
+        opening = select(
+            DailyBalance.asset_id,
+            func.max(DailyBalance.day).label('day')
+        ).where(
+            DailyBalance.user_id == user_id,
+            DailyBalance.day < start_day
+        ).group_by(DailyBalance.asset_id).subquery()
+
+        query = db.session.query(
+            DailyBalance.asset_id,
+            DailyBalance.day,
+            DailyBalance.balance
+        ).outerjoin(
+            opening,
+            and_(opening.c.asset_id == DailyBalance.asset_id, opening.c.day == DailyBalance.day)
+        ).filter(
+            DailyBalance.user_id == user_id,
+            or_(DailyBalance.day >= start_day, opening.c.day.isnot(None))
+        )
+        if end_day is not None:
+            query = query.filter(DailyBalance.day <= end_day)
+
+        changes = defaultdict(list)
+        for row in query.order_by(DailyBalance.asset_id, DailyBalance.day):
+            changes[row.asset_id].append((row.day, Decimal(str(row.balance))))
+        return dict(changes)
+
+    @staticmethod
+    def closing_balances(changes: Dict[int, List[Tuple[date, Decimal]]], days: Sequence[date]) -> Dict[int, List[Decimal]]:
+        """
+        Merge balance changes with sorted days: the closing balance of every asset on
+        every day, carried forward from its last change. Linear in changes + days.
+        """
+        balances = {}
+        for asset_id, rows in changes.items():
+            series = []
+            position = 0
+            balance = Decimal('0')
+            for day in days:
+                while position < len(rows) and rows[position][0] <= day:
+                    balance = rows[position][1]
+                    position += 1
+                series.append(balance)
+            balances[asset_id] = series
+        return balances
+
+
+# ----- Event listeners -----
+# Transaction writes are folded into the ledger on the flush connection, so the
+# ledger commits or rolls back together with the transactions themselves.
+
+@event.listens_for(Transaction, 'after_insert')
+def record_transaction_in_ledger(mapper, connection, target):
+    delta = settled_delta(target.tx_type, target.amount, target.status, target.deleted_at)
+    if delta:
+        DailyBalanceLedger.apply(target.user_id, target.asset_id, _ledger_day(target.timestamp), delta, 1, connection)
+
+
+@event.listens_for(Transaction, 'after_update')
+def restate_transaction_in_ledger(mapper, connection, target):
+    # Confirming a pending deposit, soft-deleting or editing a transaction: take
+    # out what it contributed before and put in what it contributes now
+    if not transaction_changed_balance(target):
+        return
+    previous = previous_transaction_state(target)
+
+    old_delta = settled_delta(previous['tx_type'], previous['amount'], previous['status'], previous['deleted_at'])
+    if old_delta:
+        DailyBalanceLedger.apply(previous['user_id'], previous['asset_id'], _ledger_day(previous['timestamp']),
+                                 -old_delta, -1, connection)
+    new_delta = settled_delta(target.tx_type, target.amount, target.status, target.deleted_at)
+    if new_delta:
+        DailyBalanceLedger.apply(target.user_id, target.asset_id, _ledger_day(target.timestamp), new_delta, 1, connection)
+
+
+@event.listens_for(Transaction, 'after_delete')
+def remove_transaction_from_ledger(mapper, connection, target):
+    delta = settled_delta(target.tx_type, target.amount, target.status, target.deleted_at)
+    if delta:
+        DailyBalanceLedger.apply(target.user_id, target.asset_id, _ledger_day(target.timestamp), -delta, -1, connection)
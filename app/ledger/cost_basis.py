@@ -0,0 +1,478 @@
+# app/ledger/cost_basis.py
+from collections import defaultdict
+from datetime import datetime, timedelta
+from decimal import Decimal
+from typing import Dict, List, Optional
+from sqlalchemy import and_, event, func, literal, or_, select
+from sqlalchemy import inspect as sa_inspect
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.orm import Session
+from app.models import (CopyTradeTransaction, CostBasis, Transaction, TransactionStatus, TransactionType,
+                        BALANCE_ATTRIBUTES, previous_transaction_state)
+from app.extensions import db
+from app.pricing import RateService, RateHistoryService
+
+SPOT_BOOK = 'spot'
+COPY_BOOK = 'copy'
+
+# How each transaction type moves a position:
+# acquire/deposit add quantity at cost, dispose/withdraw/release take it out at average cost.
+# Deposits and withdrawals also count as money put in or taken out of the portfolio,
+# disposals realize profit or loss.
+FILL_KINDS = {
+    TransactionType.TRADE_BUY: 'acquire',
+    TransactionType.UNSTAKE: 'acquire',
+    TransactionType.DEPOSIT: 'deposit',
+    TransactionType.TRANSFER_IN: 'deposit',
+    TransactionType.TRADE_SELL: 'dispose',
+    TransactionType.WITHDRAW: 'withdraw',
+    TransactionType.TRANSFER_OUT: 'withdraw',
+    TransactionType.STAKE: 'release',
+    TransactionType.FEE: 'release',
+}
+ACQUISITIONS = ('acquire', 'deposit')
+
+POSITION_FIELDS = ('quantity', 'cost_basis', 'invested', 'net_deposits', 'realized_pnl')
+
+# Columns whose change alters the fill a transaction or copy-trade fill contributes
+TRANSACTION_FILL_ATTRIBUTES = BALANCE_ATTRIBUTES + (
+    'price', 'quote_asset_id', 'fiat_conversion_rate', 'fiat_conversion_asset_id'
+)
+COPY_TRADE_FILL_ATTRIBUTES = (
+    'follower_id', 'base_asset_id', 'quote_asset_id', 'trade_type', 'amount', 'price', 'pnl',
+    'status', 'transaction_timestamp', 'deleted_at'
+)
+
+
+def _empty_position() -> Dict[str, Decimal]:
+    return {field: Decimal('0') for field in POSITION_FIELDS}
+
+
+def _priced_amount(amount, price=None, quote_asset_id=None, asset_id=None,
+                   fiat_conversion_rate=None, fiat_conversion_asset_id=None):
+    """What a fill is worth, as (asset_id, amount of that asset) to be converted to the pivot"""
+    amount = Decimal(str(amount))
+    if price and quote_asset_id:
+        return quote_asset_id, amount * Decimal(str(price))
+    if fiat_conversion_rate and fiat_conversion_asset_id:
+        return fiat_conversion_asset_id, amount * Decimal(str(fiat_conversion_rate))
+    return asset_id, amount
+
+
+def transaction_fill(tx) -> Optional[Dict]:
+    """Spot-book fill for a settled Transaction (or a row with the same columns), None if it doesn't move a position"""
+    kind = FILL_KINDS.get(tx.tx_type)
+    if kind is None or tx.amount is None or tx.deleted_at is not None or tx.status == TransactionStatus.PENDING:
+        return None
+    priced_asset_id, priced_amount = _priced_amount(
+        tx.amount, tx.price, tx.quote_asset_id, tx.asset_id,
+        tx.fiat_conversion_rate, tx.fiat_conversion_asset_id
+    )
+    return {
+        'user_id': tx.user_id,
+        'asset_id': tx.asset_id,
+        'book': SPOT_BOOK,
+        'kind': kind,
+        'quantity': Decimal(str(tx.amount)),
+        'priced_asset_id': priced_asset_id,
+        'priced_amount': priced_amount,
+        'realized_pnl': None,
+        'timestamp': tx.timestamp,
+    }
+
+
+def copy_trade_fill(fill) -> Optional[Dict]:
+    """Copy-book fill for a completed CopyTradeTransaction, realizing the P&L recorded on the fill"""
+    if fill.status != 'completed' or fill.deleted_at is not None or fill.trade_type not in ('buy', 'sell'):
+        return None
+    return {
+        'user_id': fill.follower_id,
+        'asset_id': fill.base_asset_id,
+        'book': COPY_BOOK,
+        'kind': 'acquire' if fill.trade_type == 'buy' else 'dispose',
+        'quantity': Decimal(str(fill.amount)),
+        'priced_asset_id': fill.quote_asset_id,
+        'priced_amount': Decimal(str(fill.amount)) * Decimal(str(fill.price)),
+        'realized_pnl': Decimal(str(fill.pnl or 0)),
+        'timestamp': fill.transaction_timestamp,
+    }
+
+
+class CostBasisService:
+    """
+    Incremental average-cost positions and P&L per user, asset and book, updated
+    as transactions and copy-trade fills are recorded so P&L pages read
+    precomputed figures instead of aggregating the whole history. Positions are
+    valued in the pivot currency and kept as one row per day they changed, which
+    gives period figures as the difference between two rows.
+    """
+
+    @staticmethod
+    def advance(position: Dict[str, Decimal], fill: Dict, value: Decimal) -> Dict[str, Decimal]:
+        """Apply a fill worth value (in the pivot currency) to a position, returns the new position"""
+        position = dict(position)
+        quantity = fill['quantity']
+        kind = fill['kind']
+
+        if kind in ACQUISITIONS:
+            position['quantity'] += quantity
+            position['cost_basis'] += value
+            position['invested'] += value
+            if kind == 'deposit':
+                position['net_deposits'] += value
+        else:
+            # Disposals take cost out at the average; quantity the store never saw
+            # acquired (e.g. held before it existed) has no cost and realizes nothing
+            held = position['quantity']
+            removed = min(quantity, held) if held > 0 else Decimal('0')
+            removed_cost = position['cost_basis'] * removed / held if removed else Decimal('0')
+            position['quantity'] = held - removed
+            position['cost_basis'] -= removed_cost
+
+            if kind == 'dispose' and fill['realized_pnl'] is None and removed:
+                position['realized_pnl'] += value * removed / quantity - removed_cost
+            elif kind == 'withdraw':
+                position['net_deposits'] -= value
+
+        # Fills that carry their own P&L figure (copy trades) realize exactly that
+        if fill['realized_pnl'] is not None:
+            position['realized_pnl'] += fill['realized_pnl']
+        return position
+
+    @staticmethod
+    def valuation_point(timestamp: datetime) -> datetime:
+        """
+        When a fill made at timestamp is valued: the close of the day before. That
+        rate is already final when the fill is recorded and reads the same before
+        and after the day is rolled up, so recording a fill as it happens and
+        replaying it later value it alike.
+        """
+        return datetime.combine(timestamp.date() - timedelta(days=1), datetime.max.time())
+
+    @staticmethod
+    def value_fills(fills: List[Dict], now: Optional[datetime] = None) -> List[Decimal]:
+        """Worth of each fill in the pivot currency at its valuation point, in one as-of query, zero where no rate is known"""
+        pivot_id = RateService.get_pivot_asset_id()
+        if pivot_id is None or not fills:
+            return [Decimal('0')] * len(fills)
+        now = now or datetime.utcnow()
+        points = [CostBasisService.valuation_point(fill['timestamp'] or now) for fill in fills]
+        rates = RateHistoryService.get_rates_as_of(
+            {fill['priced_asset_id'] for fill in fills} | {pivot_id}, pivot_id, sorted(set(points)),
+            granularity=timedelta(days=1)
+        )
+        values = []
+        for fill, point in zip(fills, points):
+            rate = rates.get((fill['priced_asset_id'], point))
+            values.append(fill['priced_amount'] * rate if rate else Decimal('0'))
+        return values
+
+    @staticmethod
+    def pivot_rate(base_currency_id: int) -> Optional[Decimal]:
+        """Rate converting pivot-currency figures into the base currency"""
+        pivot_id = RateService.get_pivot_asset_id()
+        if pivot_id is None or pivot_id == base_currency_id:
+            return Decimal('1')
+        rate = RateService.get_rate(pivot_id, base_currency_id)
+        if rate:
+            return rate
+        inverse = RateService.get_rate(base_currency_id, pivot_id)
+        return Decimal('1') / inverse if inverse else None
+
+    @staticmethod
+    def record_fill(fill: Dict, value: Decimal, connection=None) -> bool:
+        """
+        Fold a fill worth value (see value_fills) into its position's row for the
+        fill's day. Returns False without writing when the fill lands before fills
+        the position already holds (backdated, or a deposit confirmed after later
+        activity): average cost depends on order, so only a replay can place it.
+        """
+        connection = connection if connection is not None else db.session.connection()
+        table = CostBasis.__table__
+        timestamp = fill['timestamp'] or datetime.utcnow()
+        day = timestamp.date()
+        key_filter = and_(
+            table.c.user_id == fill['user_id'],
+            table.c.book == fill['book'],
+            table.c.asset_id == fill['asset_id']
+        )
+
+        latest = connection.execute(
+            select(table.c.day, table.c.last_fill_at, *[table.c[field] for field in POSITION_FIELDS]).where(
+                key_filter
+            ).order_by(table.c.day.desc()).limit(1)
+        ).first()
+        position = _empty_position()
+        if latest is not None:
+            # Rows written before fills were timestamped can't tell, so they are replayed too
+            if latest.day > day or latest.last_fill_at is None or timestamp < latest.last_fill_at:
+                return False
+            position = {field: Decimal(str(latest._mapping[field])) for field in POSITION_FIELDS}
+
+        position = CostBasisService.advance(position, fill, value)
+
+        now = datetime.utcnow()
+        row = dict(position, user_id=fill['user_id'], asset_id=fill['asset_id'], book=fill['book'],
+                   day=day, last_fill_at=timestamp, created_at=now, updated_at=now)
+        dialect = connection.dialect.name
+        if dialect in ('postgresql', 'sqlite'):
+            insert = postgresql.insert if dialect == 'postgresql' else sqlite.insert
+            stmt = insert(table).values(**row)
+            stmt = stmt.on_conflict_do_update(
+                index_elements=[table.c.user_id, table.c.book, table.c.asset_id, table.c.day],
+                set_=dict(position, last_fill_at=timestamp, updated_at=now)
+            )
+            connection.execute(stmt)
+        else:
+            result = connection.execute(
+                table.update().where(key_filter, table.c.day == day).values(
+                    **position, last_fill_at=timestamp, updated_at=now
+                )
+            )
+            if result.rowcount == 0:
+                connection.execute(table.insert().values(**row))
+        return True
+
+    @staticmethod
+    def get_positions(user_id: int, book: str = SPOT_BOOK, since: Optional[datetime] = None) -> Dict[int, Dict[str, Decimal]]:
+        """
+        Current position per asset, in one query. With since, the period_* figures
+        hold the change in invested, net_deposits and realized_pnl since that day;
+        otherwise they equal the all-time totals.
+        """
+        def last_day(*conditions):
+            return select(
+                CostBasis.asset_id,
+                func.max(CostBasis.day).label('day')
+            ).where(
+                CostBasis.user_id == user_id,
+                CostBasis.book == book,
+                *conditions
+            ).group_by(CostBasis.asset_id).subquery()
+
+        latest = last_day()
+        opening = last_day(CostBasis.day < since.date()) if since is not None else None
+
+        query = db.session.query(
+            CostBasis,
+            latest.c.day.label('latest_day'),
+            (opening.c.day if opening is not None else literal(None)).label('opening_day')
+        ).outerjoin(
+            latest, and_(latest.c.asset_id == CostBasis.asset_id, latest.c.day == CostBasis.day)
+        )
+        found = [latest.c.day.isnot(None)]
+        if opening is not None:
+            query = query.outerjoin(
+                opening, and_(opening.c.asset_id == CostBasis.asset_id, opening.c.day == CostBasis.day)
+            )
+            found.append(opening.c.day.isnot(None))
+        query = query.filter(
+            CostBasis.user_id == user_id,
+            CostBasis.book == book,
+            or_(*found)
+        )
+
+        positions = {}
+        opening_rows = {}
+        for row, latest_day, opening_day in query:
+            figures = {field: Decimal(str(getattr(row, field))) for field in POSITION_FIELDS}
+            if latest_day is not None:
+                positions[row.asset_id] = figures
+            if opening_day is not None:
+                opening_rows[row.asset_id] = figures
+
+        for asset_id, position in positions.items():
+            opening_figures = opening_rows.get(asset_id, _empty_position())
+            for field in ('invested', 'net_deposits', 'realized_pnl'):
+                position[f'period_{field}'] = position[field] - opening_figures[field]
+        return positions
+
+    @staticmethod
+    def rebuild(user_id: Optional[int] = None) -> int:
+        """
+        Replay settled transactions and completed copy-trade fills in time order,
+        valued at their valuation point, returns the number of rows written
+        """
+        written = CostBasisService._replay(user_id)
+        db.session.commit()
+        return written
+
+    @staticmethod
+    def check(user_id: Optional[int] = None) -> List[str]:
+        """
+        Compare the stored positions with a replay of the history, which is rolled
+        back afterwards. Returns one line per row that differs, empty if they agree.
+        """
+        def snapshot():
+            # Plain rows, not entities: replayed rows may reuse the ids of the ones they replace
+            query = select(
+                CostBasis.user_id, CostBasis.book, CostBasis.asset_id, CostBasis.day,
+                *[getattr(CostBasis, field) for field in POSITION_FIELDS]
+            )
+            if user_id is not None:
+                query = query.where(CostBasis.user_id == user_id)
+            return {tuple(row[:4]): tuple(row[4:]) for row in db.session.execute(query)}
+
+        stored = snapshot()
+        savepoint = db.session.begin_nested()
+        try:
+            CostBasisService._replay(user_id)
+            replayed = snapshot()
+        finally:
+            savepoint.rollback()
+            db.session.expire_all()
+
+        problems = []
+        for key in sorted(set(stored) | set(replayed)):
+            if stored.get(key) != replayed.get(key):
+                problems.append(f'user {key[0]} {key[1]} asset {key[2]} on {key[3]}: '
+                                f'stored {stored.get(key)} != replayed {replayed.get(key)}')
+        return problems
+
+    @staticmethod
+    def _replay(user_id: Optional[int] = None) -> int:
+        """rebuild() within the current database transaction, without committing"""
+        transactions = Transaction.query.filter(
+            Transaction.tx_type.in_(list(FILL_KINDS)),
+            or_(Transaction.status.is_(None), Transaction.status != TransactionStatus.PENDING)
+        )
+        copy_fills = CopyTradeTransaction.query.filter(CopyTradeTransaction.status == 'completed')
+        if user_id is not None:
+            transactions = transactions.filter(Transaction.user_id == user_id)
+            copy_fills = copy_fills.filter(CopyTradeTransaction.follower_id == user_id)
+
+        fills = [transaction_fill(tx) for tx in transactions.order_by(Transaction.timestamp, Transaction.id)]
+        fills += [copy_trade_fill(fill) for fill in copy_fills.order_by(CopyTradeTransaction.transaction_timestamp, CopyTradeTransaction.id)]
+        fills = sorted((fill for fill in fills if fill is not None), key=lambda fill: fill['timestamp'] or datetime.min)
+
+        rows = {}
+        positions = defaultdict(_empty_position)
+        now = datetime.utcnow()
+        for fill, value in zip(fills, CostBasisService.value_fills(fills, now)):
+            timestamp = fill['timestamp'] or now
+            key = (fill['user_id'], fill['book'], fill['asset_id'])
+            positions[key] = CostBasisService.advance(positions[key], fill, value)
+            rows[key + (timestamp.date(),)] = dict(
+                positions[key], user_id=key[0], book=key[1], asset_id=key[2], day=timestamp.date(),
+                last_fill_at=timestamp, created_at=now, updated_at=now
+            )
+
+        delete = CostBasis.query
+        if user_id is not None:
+            delete = delete.filter(CostBasis.user_id == user_id)
+        delete.delete(synchronize_session=False)
+        if rows:
+            db.session.bulk_insert_mappings(CostBasis, list(rows.values()))
+        return len(rows)
+
+
+# ----- Event listeners -----
+# Fills are staged on the session as their rows are written and valued just
+# before the commit, outside the flush, when rates can be looked up (which may
+# reload the rate index). The position rows are written in the same database
+# transaction, so they commit or roll back with the fills. A fill that is taken
+# back or changed (a settled transaction soft-deleted, edited or deleted), or
+# one that lands before fills its position already holds, can't be placed at
+# average cost incrementally, so its user's positions are replayed instead.
+
+def _stage_fill(target, fill):
+    session = Session.object_session(target)
+    if fill is not None and session is not None:
+        session.info.setdefault('pending_cost_fills', []).append(fill)
+
+
+def _stage_rebuild(target, *user_ids):
+    session = Session.object_session(target)
+    if session is not None:
+        session.info.setdefault('cost_basis_rebuild_users', set()).update(user_ids)
+
+
+def _changed(target, attributes):
+    state = sa_inspect(target)
+    return any(state.attrs[name].history.has_changes() for name in attributes)
+
+
+@event.listens_for(Transaction, 'after_insert')
+def stage_transaction_fill(mapper, connection, target):
+    _stage_fill(target, transaction_fill(target))
+
+
+@event.listens_for(Transaction, 'after_update')
+def stage_changed_transaction_fill(mapper, connection, target):
+    if not _changed(target, TRANSACTION_FILL_ATTRIBUTES):
+        return
+    previous = previous_transaction_state(target)
+    counted = (previous['tx_type'] in FILL_KINDS and previous['amount'] is not None and
+               previous['deleted_at'] is None and previous['status'] != TransactionStatus.PENDING)
+    if counted:
+        _stage_rebuild(target, previous['user_id'], target.user_id)
+    else:
+        # A pending transaction (deposit) being confirmed only adds its fill
+        _stage_fill(target, transaction_fill(target))
+
+
+@event.listens_for(Transaction, 'after_delete')
+def stage_deleted_transaction_fill(mapper, connection, target):
+    if transaction_fill(target) is not None:
+        _stage_rebuild(target, target.user_id)
+
+
+def _load_previous_status(target, value, oldvalue, initiator):
+    return value
+
+
+# Load the old status before it is overwritten, even on an expired instance,
+# so a fill is only recorded when it completes
+event.listen(CopyTradeTransaction.status, 'set', _load_previous_status, active_history=True, retval=True)
+
+
+@event.listens_for(CopyTradeTransaction, 'after_insert')
+def stage_copy_trade_fill(mapper, connection, target):
+    _stage_fill(target, copy_trade_fill(target))
+
+
+@event.listens_for(CopyTradeTransaction, 'after_update')
+def stage_changed_copy_trade_fill(mapper, connection, target):
+    if not _changed(target, COPY_TRADE_FILL_ATTRIBUTES):
+        return
+    history = sa_inspect(target).attrs.status.history
+    previous_status = history.deleted[0] if history.deleted else target.status
+    if previous_status == 'completed':
+        follower_history = sa_inspect(target).attrs.follower_id.history
+        previous_follower = follower_history.deleted[0] if follower_history.deleted else target.follower_id
+        _stage_rebuild(target, previous_follower, target.follower_id)
+    else:
+        _stage_fill(target, copy_trade_fill(target))
+
+
+@event.listens_for(CopyTradeTransaction, 'after_delete')
+def stage_deleted_copy_trade_fill(mapper, connection, target):
+    if copy_trade_fill(target) is not None:
+        _stage_rebuild(target, target.follower_id)
+
+
+@event.listens_for(Session, 'before_commit')
+def record_fills_before_commit(session):
+    # The commit's own final flush runs after this hook, so flush here to stage its fills
+    session.flush()
+    rebuild_users = session.info.pop('cost_basis_rebuild_users', set())
+    # A replayed user's positions already include the fills of this transaction
+    fills = [fill for fill in session.info.pop('pending_cost_fills', []) if fill['user_id'] not in rebuild_users]
+    if fills:
+        # In time order, as a replay folds them
+        now = datetime.utcnow()
+        fills.sort(key=lambda fill: fill['timestamp'] or now)
+        connection = session.connection()
+        for fill, value in zip(fills, CostBasisService.value_fills(fills, now)):
+            if fill['user_id'] in rebuild_users:
+                continue
+            if not CostBasisService.record_fill(fill, value, connection=connection):
+                rebuild_users.add(fill['user_id'])
+    for user_id in rebuild_users:
+        CostBasisService._replay(user_id)
+
+
+@event.listens_for(Session, 'after_rollback')
+def discard_fills_after_rollback(session):
+    session.info.pop('pending_cost_fills', None)
+    session.info.pop('cost_basis_rebuild_users', None)
@@ -1,4 +1,5 @@
 from datetime import datetime, timedelta
+from decimal import Decimal
 from enum import Enum
 import requests
 import secrets
@@ -7,7 +8,8 @@ import qrcode
 import io
 import base64
 from sqlalchemy import Enum as SQLAlchemyEnum, CheckConstraint
-from sqlalchemy import orm, event
+from sqlalchemy import orm, event, func, and_, select, tuple_
+from sqlalchemy.dialects import postgresql, sqlite
 from flask_login import UserMixin
 from .extensions import db, cache
 from werkzeug.security import generate_password_hash, check_password_hash
@@ -80,6 +82,14 @@ class TransactionType(Enum):
     TRANSFER_IN = 'transfer_in'    # Receiving a transfer
     TRANSFER_OUT = 'transfer_out'  # Sending a transfer
 
+# Transaction.source of trade rows that are not swaps, so swap history can leave them out
+TRANSACTION_SOURCE_ORDER_BOOK = 'order_book'  # Limit order fills
+TRANSACTION_SOURCE_CONVERSION = 'conversion'  # WalletService.transfer asset conversions
+TRANSACTION_SOURCES = (TRANSACTION_SOURCE_ORDER_BOOK, TRANSACTION_SOURCE_CONVERSION)
+# Swap rows, spelled out with literals: a partial index is only used for queries
+# whose WHERE clause provably implies its own, which bound parameters never do
+SWAP_ROWS_CONDITION = "tx_type IN ('TRADE_BUY', 'TRADE_SELL') AND source IS NULL"
+
 class TransactionStatus(Enum):
     PENDING = 'pending'
     SUCCESS = 'success'
@@ -373,6 +383,8 @@ class Transaction(db.Model, TimestampMixin, SoftDeleteMixin):
     external_tx_id = db.Column(db.String(255), nullable=True, index=True)  # For blockchain txs
     notes = db.Column(db.Text, nullable=True)
     status = db.Column(SQLAlchemyEnum(TransactionStatus), nullable=True)
+    # What wrote a trade row other than a swap (see TRANSACTION_SOURCES), None for swaps
+    source = db.Column(db.String(20), nullable=True)
 
     # Relationships
     user = db.relationship('User', back_populates='transactions')
@@ -384,6 +396,9 @@ class Transaction(db.Model, TimestampMixin, SoftDeleteMixin):
     __table_args__ = (
         CheckConstraint('amount > 0', name='ck_transaction_amount_positive'),
         CheckConstraint('fee_amount >= 0', name='ck_fee_amount_non_negative'),
+        # Keyset pagination of a user's swap history on (timestamp, id), over swap rows only
+        db.Index('idx_transaction_swaps_user_timestamp_id', 'user_id', 'timestamp', 'id',
+                 postgresql_where=db.text(SWAP_ROWS_CONDITION), sqlite_where=db.text(SWAP_ROWS_CONDITION)),
     )
 
     def __repr__(self):
@@ -393,6 +408,56 @@ class Transaction(db.Model, TimestampMixin, SoftDeleteMixin):
                 f"{self.asset.symbol}{price_info}{conversion_info} @ {self.timestamp}>")
 
 
+class DailyBalance(db.Model, TimestampMixin):
+    """Per user, asset and day: net settled transaction flow and the closing running balance"""
+    __tablename__ = 'daily_balances'
+    id = db.Column(db.Integer, primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('users.id'), nullable=False)
+    asset_id = db.Column(db.Integer, db.ForeignKey('assets.id'), nullable=False)
+    day = db.Column(db.Date, nullable=False)
+    delta = db.Column(db.Numeric(30, 18), nullable=False, default=0)  # Net change on this day
+    balance = db.Column(db.Numeric(30, 18), nullable=False, default=0)  # Balance at end of day
+    tx_count = db.Column(db.Integer, nullable=False, default=0)
+
+    asset = db.relationship('Asset', foreign_keys=[asset_id])
+
+    __table_args__ = (
+        db.UniqueConstraint('user_id', 'asset_id', 'day', name='uq_daily_balance_user_asset_day'),
+    )
+
+    def __repr__(self):
+        return f"<DailyBalance {self.user_id}:{self.asset_id} {self.day} {self.delta:+} -> {self.balance}>"
+
+
+class CostBasis(db.Model, TimestampMixin):
+    """
+    Running average-cost position per user, asset and book ('spot' holdings or
+    'copy' trading fills), as it stood at the end of each day it changed.
+    Money columns are in the pivot currency (USD).
+    """
+    __tablename__ = 'cost_basis'
+    id = db.Column(db.Integer, primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('users.id'), nullable=False)
+    asset_id = db.Column(db.Integer, db.ForeignKey('assets.id'), nullable=False)
+    book = db.Column(db.String(10), nullable=False, default='spot')
+    day = db.Column(db.Date, nullable=False)
+    quantity = db.Column(db.Numeric(30, 18), nullable=False, default=0)
+    cost_basis = db.Column(db.Numeric(30, 18), nullable=False, default=0)  # Cost of the quantity still held
+    invested = db.Column(db.Numeric(30, 18), nullable=False, default=0)  # Cumulative acquisition cost
+    net_deposits = db.Column(db.Numeric(30, 18), nullable=False, default=0)  # Cumulative deposits less withdrawals
+    realized_pnl = db.Column(db.Numeric(30, 18), nullable=False, default=0)  # Cumulative realized profit/loss
+    last_fill_at = db.Column(db.DateTime, nullable=True)  # Timestamp of the latest fill folded into the row
+
+    asset = db.relationship('Asset', foreign_keys=[asset_id])
+
+    __table_args__ = (
+        db.UniqueConstraint('user_id', 'book', 'asset_id', 'day', name='uq_cost_basis_user_book_asset_day'),
+    )
+
+    def __repr__(self):
+        return f"<CostBasis {self.user_id}:{self.asset_id} {self.book} {self.day} {self.quantity} @ {self.cost_basis}>"
+
+
 class ExchangeRate(db.Model, TimestampMixin, SoftDeleteMixin):
     __tablename__ = 'exchange_rates'
     id = db.Column(db.Integer, primary_key=True)
@@ -413,6 +478,50 @@ class ExchangeRate(db.Model, TimestampMixin, SoftDeleteMixin):
         return f"<ExchangeRate {self.base_asset.symbol}/{self.quote_asset.symbol}={self.rate} @ {self.timestamp}>"
 
 
+class LatestExchangeRate(db.Model, TimestampMixin):
+    """Current rate per pair, upserted alongside every exchange_rates insert"""
+    __tablename__ = 'latest_exchange_rates'
+    base_asset_id = db.Column(db.Integer, db.ForeignKey('assets.id'), primary_key=True)
+    quote_asset_id = db.Column(db.Integer, db.ForeignKey('assets.id'), primary_key=True)
+    rate = db.Column(db.Numeric(30, 18), nullable=False)
+    timestamp = db.Column(db.DateTime, nullable=False)
+    source = db.Column(db.String(50), nullable=True)
+
+    base_asset = db.relationship('Asset', foreign_keys=[base_asset_id])
+    quote_asset = db.relationship('Asset', foreign_keys=[quote_asset_id])
+
+    def __repr__(self):
+        return f"<LatestExchangeRate {self.base_asset.symbol}/{self.quote_asset.symbol}={self.rate} @ {self.timestamp}>"
+
+
+class ExchangeRateBucket(db.Model, TimestampMixin):
+    """OHLC rollup of exchange_rates per pair at 5-minute, hourly or daily resolution"""
+    __tablename__ = 'exchange_rate_buckets'
+    id = db.Column(db.Integer, primary_key=True)
+    base_asset_id = db.Column(db.Integer, db.ForeignKey('assets.id'), nullable=False)
+    quote_asset_id = db.Column(db.Integer, db.ForeignKey('assets.id'), nullable=False)
+    resolution = db.Column(db.String(4), nullable=False)  # '5m', '1h' or '1d'
+    bucket_start = db.Column(db.DateTime, nullable=False)
+    open = db.Column(db.Numeric(30, 18), nullable=False)
+    high = db.Column(db.Numeric(30, 18), nullable=False)
+    low = db.Column(db.Numeric(30, 18), nullable=False)
+    close = db.Column(db.Numeric(30, 18), nullable=False)
+    close_timestamp = db.Column(db.DateTime, nullable=False)  # Timestamp of the raw rate used as close
+    sample_count = db.Column(db.Integer, nullable=False, default=0)
+
+    base_asset = db.relationship('Asset', foreign_keys=[base_asset_id])
+    quote_asset = db.relationship('Asset', foreign_keys=[quote_asset_id])
+
+    __table_args__ = (
+        db.UniqueConstraint('resolution', 'base_asset_id', 'quote_asset_id', 'bucket_start', name='uq_rate_bucket'),
+        db.Index('idx_rate_bucket_quote_start', 'resolution', 'quote_asset_id', 'bucket_start'),
+    )
+
+    def __repr__(self):
+        return (f"<ExchangeRateBucket {self.resolution} {self.base_asset.symbol}/{self.quote_asset.symbol} "
+                f"@ {self.bucket_start} O={self.open} H={self.high} L={self.low} C={self.close}>")
+
+
 class DepositAddress(db.Model, TimestampMixin, SoftDeleteMixin): # TODO: Delete
     __tablename__ = 'deposit_addresses'
 
@@ -479,7 +588,7 @@ class OrderBook(db.Model, TimestampMixin, SoftDeleteMixin):
     side = db.Column(db.String(4))  # buy/sell
     amount = db.Column(db.Numeric(30, 18))
     price = db.Column(db.Numeric(30, 18))
-    status = db.Column(db.String(20), default='open')  # open/filled/cancelled
+    status = db.Column(db.String(20), default='open')  # pending/open/filled/cancelled/rejected
 
     # Relationships
     user = db.relationship('User', backref='limit_orders')
@@ -487,8 +596,16 @@ class OrderBook(db.Model, TimestampMixin, SoftDeleteMixin):
     quote_asset = db.relationship('Asset', foreign_keys=[quote_asset_id])
 
     __table_args__ = (
-        db.Index('idx_order_book_assets', 'base_asset_id', 'quote_asset_id'),
-        db.Index('idx_order_book_status', 'status'),
+        # Local depth: GROUP BY side, price over a pair's open orders
+        db.Index('idx_order_book_pair_side_status_price', 'base_asset_id', 'quote_asset_id', 'side', 'status', 'price'),
+        # Partial indexes over the few live rows rather than the whole order history:
+        # loading a pair's open orders in time order (covering on PostgreSQL) and its newest open id
+        db.Index('idx_order_book_open_pair_id', 'base_asset_id', 'quote_asset_id', 'id',
+                 postgresql_where=db.text("status = 'open'"), sqlite_where=db.text("status = 'open'"),
+                 postgresql_include=['user_id', 'side', 'price', 'amount']),
+        # The batch matcher's queue, oldest first
+        db.Index('idx_order_book_pending', 'id',
+                 postgresql_where=db.text("status = 'pending'"), sqlite_where=db.text("status = 'pending'")),
     )
 
     def __repr__(self):
@@ -872,16 +989,183 @@ class MiningPoolStats(db.Model, TimestampMixin):
 
 
 # ----- Event listeners -----
+# Holdings are a projection of settled transactions: every Transaction insert,
+# update or delete stages its balance change, and once the flush is done the
+# changes are applied with atomic UPDATE ... SET balance = balance + :delta
+# statements on the same connection, so balances commit or roll back together
+# with the transactions that moved them.
+
+# Which way each transaction type moves the holding of its asset
+BALANCE_INFLOWS = frozenset({
+    TransactionType.DEPOSIT,
+    TransactionType.TRADE_BUY,
+    TransactionType.TRANSFER_IN,
+    TransactionType.UNSTAKE,
+})
+BALANCE_OUTFLOWS = frozenset({
+    TransactionType.WITHDRAW,
+    TransactionType.TRADE_SELL,
+    TransactionType.TRANSFER_OUT,
+    TransactionType.STAKE,
+    TransactionType.FEE,
+})
+
+# Transaction columns whose change can move a balance
+BALANCE_ATTRIBUTES = ('user_id', 'asset_id', 'tx_type', 'amount', 'status', 'timestamp', 'deleted_at')
+
+
+def settled_delta(tx_type, amount, status=None, deleted_at=None) -> Decimal:
+    """
+    Signed change a transaction makes to its holding. Pending and soft-deleted
+    transactions don't move balances, so they count as zero.
+    """
+    if amount is None or deleted_at is not None or status == TransactionStatus.PENDING:
+        return Decimal('0')
+    amount = Decimal(str(amount))
+    if tx_type in BALANCE_INFLOWS:
+        return amount
+    if tx_type in BALANCE_OUTFLOWS:
+        return -amount
+    return Decimal('0')
+
+
+def previous_transaction_state(target):
+    """Balance-relevant column values of a transaction as they were before the pending update"""
+    state = orm.attributes.instance_state(target)
+    previous = {}
+    for name in BALANCE_ATTRIBUTES:
+        history = state.attrs[name].history
+        previous[name] = history.deleted[0] if history.deleted else getattr(target, name)
+    return previous
+
+
+def transaction_changed_balance(target):
+    state = orm.attributes.instance_state(target)
+    return any(state.attrs[name].history.has_changes() for name in BALANCE_ATTRIBUTES)
+
+
+def _load_previous_value(target, value, oldvalue, initiator):
+    return value
+
+
+# Load the old value before a balance-relevant attribute is overwritten, even on
+# an expired instance, so updates can take the previous change back out
+for _name in BALANCE_ATTRIBUTES:
+    event.listen(getattr(Transaction, _name), 'set', _load_previous_value, active_history=True, retval=True)
+
+
+class InsufficientBalanceError(ValueError):
+    """A debit would take a holding below zero"""
+
+
+def apply_balance_changes(connection, changes):
+    """
+    Apply {(user_id, asset_id): delta} to holdings. Every touched holding is
+    locked up front in id order (SELECT ... FOR UPDATE where supported), so
+    concurrent transfers between the same users can't deadlock. Credits create
+    the holding if needed, as an upsert so two concurrent first credits can't
+    collide on uq_user_asset; debits are conditional on the balance covering
+    them and raise InsufficientBalanceError instead of overdrawing.
+    """
+    changes = {key: delta for key, delta in changes.items() if delta}
+    if not changes:
+        return
+
+    holdings = Holding.__table__
+    keys = sorted(changes)
+    connection.execute(
+        select(holdings.c.id).where(
+            tuple_(holdings.c.user_id, holdings.c.asset_id).in_(keys)
+        ).order_by(holdings.c.id).with_for_update()
+    ).all()
+
+    now = datetime.utcnow()
+    dialect = connection.dialect.name
+    for user_id, asset_id in keys:
+        delta = changes[(user_id, asset_id)]
+        if delta > 0 and dialect in ('postgresql', 'sqlite'):
+            insert = postgresql.insert if dialect == 'postgresql' else sqlite.insert
+            stmt = insert(holdings).values(
+                user_id=user_id,
+                asset_id=asset_id,
+                balance=delta,
+                created_at=now,
+                updated_at=now
+            )
+            stmt = stmt.on_conflict_do_update(
+                index_elements=[holdings.c.user_id, holdings.c.asset_id],
+                set_={
+                    'balance': func.coalesce(holdings.c.balance, 0) + stmt.excluded.balance,
+                    'updated_at': stmt.excluded.updated_at,
+                }
+            )
+            connection.execute(stmt)
+            continue
+
+        key_filter = and_(holdings.c.user_id == user_id, holdings.c.asset_id == asset_id)
+        if delta < 0:
+            key_filter = and_(key_filter, holdings.c.balance >= -delta)
+        result = connection.execute(
+            holdings.update().where(key_filter).values(
+                balance=func.coalesce(holdings.c.balance, 0) + delta,
+                updated_at=now
+            )
+        )
+        if result.rowcount:
+            continue
+        if delta < 0:
+            raise InsufficientBalanceError("Insufficient balance")
+        connection.execute(
+            holdings.insert().values(
+                user_id=user_id,
+                asset_id=asset_id,
+                balance=delta,
+                created_at=now,
+                updated_at=now
+            )
+        )
+
+
+def _stage_balance_change(target, user_id, asset_id, delta):
+    session = orm.object_session(target)
+    if session is not None and delta:
+        changes = session.info.setdefault('pending_balance_changes', {})
+        changes[(user_id, asset_id)] = changes.get((user_id, asset_id), Decimal('0')) + delta
+
 
 @event.listens_for(Transaction, 'after_insert')
 def update_holding_after_transaction(mapper, connection, target):
     """Update holdings after transaction is added"""
-    # Implementation would adjust the user's holding based on transaction type
-    pass
+    delta = settled_delta(target.tx_type, target.amount, target.status, target.deleted_at)
+    _stage_balance_change(target, target.user_id, target.asset_id, delta)
+
+
+@event.listens_for(Transaction, 'after_update')
+def update_holding_after_transaction_update(mapper, connection, target):
+    """Update holdings after a transaction is confirmed, soft-deleted or edited"""
+    if not transaction_changed_balance(target):
+        return
+    previous = previous_transaction_state(target)
+    old_delta = settled_delta(previous['tx_type'], previous['amount'], previous['status'], previous['deleted_at'])
+    _stage_balance_change(target, previous['user_id'], previous['asset_id'], -old_delta)
+    new_delta = settled_delta(target.tx_type, target.amount, target.status, target.deleted_at)
+    _stage_balance_change(target, target.user_id, target.asset_id, new_delta)
 
 
 @event.listens_for(Transaction, 'after_delete')
 def update_holding_after_transaction_delete(mapper, connection, target):
     """Update holdings after transaction is deleted"""
-    # Implementation would adjust the user's holding based on the removed transaction
-    pass
\ No newline at end of file
+    delta = settled_delta(target.tx_type, target.amount, target.status, target.deleted_at)
+    _stage_balance_change(target, target.user_id, target.asset_id, -delta)
+
+
+@event.listens_for(orm.Session, 'after_flush')
+def apply_balance_changes_after_flush(session, flush_context):
+    changes = session.info.pop('pending_balance_changes', None)
+    if changes:
+        apply_balance_changes(session.connection(), changes)
+
+
+@event.listens_for(orm.Session, 'after_rollback')
+def discard_balance_changes_after_rollback(session):
+    session.info.pop('pending_balance_changes', None)
@@ -0,0 +1,4 @@
+# app/pricing/__init__.py
+
+from .rates import RateService, RateEntry, latest_rate_index
+from .history import RateHistoryService
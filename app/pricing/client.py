@@ -0,0 +1,257 @@
+# app/pricing/client.py
+import asyncio
+import threading
+import time
+from typing import Dict, Iterable, Optional, Tuple
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from flask import current_app, has_app_context
+from .singleflight import SingleFlight
+
+DEFAULT_API_URL = "https://api.coingecko.com/api/v3"
+
+
+class RateLimitExceeded(requests.RequestException):
+    """A request would have to wait longer than its caller allows for a token"""
+
+
+class TokenBucket:
+    """
+    Thread-safe token bucket. Callers reserve a token and get back how long to wait
+    for it, so the sync client can sleep and the async client can await.
+    """
+
+    def __init__(self, rate: float, capacity: int):
+        self.rate = rate
+        self.capacity = capacity
+        self._tokens = float(capacity)
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def reserve(self, max_wait: Optional[float] = None) -> float:
+        """
+        Take a token, returns the seconds to wait before it may be used. With
+        max_wait, raises RateLimitExceeded instead of taking a token that is
+        further away, so the backlog never grows on behalf of such callers.
+        """
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+            self._updated = now
+            delay = max(0.0, 1 - self._tokens) / self.rate
+            if max_wait is not None and delay > max_wait:
+                raise RateLimitExceeded(f"Rate limited, next token in {delay:.1f}s")
+            self._tokens -= 1
+            return delay
+
+    def acquire(self, max_wait: Optional[float] = None):
+        delay = self.reserve(max_wait)
+        if delay > 0:
+            time.sleep(delay)
+
+
+def _request_key(path: str, params: Optional[Dict]) -> Tuple:
+    return (path, tuple(sorted((params or {}).items())))
+
+
+def _client_settings(config) -> Dict:
+    return {
+        'base_url': config.get('COINGECKO_API_URL', DEFAULT_API_URL),
+        'api_key': config.get('COINGECKO_API_KEY'),
+        'rate_limit': config.get('COINGECKO_RATE_LIMIT', 0.5),
+        'burst': config.get('COINGECKO_RATE_BURST', 5),
+        'timeout': config.get('COINGECKO_TIMEOUT', 10),
+        'pool_size': config.get('COINGECKO_POOL_SIZE', 10),
+    }
+
+
+class CoinGeckoClient:
+    """
+    Shared CoinGecko client: one pooled keep-alive session with retries on 429/5xx,
+    a token-bucket rate limit across all threads, and coalescing of identical
+    in-flight requests so concurrent callers share a single response.
+
+    Background callers wait for their token and honor Retry-After. Callers inside a
+    web request pass max_wait: they get RateLimitExceeded rather than a longer wait,
+    and a 429 fails at once instead of sleeping through Retry-After.
+    """
+
+    def __init__(self, base_url: str = DEFAULT_API_URL, api_key: Optional[str] = None,
+                 rate_limit: float = 0.5, burst: int = 5, timeout: float = 10, pool_size: int = 10):
+        self.base_url = base_url.rstrip('/')
+        self.api_key = api_key
+        self.timeout = timeout
+        self.bucket = TokenBucket(rate_limit, burst)
+        self.session = requests.Session()
+        retries = Retry(
+            total=3,
+            backoff_factor=0.5,
+            status_forcelist=(429, 500, 502, 503, 504),
+            allowed_methods=frozenset(['GET']),
+            respect_retry_after_header=True
+        )
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=retries)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        # Same pooling, but only 5xx are retried and never after a Retry-After sleep
+        self.fail_fast_session = requests.Session()
+        fail_fast_retries = Retry(
+            total=1,
+            backoff_factor=0.1,
+            status_forcelist=(500, 502, 503, 504),
+            allowed_methods=frozenset(['GET']),
+            respect_retry_after_header=False
+        )
+        fail_fast_adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size,
+                                        max_retries=fail_fast_retries)
+        self.fail_fast_session.mount('http://', fail_fast_adapter)
+        self.fail_fast_session.mount('https://', fail_fast_adapter)
+        self._flights = SingleFlight()
+
+    @classmethod
+    def from_config(cls, config) -> 'CoinGeckoClient':
+        return cls(**_client_settings(config))
+
+    def _params(self, params: Optional[Dict]) -> Dict:
+        params = dict(params or {})
+        if self.api_key:
+            params['x_cg_pro_api_key'] = self.api_key
+        return params
+
+    def _fetch(self, path: str, params: Optional[Dict], max_wait: Optional[float]):
+        self.bucket.acquire(max_wait)
+        session = self.session if max_wait is None else self.fail_fast_session
+        response = session.get(f"{self.base_url}{path}", params=self._params(params), timeout=self.timeout)
+        response.raise_for_status()
+        return response.json()
+
+    def get(self, path: str, params: Optional[Dict] = None, max_wait: Optional[float] = None):
+        """
+        GET a JSON endpoint, joining an identical request if one is already in flight.
+        Fail-fast callers (max_wait set) only join each other, never a background
+        request that may be waiting out a rate limit.
+        """
+        key = _request_key(path, params) + (max_wait is not None,)
+        result, _ = self._flights.do(key, lambda: self._fetch(path, params, max_wait))
+        return result
+
+    @property
+    def stats(self) -> Dict[str, int]:
+        return self._flights.stats()
+
+    def simple_price(self, ids: Iterable[str], vs_currencies: Iterable[str],
+                     max_wait: Optional[float] = None, **extra) -> Dict:
+        """/simple/price for the given coin ids and quote currencies"""
+        params = {'ids': ','.join(ids), 'vs_currencies': ','.join(vs_currencies)}
+        params.update(extra)
+        return self.get('/simple/price', params, max_wait)
+
+    def close(self):
+        self.session.close()
+        self.fail_fast_session.close()
+
+
+class AsyncCoinGeckoClient:
+    """
+    asyncio/aiohttp flavour of CoinGeckoClient for workers that fan out many
+    requests. Shares the same rate limit semantics and coalesces identical requests
+    onto one future. Must be used from a single event loop.
+    """
+
+    def __init__(self, base_url: str = DEFAULT_API_URL, api_key: Optional[str] = None,
+                 rate_limit: float = 0.5, burst: int = 5, timeout: float = 10, pool_size: int = 10):
+        self.base_url = base_url.rstrip('/')
+        self.api_key = api_key
+        self.timeout = timeout
+        self.pool_size = pool_size
+        self.bucket = TokenBucket(rate_limit, burst)
+        self._session = None
+        self._inflight: Dict[Tuple, asyncio.Future] = {}
+        self.stats = {'issued': 0, 'coalesced': 0}
+
+    @classmethod
+    def from_config(cls, config) -> 'AsyncCoinGeckoClient':
+        return cls(**_client_settings(config))
+
+    async def _get_session(self):
+        if self._session is None or self._session.closed:
+            import aiohttp
+            self._session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(limit=self.pool_size),
+                timeout=aiohttp.ClientTimeout(total=self.timeout)
+            )
+        return self._session
+
+    async def _fetch(self, path: str, params: Optional[Dict]):
+        delay = self.bucket.reserve()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        params = {k: str(v) for k, v in (params or {}).items()}
+        if self.api_key:
+            params['x_cg_pro_api_key'] = self.api_key
+        session = await self._get_session()
+        async with session.get(f"{self.base_url}{path}", params=params) as response:
+            response.raise_for_status()
+            return await response.json()
+
+    async def get(self, path: str, params: Optional[Dict] = None):
+        key = _request_key(path, params)
+        future = self._inflight.get(key)
+        if future is not None:
+            self.stats['coalesced'] += 1
+            return await asyncio.shield(future)
+
+        self.stats['issued'] += 1
+        future = asyncio.get_running_loop().create_future()
+        self._inflight[key] = future
+        try:
+            result = await self._fetch(path, params)
+            future.set_result(result)
+            return result
+        except BaseException as e:
+            future.set_exception(e)
+            # Mark retrieved so a failure nobody else awaited isn't logged as unhandled
+            future.exception()
+            raise
+        finally:
+            self._inflight.pop(key, None)
+
+    async def simple_price(self, ids: Iterable[str], vs_currencies: Iterable[str], **extra) -> Dict:
+        params = {'ids': ','.join(ids), 'vs_currencies': ','.join(vs_currencies)}
+        params.update(extra)
+        return await self.get('/simple/price', params)
+
+    async def close(self):
+        if self._session is not None:
+            await self._session.close()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.close()
+
+
+_client: Optional[CoinGeckoClient] = None
+_client_lock = threading.Lock()
+
+
+def get_coingecko_client() -> CoinGeckoClient:
+    """Process-wide client, configured from the app config on first use"""
+    global _client
+    if _client is None:
+        with _client_lock:
+            if _client is None:
+                config = current_app.config if has_app_context() else {}
+                _client = CoinGeckoClient.from_config(config)
+    return _client
+
+
+def reset_coingecko_client():
+    """Drop the shared client, e.g. after changing COINGECKO_* settings"""
+    global _client
+    with _client_lock:
+        if _client is not None:
+            _client.close()
+        _client = None
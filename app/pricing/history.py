@@ -0,0 +1,343 @@
+# app/pricing/history.py
+from datetime import datetime, timedelta
+from decimal import Decimal
+from typing import Dict, Iterable, List, Optional, Tuple
+from flask import current_app, has_app_context
+from sqlalchemy import DateTime, Integer, and_, func, literal, or_, select, true, union_all
+from app.models import ExchangeRate, ExchangeRateBucket
+from app.extensions import db
+from .rates import RateService
+
+# Bucket widths, finest first. Each level is rolled up from the one before it.
+RESOLUTIONS = (
+    ('5m', timedelta(minutes=5)),
+    ('1h', timedelta(hours=1)),
+    ('1d', timedelta(days=1)),
+)
+RESOLUTION_WIDTHS = dict(RESOLUTIONS)
+
+
+def bucket_start(timestamp: datetime, resolution: str) -> datetime:
+    """Floor a timestamp to the start of its bucket"""
+    if resolution == '1d':
+        return timestamp.replace(hour=0, minute=0, second=0, microsecond=0)
+    if resolution == '1h':
+        return timestamp.replace(minute=0, second=0, microsecond=0)
+    width_minutes = int(RESOLUTION_WIDTHS[resolution].total_seconds() // 60)
+    return timestamp.replace(minute=timestamp.minute - timestamp.minute % width_minutes,
+                             second=0, microsecond=0)
+
+
+class RateHistoryService:
+    """Rollup of raw exchange_rates into OHLC buckets, and as-of lookups on them"""
+
+    DEFAULT_RAW_RETENTION_DAYS = 7
+
+    @staticmethod
+    def raw_retention_days() -> int:
+        if has_app_context():
+            return current_app.config.get('RATE_RAW_RETENTION_DAYS', RateHistoryService.DEFAULT_RAW_RETENTION_DAYS)
+        return RateHistoryService.DEFAULT_RAW_RETENTION_DAYS
+
+    @staticmethod
+    def resolution_for(granularity: timedelta) -> str:
+        """The coarsest (smallest) bucket level that still resolves the given granularity"""
+        chosen = RESOLUTIONS[0][0]
+        for resolution, width in RESOLUTIONS:
+            if width <= granularity:
+                chosen = resolution
+        return chosen
+
+    @staticmethod
+    def _last_bucket_start(resolution: str) -> Optional[datetime]:
+        return db.session.query(func.max(ExchangeRateBucket.bucket_start)).filter(
+            ExchangeRateBucket.resolution == resolution
+        ).scalar()
+
+    @staticmethod
+    def _aggregate(samples: Iterable[Tuple], resolution: str) -> List[Dict]:
+        """
+        Fold time-ordered samples of (base_asset_id, quote_asset_id, start, open, high,
+        low, close, close_timestamp, sample_count) into buckets of the given resolution
+        """
+        buckets = {}
+        for base_id, quote_id, start, open_, high, low, close, close_ts, count in samples:
+            key = (base_id, quote_id, bucket_start(start, resolution))
+            bucket = buckets.get(key)
+            if bucket is None:
+                buckets[key] = {
+                    'base_asset_id': base_id,
+                    'quote_asset_id': quote_id,
+                    'resolution': resolution,
+                    'bucket_start': key[2],
+                    'open': open_,
+                    'high': high,
+                    'low': low,
+                    'close': close,
+                    'close_timestamp': close_ts,
+                    'sample_count': count,
+                }
+                continue
+            bucket['high'] = max(bucket['high'], high)
+            bucket['low'] = min(bucket['low'], low)
+            bucket['close'] = close
+            bucket['close_timestamp'] = close_ts
+            bucket['sample_count'] += count
+        return list(buckets.values())
+
+    @staticmethod
+    def _raw_samples(since: Optional[datetime]):
+        query = db.session.query(
+            ExchangeRate.base_asset_id,
+            ExchangeRate.quote_asset_id,
+            ExchangeRate.timestamp,
+            ExchangeRate.rate
+        ).filter(
+            ExchangeRate.deleted_at.is_(None)
+        )
+        if since is not None:
+            query = query.filter(ExchangeRate.timestamp >= since)
+
+        for row in query.order_by(ExchangeRate.timestamp).yield_per(5000):
+            rate = Decimal(str(row.rate))
+            yield (row.base_asset_id, row.quote_asset_id, row.timestamp,
+                   rate, rate, rate, rate, row.timestamp, 1)
+
+    @staticmethod
+    def _bucket_samples(resolution: str, since: Optional[datetime]):
+        query = db.session.query(ExchangeRateBucket).filter(
+            ExchangeRateBucket.resolution == resolution
+        )
+        if since is not None:
+            query = query.filter(ExchangeRateBucket.bucket_start >= since)
+
+        for bucket in query.order_by(ExchangeRateBucket.bucket_start).yield_per(5000):
+            yield (bucket.base_asset_id, bucket.quote_asset_id, bucket.bucket_start,
+                   bucket.open, bucket.high, bucket.low, bucket.close,
+                   bucket.close_timestamp, bucket.sample_count)
+
+    @staticmethod
+    def rollup() -> Dict[str, int]:
+        """
+        Compact raw rates into 5-minute buckets, 5-minute into hourly and hourly into
+        daily. Each level restarts from its latest (possibly partial) bucket, which is
+        rebuilt together with anything newer. Returns the buckets written per level.
+        """
+        written = {}
+        source = None
+        try:
+            for resolution, _ in RESOLUTIONS:
+                since = RateHistoryService._last_bucket_start(resolution)
+                if source is None:
+                    samples = RateHistoryService._raw_samples(since)
+                else:
+                    # The source level's buckets all start within their parent bucket
+                    samples = RateHistoryService._bucket_samples(source, since)
+                buckets = RateHistoryService._aggregate(samples, resolution)
+
+                delete = ExchangeRateBucket.query.filter(ExchangeRateBucket.resolution == resolution)
+                if since is not None:
+                    delete = delete.filter(ExchangeRateBucket.bucket_start >= since)
+                delete.delete(synchronize_session=False)
+
+                if buckets:
+                    db.session.bulk_insert_mappings(ExchangeRateBucket, buckets)
+                db.session.flush()
+                written[resolution] = len(buckets)
+                source = resolution
+
+            db.session.commit()
+        except Exception:
+            db.session.rollback()
+            raise
+        return written
+
+    @staticmethod
+    def prune_raw(retention_days: Optional[int] = None) -> int:
+        """
+        Hard-delete raw exchange_rates older than the retention window. Rows newer than
+        the start of the latest 5-minute bucket are always kept, so nothing is dropped
+        before it has been rolled up.
+        """
+        if retention_days is None:
+            retention_days = RateHistoryService.raw_retention_days()
+        rolled_up_to = RateHistoryService._last_bucket_start('5m')
+        if rolled_up_to is None:
+            return 0
+
+        cutoff = min(datetime.utcnow() - timedelta(days=retention_days), rolled_up_to)
+        try:
+            deleted = ExchangeRate.query.filter(
+                ExchangeRate.timestamp < cutoff
+            ).delete(synchronize_session=False)
+            db.session.commit()
+        except Exception:
+            db.session.rollback()
+            raise
+        return deleted
+
+    @staticmethod
+    def _samples_query(resolution: str, pairs: Iterable[Tuple[int, int]]):
+        """
+        Rate samples (base_asset_id, quote_asset_id, ts, rate) for the given pairs: bucket
+        closes at the given resolution, plus the raw rows newer than the last rollup
+        """
+        pair_filter = lambda model: or_(*[
+            and_(model.base_asset_id == base_id, model.quote_asset_id == quote_id)
+            for base_id, quote_id in pairs
+        ])
+
+        rolled_up_to = select(func.max(ExchangeRateBucket.close_timestamp)).where(
+            ExchangeRateBucket.resolution == resolution
+        ).scalar_subquery()
+
+        buckets = select(
+            ExchangeRateBucket.base_asset_id.label('base_asset_id'),
+            ExchangeRateBucket.quote_asset_id.label('quote_asset_id'),
+            ExchangeRateBucket.close_timestamp.label('ts'),
+            ExchangeRateBucket.close.label('rate')
+        ).where(
+            ExchangeRateBucket.resolution == resolution,
+            pair_filter(ExchangeRateBucket)
+        )
+        raw = select(
+            ExchangeRate.base_asset_id,
+            ExchangeRate.quote_asset_id,
+            ExchangeRate.timestamp,
+            ExchangeRate.rate
+        ).where(
+            pair_filter(ExchangeRate),
+            ExchangeRate.deleted_at.is_(None),
+            ExchangeRate.timestamp > func.coalesce(rolled_up_to, literal(datetime(1970, 1, 1), DateTime))
+        )
+        return union_all(buckets, raw).cte('samples')
+
+    @staticmethod
+    def _as_of_statement(samples, points, pairs, dialect: str):
+        """
+        Latest sample at or before every point for every pair. PostgreSQL runs one
+        LATERAL lookup per (point, pair); other databases (SQLite) rank the joined
+        samples with ROW_NUMBER instead.
+        """
+        if dialect == 'postgresql':
+            latest = select(samples.c.rate).where(
+                samples.c.base_asset_id == pairs.c.base_asset_id,
+                samples.c.quote_asset_id == pairs.c.quote_asset_id,
+                samples.c.ts <= points.c.at
+            ).order_by(samples.c.ts.desc()).limit(1).lateral('latest')
+
+            return select(
+                points.c.idx, pairs.c.base_asset_id, pairs.c.quote_asset_id, latest.c.rate
+            ).select_from(
+                points.join(pairs, true()).join(latest, true())
+            )
+
+        ranked = select(
+            points.c.idx,
+            samples.c.base_asset_id,
+            samples.c.quote_asset_id,
+            samples.c.rate,
+            func.row_number().over(
+                partition_by=(points.c.idx, samples.c.base_asset_id, samples.c.quote_asset_id),
+                order_by=samples.c.ts.desc()
+            ).label('position')
+        ).select_from(
+            points.join(samples, samples.c.ts <= points.c.at)
+        ).subquery('ranked')
+
+        return select(
+            ranked.c.idx, ranked.c.base_asset_id, ranked.c.quote_asset_id, ranked.c.rate
+        ).where(ranked.c.position == 1)
+
+    @staticmethod
+    def get_rates_as_of(asset_ids: Iterable[int], quote_asset_id: int, timestamps: Iterable[datetime],
+                        granularity: timedelta = timedelta(days=1)) -> Dict[Tuple[int, datetime], Decimal]:
+        """
+        Latest rate of every asset against the quote asset at or before each timestamp,
+        resolved in a single query on the smallest bucket level that resolves the given
+        granularity. Returns {(asset_id, timestamp): rate}; unknown rates are left out.
+        Assets without a direct rate are triangulated through the USD legs.
+        """
+        asset_ids = sorted(set(asset_ids))
+        timestamps = list(dict.fromkeys(timestamps))
+        rates = {}
+        if not asset_ids or not timestamps:
+            return rates
+
+        for timestamp in timestamps:
+            if quote_asset_id in asset_ids:
+                rates[(quote_asset_id, timestamp)] = Decimal('1')
+        base_ids = [asset_id for asset_id in asset_ids if asset_id != quote_asset_id]
+        if not base_ids:
+            return rates
+
+        pairs = [(asset_id, quote_asset_id) for asset_id in base_ids]
+        pivot_id = RateService.get_pivot_asset_id()
+        if pivot_id is not None and pivot_id != quote_asset_id:
+            pairs += [(asset_id, pivot_id) for asset_id in base_ids + [quote_asset_id] if asset_id != pivot_id]
+        pairs = list(dict.fromkeys(pairs))
+
+        resolution = RateHistoryService.resolution_for(granularity)
+        samples = RateHistoryService._samples_query(resolution, pairs)
+        points = union_all(*[
+            select(literal(idx, Integer).label('idx'), literal(timestamp, DateTime).label('at'))
+            for idx, timestamp in enumerate(timestamps)
+        ]).subquery('points')
+        pair_rows = union_all(*[
+            select(literal(base_id, Integer).label('base_asset_id'), literal(quote_id, Integer).label('quote_asset_id'))
+            for base_id, quote_id in pairs
+        ]).subquery('pairs')
+
+        dialect = db.session.get_bind().dialect.name
+        stmt = RateHistoryService._as_of_statement(samples, points, pair_rows, dialect)
+
+        found = {}
+        for row in db.session.execute(stmt):
+            found[(row.base_asset_id, row.quote_asset_id, row.idx)] = Decimal(str(row.rate))
+
+        for idx, timestamp in enumerate(timestamps):
+            for asset_id in base_ids:
+                rate = found.get((asset_id, quote_asset_id, idx))
+                if rate is None and pivot_id is not None and pivot_id not in (asset_id, quote_asset_id):
+                    base_leg = found.get((asset_id, pivot_id, idx))
+                    quote_leg = found.get((quote_asset_id, pivot_id, idx))
+                    if base_leg is not None and quote_leg:
+                        rate = base_leg / quote_leg
+                if rate is not None:
+                    rates[(asset_id, timestamp)] = rate
+        return rates
+
+    @staticmethod
+    def get_rate_at(base_asset_id: int, quote_asset_id: int, at: datetime,
+                    granularity: timedelta = timedelta(days=1)) -> Optional[Decimal]:
+        """Rate of a single pair as of a point in time, see get_rates_as_of"""
+        rates = RateHistoryService.get_rates_as_of([base_asset_id], quote_asset_id, [at], granularity)
+        return rates.get((base_asset_id, at))
+
+    @staticmethod
+    def get_history_dates(start: datetime) -> List:
+        """Distinct days since start that have rate data, rolled up or still raw"""
+        bucket_days = db.session.query(ExchangeRateBucket.bucket_start).filter(
+            ExchangeRateBucket.resolution == '1d',
+            ExchangeRateBucket.bucket_start >= bucket_start(start, '1d')
+        ).distinct().all()
+        dates = {row.bucket_start.date() for row in bucket_days}
+
+        raw_since = start
+        latest_day = RateHistoryService._last_bucket_start('1d')
+        if latest_day is not None:
+            raw_since = max(start, latest_day)
+        raw_days = db.session.query(
+            func.date(ExchangeRate.timestamp).label('date')
+        ).filter(
+            ExchangeRate.timestamp >= raw_since,
+            ExchangeRate.deleted_at.is_(None)
+        ).group_by(
+            func.date(ExchangeRate.timestamp)
+        ).all()
+        for row in raw_days:
+            # func.date returns a string on SQLite
+            day = row.date if not isinstance(row.date, str) else datetime.strptime(row.date, '%Y-%m-%d').date()
+            dates.add(day)
+
+        return sorted(day for day in dates if day >= start.date())
@@ -0,0 +1,349 @@
+# app/pricing/rates.py
+import threading
+from collections import namedtuple
+from datetime import datetime, timedelta
+from decimal import Decimal
+from typing import Dict, Iterable, Optional, Tuple
+from flask import current_app, has_app_context
+from sqlalchemy import and_, event, select
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.orm import Session
+from app.models import Asset, AssetType, ExchangeRate, LatestExchangeRate
+from app.extensions import db, cache
+from app.events import rates_refreshed
+
+RateEntry = namedtuple('RateEntry', ['rate', 'timestamp'])
+
+
+class LatestRateIndex:
+    """Process-wide index of the latest rate per (base_asset_id, quote_asset_id)"""
+
+    def __init__(self):
+        self._rates: Dict[Tuple[int, int], RateEntry] = {}
+        # Triangulated cross rates, only valid until the next refresh or insert
+        self._cross_rates: Dict[Tuple[int, int], RateEntry] = {}
+        self._lock = threading.Lock()
+        self.version = 0
+        self.loaded_at: Optional[datetime] = None
+
+    def get(self, base_asset_id: int, quote_asset_id: int) -> Optional[RateEntry]:
+        return self._rates.get((base_asset_id, quote_asset_id))
+
+    def get_cross(self, base_asset_id: int, quote_asset_id: int) -> Optional[RateEntry]:
+        return self._cross_rates.get((base_asset_id, quote_asset_id))
+
+    def put(self, base_asset_id: int, quote_asset_id: int, rate, timestamp: datetime):
+        """Record a single rate, keeping whichever entry is newest"""
+        key = (base_asset_id, quote_asset_id)
+        with self._lock:
+            current = self._rates.get(key)
+            if current is None or current.timestamp <= timestamp:
+                self._rates[key] = RateEntry(Decimal(str(rate)), timestamp)
+            self._cross_rates = {}
+            self.version += 1
+
+    def put_cross(self, base_asset_id: int, quote_asset_id: int, entry: RateEntry):
+        with self._lock:
+            self._cross_rates[(base_asset_id, quote_asset_id)] = entry
+
+    def replace(self, entries: Dict[Tuple[int, int], RateEntry]):
+        """Swap in a freshly loaded set of latest rates"""
+        with self._lock:
+            self._rates = dict(entries)
+            self._cross_rates = {}
+            self.loaded_at = datetime.utcnow()
+            self.version += 1
+
+    def invalidate(self):
+        """Drop everything so the next lookup reloads from the database"""
+        with self._lock:
+            self._rates = {}
+            self._cross_rates = {}
+            self.loaded_at = None
+            self.version += 1
+
+    def is_stale(self, max_age: int) -> bool:
+        if self.loaded_at is None:
+            return True
+        return datetime.utcnow() - self.loaded_at > timedelta(seconds=max_age)
+
+    def __len__(self):
+        return len(self._rates)
+
+
+# Shared by every request handled in this process
+latest_rate_index = LatestRateIndex()
+
+
+class RateService:
+    """Single lookup API for the latest exchange rate of a pair"""
+
+    DEFAULT_INDEX_MAX_AGE = 300  # seconds
+    PIVOT_SYMBOL = 'USD'  # Cross rates are triangulated through this fiat asset
+    RATES_VERSION_KEY = 'pricing:rates_version'  # Shared cache key bumped by every bulk rate refresh
+    VERSION_POLL_INTERVAL = 1  # seconds between checks of the shared rates version
+    _pivot_asset_id = None
+    _version_checked_at = None
+
+    @staticmethod
+    def _index_max_age() -> int:
+        if has_app_context():
+            return current_app.config.get('RATE_INDEX_MAX_AGE', RateService.DEFAULT_INDEX_MAX_AGE)
+        return RateService.DEFAULT_INDEX_MAX_AGE
+
+    @staticmethod
+    def load_latest_rates() -> Dict[Tuple[int, int], RateEntry]:
+        """Load the current rate for every pair from latest_exchange_rates"""
+        rows = db.session.query(
+            LatestExchangeRate.base_asset_id,
+            LatestExchangeRate.quote_asset_id,
+            LatestExchangeRate.rate,
+            LatestExchangeRate.timestamp
+        ).all()
+
+        return {
+            (row.base_asset_id, row.quote_asset_id): RateEntry(Decimal(str(row.rate)), row.timestamp)
+            for row in rows
+        }
+
+    @staticmethod
+    def upsert_latest_rates(rows: Iterable[Dict], connection=None) -> int:
+        """
+        Upsert rows of base_asset_id, quote_asset_id, rate, timestamp and source into
+        latest_exchange_rates. Runs on the given connection (or the session's), so it
+        commits or rolls back together with the matching exchange_rates insert.
+        An existing row is only replaced by a rate that is at least as new.
+        """
+        # Keep the newest row per pair, a single upsert statement can't touch a row twice
+        newest = {}
+        for row in rows:
+            key = (row['base_asset_id'], row['quote_asset_id'])
+            if key not in newest or newest[key]['timestamp'] <= row['timestamp']:
+                newest[key] = row
+        if not newest:
+            return 0
+
+        connection = connection if connection is not None else db.session.connection()
+        table = LatestExchangeRate.__table__
+        now = datetime.utcnow()
+        values = [
+            {
+                'base_asset_id': row['base_asset_id'],
+                'quote_asset_id': row['quote_asset_id'],
+                'rate': row['rate'],
+                'timestamp': row['timestamp'],
+                'source': row.get('source'),
+                'created_at': now,
+                'updated_at': now,
+            }
+            for row in newest.values()
+        ]
+
+        dialect = connection.dialect.name
+        if dialect in ('postgresql', 'sqlite'):
+            insert = postgresql.insert if dialect == 'postgresql' else sqlite.insert
+            stmt = insert(table)
+            stmt = stmt.on_conflict_do_update(
+                index_elements=[table.c.base_asset_id, table.c.quote_asset_id],
+                set_={
+                    'rate': stmt.excluded.rate,
+                    'timestamp': stmt.excluded.timestamp,
+                    'source': stmt.excluded.source,
+                    'updated_at': stmt.excluded.updated_at,
+                },
+                where=table.c.timestamp <= stmt.excluded.timestamp
+            )
+            connection.execute(stmt, values)
+        else:
+            for value in values:
+                key_filter = and_(
+                    table.c.base_asset_id == value['base_asset_id'],
+                    table.c.quote_asset_id == value['quote_asset_id']
+                )
+                exists = connection.execute(
+                    select(table.c.timestamp).where(key_filter)
+                ).first()
+                if exists is None:
+                    connection.execute(table.insert().values(**value))
+                elif exists.timestamp <= value['timestamp']:
+                    connection.execute(
+                        table.update().where(key_filter).values(
+                            rate=value['rate'],
+                            timestamp=value['timestamp'],
+                            source=value['source'],
+                            updated_at=value['updated_at']
+                        )
+                    )
+
+        return len(values)
+
+    @staticmethod
+    def refresh_index() -> int:
+        """Rebuild the in-memory index from the database, returns the number of pairs"""
+        entries = RateService.load_latest_rates()
+        latest_rate_index.replace(entries)
+        return len(entries)
+
+    @staticmethod
+    def publish_rates_version():
+        """Record in the shared cache that fresh rates were stored, so every process reloads"""
+        version = datetime.utcnow()
+        cache.set(RateService.RATES_VERSION_KEY, version, timeout=0)
+        rates_refreshed.send(version)
+
+    @staticmethod
+    def rates_version():
+        """When rates were last published to the shared cache (None if never)"""
+        if not has_app_context():
+            return None
+        return cache.get(RateService.RATES_VERSION_KEY)
+
+    @staticmethod
+    def _index_needs_refresh() -> bool:
+        if latest_rate_index.is_stale(RateService._index_max_age()):
+            return True
+
+        # Cheap check, at most once per poll interval, for rates published by another process
+        if not has_app_context():
+            return False
+        now = datetime.utcnow()
+        checked_at = RateService._version_checked_at
+        if checked_at is not None and now - checked_at < timedelta(seconds=RateService.VERSION_POLL_INTERVAL):
+            return False
+        RateService._version_checked_at = now
+        published_at = cache.get(RateService.RATES_VERSION_KEY)
+        return published_at is not None and published_at > latest_rate_index.loaded_at
+
+    @staticmethod
+    def get_pivot_asset_id() -> Optional[int]:
+        """Id of the fiat asset every crypto rate is stored against"""
+        if RateService._pivot_asset_id is None:
+            pivot = Asset.query.filter_by(
+                symbol=RateService.PIVOT_SYMBOL,
+                asset_type=AssetType.FIAT
+            ).first()
+            RateService._pivot_asset_id = pivot.id if pivot else None
+        return RateService._pivot_asset_id
+
+    @staticmethod
+    def _get_stored_rate(base_asset_id: int, quote_asset_id: int) -> Optional[RateEntry]:
+        """Look up a rate that was actually stored, without triangulating"""
+        entry = latest_rate_index.get(base_asset_id, quote_asset_id)
+        if entry is None:
+            # Another worker may have stored it since the last reload
+            latest = db.session.get(LatestExchangeRate, (base_asset_id, quote_asset_id))
+            if latest is not None:
+                latest_rate_index.put(base_asset_id, quote_asset_id, latest.rate, latest.timestamp)
+                entry = latest_rate_index.get(base_asset_id, quote_asset_id)
+        return entry
+
+    @staticmethod
+    def _triangulate(base_asset_id: int, quote_asset_id: int) -> Optional[RateEntry]:
+        """
+        Derive base/quote from the base/pivot and quote/pivot legs. The result is
+        cached until the index is next refreshed or receives a new rate, and carries
+        the timestamp of the older leg.
+        """
+        pivot_id = RateService.get_pivot_asset_id()
+        if pivot_id is None or pivot_id in (base_asset_id, quote_asset_id):
+            return None
+
+        base_leg = RateService._get_stored_rate(base_asset_id, pivot_id)
+        quote_leg = RateService._get_stored_rate(quote_asset_id, pivot_id)
+        if not base_leg or not quote_leg or quote_leg.rate <= 0:
+            return None
+
+        entry = RateEntry(
+            base_leg.rate / quote_leg.rate,
+            min(base_leg.timestamp, quote_leg.timestamp)
+        )
+        latest_rate_index.put_cross(base_asset_id, quote_asset_id, entry)
+        return entry
+
+    @staticmethod
+    def get_latest_rate(base_asset_id: int, quote_asset_id: int) -> Optional[RateEntry]:
+        """
+        Get the latest (rate, timestamp) for a pair, or None if no rate is known.
+        Served from the process-wide index, which is reloaded when it gets too old.
+        Pairs that are not stored (crypto-to-crypto) are triangulated through USD.
+        """
+        if base_asset_id == quote_asset_id:
+            return RateEntry(Decimal('1'), datetime.utcnow())
+
+        if RateService._index_needs_refresh():
+            RateService.refresh_index()
+
+        entry = latest_rate_index.get(base_asset_id, quote_asset_id)
+        if entry is not None:
+            return entry
+
+        entry = latest_rate_index.get_cross(base_asset_id, quote_asset_id)
+        if entry is not None:
+            return entry
+
+        return RateService._get_stored_rate(base_asset_id, quote_asset_id) or \
+            RateService._triangulate(base_asset_id, quote_asset_id)
+
+    @staticmethod
+    def get_rate(base_asset_id: int, quote_asset_id: int) -> Optional[Decimal]:
+        """Get just the latest rate value for a pair"""
+        entry = RateService.get_latest_rate(base_asset_id, quote_asset_id)
+        return entry.rate if entry else None
+
+    @staticmethod
+    def record_cross_rate(base_asset_id: int, quote_asset_id: int, rate: Decimal, timestamp: datetime):
+        """
+        Keep a directly fetched cross rate in this process until the index next
+        changes; cross rates are never stored, so they can't outlive fresher legs
+        """
+        latest_rate_index.put_cross(base_asset_id, quote_asset_id, RateEntry(Decimal(str(rate)), timestamp))
+
+    @staticmethod
+    def record_rates(rates: Iterable[Tuple[int, int, Decimal, datetime]]):
+        """Push freshly committed (base_asset_id, quote_asset_id, rate, timestamp) rows into the index"""
+        for base_asset_id, quote_asset_id, rate, timestamp in rates:
+            latest_rate_index.put(base_asset_id, quote_asset_id, rate, timestamp)
+
+
+# ----- Event listeners -----
+# Rates inserted through the ORM are upserted into latest_exchange_rates on the
+# flush connection, and staged on the session so they only reach the index once
+# the transaction commits; rolled back rates are never served. These are one-off
+# rates (e.g. a live swap-rate fetch), so they only update this process's index:
+# publishing a new rates version is left to the bulk refresh, as every publish
+# makes all workers reload their index and outdates every portfolio snapshot.
+
+@event.listens_for(ExchangeRate, 'after_insert')
+def stage_rate_after_insert(mapper, connection, target):
+    RateService.upsert_latest_rates([{
+        'base_asset_id': target.base_asset_id,
+        'quote_asset_id': target.quote_asset_id,
+        'rate': target.rate,
+        'timestamp': target.timestamp,
+        'source': target.source,
+    }], connection)
+
+    session = Session.object_session(target)
+    if session is not None:
+        session.info.setdefault('pending_rates', []).append(
+            (target.base_asset_id, target.quote_asset_id, target.rate, target.timestamp)
+        )
+
+
+@event.listens_for(Session, 'after_commit')
+def record_rates_after_commit(session):
+    pending = session.info.pop('pending_rates', None)
+    if pending:
+        RateService.record_rates(pending)
+
+
+@event.listens_for(Session, 'after_rollback')
+def discard_rates_after_rollback(session):
+    session.info.pop('pending_rates', None)
+
+
+@rates_refreshed.connect
+def reload_index_on_rates_refreshed(version):
+    # The publishing process reloads at once; other processes notice the new
+    # version in the shared cache on their next poll
+    RateService.refresh_index()
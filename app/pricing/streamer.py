@@ -0,0 +1,113 @@
+# app/pricing/streamer.py
+import random
+import threading
+from typing import Dict, Optional, Sequence
+from app.extensions import db
+from app.dashboard.services import CoinGeckoService
+from .client import get_coingecko_client
+from .rates import latest_rate_index
+
+
+class CoinGeckoProvider:
+    """Live prices from CoinGecko /simple/price through the shared client"""
+    source = 'coingecko'
+
+    def fetch_prices(self, coin_ids: Sequence[str], vs_currencies: Sequence[str]) -> Dict:
+        return get_coingecko_client().simple_price(coin_ids, vs_currencies, include_last_updated_at='true')
+
+
+class RandomWalkProvider:
+    """
+    Offline stand-in returning /simple/price shaped data. Each price starts at the
+    given seed price (or a deterministic pseudo-price) and takes a small random
+    step on every poll.
+    """
+    source = 'random_walk'
+
+    def __init__(self, seed_prices: Optional[Dict[str, Dict[str, float]]] = None,
+                 volatility: float = 0.002, seed: Optional[int] = None):
+        self.prices = {coin: dict(quotes) for coin, quotes in (seed_prices or {}).items()}
+        self.volatility = volatility
+        self.rng = random.Random(seed)
+
+    def fetch_prices(self, coin_ids: Sequence[str], vs_currencies: Sequence[str]) -> Dict:
+        data = {}
+        for coin_id in coin_ids:
+            quotes = self.prices.setdefault(coin_id, {})
+            for currency in vs_currencies:
+                price = quotes.get(currency)
+                if price is None:
+                    price = random.Random(f"{coin_id}/{currency}").uniform(0.01, 1000)
+                quotes[currency] = price * (1 + self.rng.gauss(0, self.volatility))
+            data[coin_id] = {currency: quotes[currency] for currency in vs_currencies}
+        return data
+
+
+class PriceStreamer:
+    """
+    Polls a price provider on a schedule and publishes every snapshot into the rate
+    store (exchange_rates, latest_exchange_rates, the in-memory index and the shared
+    cache version), so request handlers read rates instead of fetching them.
+    Successful polls are spaced by the interval with +/- jitter; failures back off
+    exponentially up to max_backoff, with jitter so workers don't retry in lockstep.
+    """
+
+    def __init__(self, app, provider=None, interval: float = 60, max_backoff: float = 900,
+                 jitter: float = 0.1):
+        self.app = app
+        self.provider = provider or CoinGeckoProvider()
+        self.interval = interval
+        self.max_backoff = max_backoff
+        self.jitter = jitter
+        self.failures = 0
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def run_once(self) -> int:
+        """Poll the provider once and store the snapshot, returns the number of rates stored"""
+        with self.app.app_context():
+            try:
+                return CoinGeckoService.fetch_and_store_rates(
+                    fetch_prices=self.provider.fetch_prices,
+                    source=self.provider.source
+                )
+            finally:
+                db.session.remove()
+
+    def next_delay(self) -> float:
+        if not self.failures:
+            return self.interval * random.uniform(1 - self.jitter, 1 + self.jitter)
+        backoff = min(self.max_backoff, self.interval * 2 ** (self.failures - 1))
+        return backoff / 2 + random.uniform(0, backoff / 2)
+
+    def tick(self):
+        try:
+            count = self.run_once()
+            self.failures = 0
+            self.app.logger.info(f"Price streamer stored {count} rates (index version {latest_rate_index.version})")
+        except Exception as e:
+            self.failures += 1
+            self.app.logger.warning(f"Price streamer poll failed ({self.failures} in a row): {str(e)}")
+
+    def run(self, max_ticks: Optional[int] = None):
+        """Poll until stopped (or for max_ticks polls), blocking the calling thread"""
+        ticks = 0
+        while not self._stop.is_set():
+            self.tick()
+            ticks += 1
+            if max_ticks is not None and ticks >= max_ticks:
+                break
+            self._stop.wait(self.next_delay())
+
+    def start(self) -> threading.Thread:
+        """Run in a daemon thread"""
+        self._stop.clear()
+        self._thread = threading.Thread(target=self.run, name='price-streamer', daemon=True)
+        self._thread.start()
+        return self._thread
+
+    def stop(self, timeout: Optional[float] = None):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+            self._thread = None
@@ -0,0 +1,111 @@
+# app/pricing/vectorized.py
+import time
+import tracemalloc
+from datetime import datetime
+from decimal import Decimal
+from typing import Callable, Dict, List, Sequence
+import numpy as np
+
+
+def build_price_matrix(data: Dict, coin_ids: Sequence[str], vs_currencies: Sequence[str]) -> np.ndarray:
+    """
+    Turn a CoinGecko /simple/price response into a (coins x currencies) float
+    matrix, with NaN wherever a price is missing
+    """
+    matrix = np.full((len(coin_ids), len(vs_currencies)), np.nan, dtype=np.float64)
+    for row, coin_id in enumerate(coin_ids):
+        coin_data = data.get(coin_id) or {}
+        for col, currency in enumerate(vs_currencies):
+            price = coin_data.get(currency)
+            if price is not None:
+                matrix[row, col] = price
+    return matrix
+
+
+def cross_rate_matrix(usd_prices: np.ndarray) -> np.ndarray:
+    """
+    Compute every base/quote cross rate from a vector of USD prices with one
+    outer division. Pairs with a missing or non-positive leg, and the diagonal,
+    are NaN.
+    """
+    prices = np.where(usd_prices > 0, usd_prices, np.nan)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        matrix = np.divide.outer(prices, prices)
+    np.fill_diagonal(matrix, np.nan)
+    return matrix
+
+
+def matrix_to_rows(matrix: np.ndarray, base_asset_ids: Sequence[int], quote_asset_ids: Sequence[int],
+                   timestamp: datetime, source: str) -> List[Dict]:
+    """
+    Persistence boundary: convert the finite cells of a rate matrix into
+    exchange rate rows, creating Decimals only for the values actually stored
+    """
+    row_idx, col_idx = np.nonzero(np.isfinite(matrix))
+    values = matrix[row_idx, col_idx].tolist()
+    return [
+        {
+            'base_asset_id': base_asset_ids[row],
+            'quote_asset_id': quote_asset_ids[col],
+            'rate': Decimal(repr(value)),
+            'timestamp': timestamp,
+            'source': source,
+        }
+        for row, col, value in zip(row_idx.tolist(), col_idx.tolist(), values)
+    ]
+
+
+def cross_rates_loop(usd_prices: Sequence[float], asset_ids: Sequence[int],
+                     timestamp: datetime, source: str) -> List[Dict]:
+    """The original per-pair Decimal loop, kept as the benchmark baseline"""
+    rows = []
+    for i, base_usd_rate in enumerate(usd_prices):
+        if not base_usd_rate:
+            continue
+        for j, quote_usd_rate in enumerate(usd_prices):
+            if i == j or not quote_usd_rate:
+                continue
+            rows.append({
+                'base_asset_id': asset_ids[i],
+                'quote_asset_id': asset_ids[j],
+                'rate': Decimal(str(base_usd_rate)) / Decimal(str(quote_usd_rate)),
+                'timestamp': timestamp,
+                'source': source,
+            })
+    return rows
+
+
+def cross_rates_vectorized(usd_prices: Sequence[float], asset_ids: Sequence[int],
+                           timestamp: datetime, source: str) -> List[Dict]:
+    """Same rows as cross_rates_loop, computed with a NumPy outer division"""
+    vector = np.asarray(usd_prices, dtype=np.float64)
+    return matrix_to_rows(cross_rate_matrix(vector), asset_ids, asset_ids, timestamp, source)
+
+
+def _measure(fn: Callable, *args) -> Dict:
+    tracemalloc.start()
+    started = time.perf_counter()
+    result = fn(*args)
+    elapsed = time.perf_counter() - started
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return {'seconds': elapsed, 'peak_bytes': peak, 'rows': len(result)}
+
+
+def benchmark_cross_rates(asset_counts: Sequence[int] = (150, 500, 2000), seed: int = 42) -> List[Dict]:
+    """
+    Compare wall time and peak allocations of the loop and the vectorized
+    cross-rate computation for synthetic price vectors of the given sizes
+    """
+    rng = np.random.default_rng(seed)
+    timestamp = datetime.utcnow()
+    results = []
+    for count in asset_counts:
+        usd_prices = rng.lognormal(mean=0.0, sigma=4.0, size=count).tolist()
+        asset_ids = list(range(1, count + 1))
+        results.append({
+            'assets': count,
+            'loop': _measure(cross_rates_loop, usd_prices, asset_ids, timestamp, 'benchmark'),
+            'vectorized': _measure(cross_rates_vectorized, usd_prices, asset_ids, timestamp, 'benchmark'),
+        })
+    return results
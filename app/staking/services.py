@@ -1,7 +1,7 @@
 from decimal import Decimal
 from datetime import datetime, timedelta
 from flask import current_app
-from app.models import User, Holding, Asset, AssetType, StakingPosition, MiningPool, HashratePackage, MiningContract, Transaction, MiningContractStatus, MiningEarnings, MiningEarningsStatus, MiningDifficulty, MiningAlgorithm    
+from app.models import User, Holding, Asset, AssetType, StakingPosition, MiningPool, HashratePackage, MiningContract, Transaction, TransactionType, TransactionStatus, MiningContractStatus, MiningEarnings, MiningEarningsStatus, MiningDifficulty, MiningAlgorithm    
 from app.extensions import db
 from sqlalchemy import or_, func
 
@@ -120,24 +120,21 @@ class StakingService:
                 provider='Internal'
             )
             
-            # Update user holding (subtract staked amount from available balance)
-            holding = Holding.query.filter_by(
+            # Move the staked amount out of the available balance, the holding
+            # is debited from the transaction when it is flushed
+            stake_transaction = Transaction(
                 user_id=user_id,
-                asset_id=asset_id
-            ).first()
-            
-            if holding:
-                holding.balance -= Decimal(str(amount))
-            else:
-                # This shouldn't happen if validation passed, but handle it
-                return {
-                    'success': False,
-                    'error': 'Balance error',
-                    'message': 'Could not find user balance record'
-                }
+                asset_id=asset_id,
+                tx_type=TransactionType.STAKE,
+                amount=Decimal(str(amount)),
+                status=TransactionStatus.SUCCESS,
+                timestamp=datetime.utcnow(),
+                notes=f"Staked {amount} {asset.symbol}"
+            )
             
             # Save to database
             db.session.add(staking_position)
+            db.session.add(stake_transaction)
             db.session.commit()
             
             return {
@@ -268,22 +265,18 @@ class StakingService:
                     'message': f'Position is locked until {position.locked_until.strftime("%Y-%m-%d %H:%M:%S")}'
                 }
             
-            # Return funds to user's holding
-            holding = Holding.query.filter_by(
+            # Return funds to user's holding, credited from the transaction when it
+            # is flushed (creating the holding if it doesn't exist)
+            unstake_transaction = Transaction(
                 user_id=user_id,
-                asset_id=position.asset_id
-            ).first()
-            
-            if holding:
-                holding.balance += position.amount
-            else:
-                # Create new holding if it doesn't exist
-                holding = Holding(
-                    user_id=user_id,
-                    asset_id=position.asset_id,
-                    balance=position.amount
-                )
-                db.session.add(holding)
+                asset_id=position.asset_id,
+                tx_type=TransactionType.UNSTAKE,
+                amount=position.amount,
+                status=TransactionStatus.SUCCESS,
+                timestamp=datetime.utcnow(),
+                notes=f"Unstaked {position.amount} {position.asset.symbol}"
+            )
+            db.session.add(unstake_transaction)
             
             # Remove staking position
             db.session.delete(position)
@@ -0,0 +1,107 @@
+# app/trading/depth.py
+import math
+from datetime import datetime
+from typing import Dict, List, Optional, Sequence, Tuple
+
+# Aggregated views are precomputed at the price's order of magnitude minus these
+# exponents, e.g. ticks of 1, 10 and 100 for a price around 50,000
+TICK_EXPONENTS = (4, 3, 2)
+
+
+def tick_sizes(mid_price: Optional[float]) -> List[float]:
+    """Tick sizes to aggregate a book around mid_price at, finest first"""
+    if not mid_price or mid_price <= 0:
+        return []
+    magnitude = math.floor(math.log10(mid_price))
+    return [10.0 ** (magnitude - exponent) for exponent in TICK_EXPONENTS]
+
+
+def aggregate_levels(levels: Sequence[Sequence[float]], tick: float, side: str) -> List[Tuple[float, float]]:
+    """
+    Merge (price, amount) levels into buckets of tick size, best first. Bids round
+    down and asks round up, so a bucket never shows a better price than it holds.
+    """
+    buckets: Dict[int, float] = {}
+    for price, amount in levels:
+        ticks = math.floor(price / tick + 1e-9) if side == 'bid' else math.ceil(price / tick - 1e-9)
+        buckets[ticks] = buckets.get(ticks, 0.0) + amount
+    return [(round(ticks * tick, 12), amount)
+            for ticks, amount in sorted(buckets.items(), reverse=(side == 'bid'))]
+
+
+def depth_levels(levels: Sequence[Sequence[float]]) -> List[Dict]:
+    """Price levels with their quote total and depth as a percentage of the largest level"""
+    max_amount = max([amount for price, amount in levels] or [0])
+    return [{
+        'price': price,
+        'amount': amount,
+        'total': amount * price,
+        'depth': 100 * float(amount) / float(max_amount) if max_amount else 0
+    } for price, amount in levels]
+
+
+def build_snapshot(bids: Sequence[Sequence[float]], asks: Sequence[Sequence[float]], source: str) -> Dict:
+    """
+    Depth snapshot of a book: the raw (price, amount) levels plus every precomputed
+    aggregation, keyed by tick size (None for raw), ready to be sliced to any limit
+    """
+    # Exchanges may append more fields (e.g. a timestamp) after price and amount
+    bids = [(float(level[0]), float(level[1])) for level in bids]
+    asks = [(float(level[0]), float(level[1])) for level in asks]
+    mid_price = (bids[0][0] + asks[0][0]) / 2 if bids and asks else None
+
+    views = {None: {'bids': bids, 'asks': asks}}
+    for tick in tick_sizes(mid_price):
+        views[tick] = {
+            'bids': aggregate_levels(bids, tick, 'bid'),
+            'asks': aggregate_levels(asks, tick, 'ask'),
+        }
+    return {
+        'mid_price': mid_price,
+        'views': views,
+        'source': source,
+        'fetched_at': datetime.utcnow(),
+    }
+
+
+def merge_levels(first: Sequence[Sequence[float]], second: Sequence[Sequence[float]], side: str) -> List[Tuple[float, float]]:
+    """Sum two (price, amount) level lists by price, best first"""
+    merged: Dict[float, float] = {}
+    for price, amount in list(first) + list(second):
+        merged[price] = merged.get(price, 0.0) + amount
+    return sorted(merged.items(), reverse=(side == 'bid'))
+
+
+def merge_snapshots(exchange: Dict, local: Dict) -> Dict:
+    """Exchange and local depth in one snapshot, re-aggregated at the exchange's tick sizes"""
+    raw_exchange, raw_local = exchange['views'][None], local['views'][None]
+    snapshot = build_snapshot(
+        merge_levels(raw_exchange['bids'], raw_local['bids'], 'bid'),
+        merge_levels(raw_exchange['asks'], raw_local['asks'], 'ask'),
+        'merged'
+    )
+    snapshot['fetched_at'] = exchange['fetched_at']
+    return snapshot
+
+
+def snapshot_view(snapshot: Dict, limit: int, tick: Optional[float] = None) -> Dict:
+    """
+    The order book response for a snapshot: raw levels, or the precomputed
+    aggregation with the largest tick not above the requested one
+    """
+    chosen = None
+    if tick:
+        for size in sorted(size for size in snapshot['views'] if size is not None):
+            if size <= tick * (1 + 1e-9):
+                chosen = size
+    view = snapshot['views'][chosen]
+    return {
+        # Depth bars are relative to the levels shown, so only those are formatted
+        'bids': depth_levels(view['bids'][:limit]),
+        'asks': depth_levels(view['asks'][:limit]),
+        'mid_price': snapshot['mid_price'],
+        'tick': chosen,
+        'ticks': sorted(size for size in snapshot['views'] if size is not None),
+        'source': snapshot['source'],
+        'as_of': snapshot['fetched_at'].isoformat(),
+    }
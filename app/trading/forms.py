@@ -67,6 +67,8 @@ class SwapForm(FlaskForm):
     
     # Hidden field for confirmation step
     confirm_swap = HiddenField()
+    # Quote locked by the last preview, honored on execution
+    quote_id = HiddenField()
     
     # Action buttons
     preview_swap = SubmitField(
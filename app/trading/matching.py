@@ -0,0 +1,178 @@
+# app/trading/matching.py
+import threading
+from bisect import bisect_left, insort
+from collections import deque
+from decimal import Decimal
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple
+
+
+class RestingOrder:
+    """An open limit order and the amount of it still unfilled"""
+    __slots__ = ('order_id', 'user_id', 'side', 'price', 'remaining')
+
+    def __init__(self, order_id: int, user_id: int, side: str, price: Decimal, remaining: Decimal):
+        self.order_id = order_id
+        self.user_id = user_id
+        self.side = side
+        self.price = price
+        self.remaining = remaining
+
+
+class Fill:
+    """Part of an incoming order executed against one resting (maker) order at its price"""
+    __slots__ = ('maker', 'amount', 'price')
+
+    def __init__(self, maker: RestingOrder, amount: Decimal, price: Decimal):
+        self.maker = maker
+        self.amount = amount
+        self.price = price
+
+
+class BookSide:
+    """Price levels of one side of a book, best price first, each a FIFO queue of orders"""
+
+    def __init__(self, descending: bool):
+        self.descending = descending
+        self._prices: List[Decimal] = []  # Ascending, the best price is last for bids
+        self._levels: Dict[Decimal, deque] = {}
+
+    def add(self, order: RestingOrder):
+        level = self._levels.get(order.price)
+        if level is None:
+            level = self._levels[order.price] = deque()
+            insort(self._prices, order.price)
+        level.append(order)
+
+    def remove(self, order: RestingOrder):
+        level = self._levels.get(order.price)
+        if level is None or order not in level:
+            return
+        level.remove(order)
+        if not level:
+            del self._levels[order.price]
+            del self._prices[bisect_left(self._prices, order.price)]
+
+    def prices(self) -> Iterator[Decimal]:
+        """Level prices, best first"""
+        return reversed(self._prices) if self.descending else iter(self._prices)
+
+    def __iter__(self) -> Iterator[RestingOrder]:
+        """Resting orders in price-time priority"""
+        for price in self.prices():
+            yield from self._levels[price]
+
+    def levels(self) -> Iterator[Tuple[Decimal, Decimal, int]]:
+        """(price, total remaining, order count) per level, best first"""
+        for price in self.prices():
+            level = self._levels[price]
+            yield price, sum((order.remaining for order in level), Decimal('0')), len(level)
+
+    def best_price(self) -> Optional[Decimal]:
+        if not self._prices:
+            return None
+        return self._prices[-1] if self.descending else self._prices[0]
+
+
+class PairBook:
+    """
+    In-memory book of one (base, quote) pair. Matching first plans the fills of an
+    incoming order without touching the book; the plan is applied only once it has
+    been persisted, so a failed commit leaves the book as it was.
+    """
+
+    def __init__(self, base_asset_id: int, quote_asset_id: int):
+        self.base_asset_id = base_asset_id
+        self.quote_asset_id = quote_asset_id
+        self.bids = BookSide(descending=True)
+        self.asks = BookSide(descending=False)
+        self._orders: Dict[int, RestingOrder] = {}
+        self.last_order_id = 0  # Highest order id the book has seen, to spot orders placed elsewhere
+        self.loaded = False
+        # Held while an order is matched and persisted, so fills of a pair are serialized
+        self.lock = threading.RLock()
+
+    def side(self, side: str) -> BookSide:
+        return self.bids if side == 'buy' else self.asks
+
+    def replace(self, orders: Iterable[Tuple[int, int, str, Decimal, Decimal]]):
+        """Rebuild from (order_id, user_id, side, price, remaining) rows in time priority"""
+        self.bids = BookSide(descending=True)
+        self.asks = BookSide(descending=False)
+        self._orders = {}
+        self.last_order_id = 0
+        for order_id, user_id, side, price, remaining in orders:
+            self.add(order_id, user_id, side, price, remaining)
+        self.loaded = True
+
+    def add(self, order_id: int, user_id: int, side: str, price: Decimal, remaining: Decimal):
+        self.last_order_id = max(self.last_order_id, order_id)
+        if remaining <= 0:
+            return
+        order = RestingOrder(order_id, user_id, side, price, remaining)
+        self._orders[order_id] = order
+        self.side(side).add(order)
+
+    def remove(self, order_id: int):
+        order = self._orders.pop(order_id, None)
+        if order is not None:
+            self.side(order.side).remove(order)
+
+    def get(self, order_id: int) -> Optional[RestingOrder]:
+        return self._orders.get(order_id)
+
+    def plan(self, side: str, price: Decimal, amount: Decimal, skip: Iterable[int] = ()) -> List[Fill]:
+        """
+        Fills an incoming order would get: against the opposite side in price-time
+        priority, at each maker's price, while the prices cross. Orders in skip are
+        passed over. The book is not changed.
+        """
+        skip = set(skip)
+        fills = []
+        remaining = amount
+        for maker in (self.asks if side == 'buy' else self.bids):
+            if remaining <= 0:
+                break
+            if (maker.price > price) if side == 'buy' else (maker.price < price):
+                break
+            if maker.order_id in skip:
+                continue
+            quantity = min(remaining, maker.remaining)
+            fills.append(Fill(maker, quantity, maker.price))
+            remaining -= quantity
+        return fills
+
+    def apply(self, fills: Iterable[Fill]):
+        """Take persisted fills off the resting orders they executed against"""
+        for fill in fills:
+            fill.maker.remaining -= fill.amount
+            if fill.maker.remaining <= 0:
+                self.remove(fill.maker.order_id)
+
+
+class MatchingEngine:
+    """Process-wide registry of in-memory pair books, each rebuilt from order_book rows on first use"""
+
+    def __init__(self):
+        self._books: Dict[Tuple[int, int], PairBook] = {}
+        self._lock = threading.Lock()
+
+    def book(self, base_asset_id: int, quote_asset_id: int) -> PairBook:
+        key = (base_asset_id, quote_asset_id)
+        with self._lock:
+            book = self._books.get(key)
+            if book is None:
+                book = self._books[key] = PairBook(base_asset_id, quote_asset_id)
+            return book
+
+    def loaded_book(self, base_asset_id: int, quote_asset_id: int) -> Optional[PairBook]:
+        """The pair's book if this process has loaded it, without creating one"""
+        book = self._books.get((base_asset_id, quote_asset_id))
+        return book if book is not None and book.loaded else None
+
+    def reset(self):
+        with self._lock:
+            self._books = {}
+
+
+# Shared by every request handled in this process
+matching_engine = MatchingEngine()
@@ -147,12 +147,13 @@ def place_limit_order():
             data['side'].lower()
         )
 
+        # Queued orders are only acknowledged, the matching worker fills them shortly
         return jsonify({
-            'status': 'open',
+            'status': order.status,
             'order_id': order.id,
             'amount': str(order.amount),
             'price': str(order.price)
-        }), 201
+        }), 202 if order.status == 'pending' else 201
 
     except ValueError as e:
         return jsonify({'error': str(e)}), 400
@@ -182,7 +183,18 @@ def get_order_book(base_asset, quote_asset):
         if not base or not quote:
             return jsonify({'error': 'Invalid asset symbols'}), 400
 
-        order_book = OrderBookService.get_order_book(base.id, quote.id)
+        # Optional ?tick= picks a price-level aggregation, ?limit= the levels per side and
+        # ?source= the book: exchange (default), local resting orders or both merged
+        source = request.args.get('source', 'exchange')
+        if source not in ('exchange', 'local', 'merged'):
+            return jsonify({'error': 'Invalid order book source'}), 400
+        order_book = OrderBookService.get_order_book(
+            base.id,
+            quote.id,
+            limit=max(1, min(request.args.get('limit', 5, type=int), 100)),
+            tick=request.args.get('tick', type=float),
+            source=source
+        )
         return jsonify(order_book), 200
     except Exception as e:
         print(f'error: {e}')
@@ -203,12 +215,15 @@ def swap():
     if form.validate_on_submit():
         try:
             if form.preview_swap.data:
-                # Generate swap preview
+                # Generate swap preview, locking the rate into a short-lived quote
+                pricing = CryptoSwapService.quote_swap(form.from_asset_id.data, form.to_asset_id.data)
                 swap_preview = CryptoSwapService.calculate_swap_preview(
                     from_asset_id=form.from_asset_id.data,
                     to_asset_id=form.to_asset_id.data,
-                    from_amount=form.from_amount.data
+                    from_amount=form.from_amount.data,
+                    pricing=pricing
                 )
+                form.quote_id.data = swap_preview['quote_id']
                 show_preview = True
                 flash('Swap preview generated successfully', 'info')
                 
@@ -218,7 +233,8 @@ def swap():
                     user_id=current_user.id,
                     from_asset_id=form.from_asset_id.data,
                     to_asset_id=form.to_asset_id.data,
-                    from_amount=form.from_amount.data
+                    from_amount=form.from_amount.data,
+                    quote_id=form.quote_id.data or None
                 )
                 
                 if result['success']:
@@ -253,26 +269,25 @@ def swap():
 @login_required
 def swap_history():
     """View swap transaction history"""
-    page = request.args.get('page', 1, type=int)
+    page = request.args.get('page', 1, type=int)  # Only shown, the cursors do the paging
     per_page = 20
     
-    # Get recent swaps
-    recent_swaps = CryptoSwapService.get_recent_swaps(current_user.id, limit=100)
-    
-    # Simple pagination
-    start_idx = (page - 1) * per_page
-    end_idx = start_idx + per_page
-    paginated_swaps = recent_swaps[start_idx:end_idx]
-    
-    has_prev = page > 1
-    has_next = len(recent_swaps) > end_idx
+    # Keyset pagination: the page before or after a (timestamp, id) cursor
+    history = CryptoSwapService.get_swap_history_page(
+        current_user.id,
+        per_page,
+        before=CryptoSwapService.parse_swap_cursor(request.args.get('before')),
+        after=CryptoSwapService.parse_swap_cursor(request.args.get('after'))
+    )
     
     return render_template(
         'trading/swap_history.html',
-        transactions=paginated_swaps,
-        page=page,
-        has_prev=has_prev,
-        has_next=has_next
+        transactions=history['transactions'],
+        page=max(page, 1),
+        has_prev=history['has_prev'],
+        has_next=history['has_next'],
+        prev_cursor=history['prev_cursor'],
+        next_cursor=history['next_cursor']
     )
 
 
@@ -290,9 +305,13 @@ def api_swap_preview():
         if from_amount <= 0:
             return jsonify({'error': 'Amount must be greater than 0'}), 400
         
+        # Resolve assets and rate once for validation and preview; repeated previews
+        # of the pair reuse the cached quote
+        pricing = CryptoSwapService.quote_swap(from_asset_id, to_asset_id)
+        
         # Validate swap
         is_valid, error_msg = CryptoSwapService.validate_swap(
-            current_user.id, from_asset_id, to_asset_id, from_amount
+            current_user.id, from_asset_id, to_asset_id, from_amount, pricing=pricing
         )
         
         if not is_valid:
@@ -300,7 +319,7 @@ def api_swap_preview():
         
         # Calculate preview
         preview = CryptoSwapService.calculate_swap_preview(
-            from_asset_id, to_asset_id, from_amount
+            from_asset_id, to_asset_id, from_amount, pricing=pricing
         )
         
         return jsonify({
@@ -311,7 +330,9 @@ def api_swap_preview():
             'fee_amount': str(preview['fee_amount']),
             'fee_percentage': str(preview['fee_percentage']),
             'from_asset_symbol': preview['from_asset'].symbol,
-            'to_asset_symbol': preview['to_asset'].symbol
+            'to_asset_symbol': preview['to_asset'].symbol,
+            'quote_id': preview['quote_id'],
+            'quote_expires_at': preview['quote_expires_at'].isoformat() if preview['quote_expires_at'] else None
         })
         
     except Exception as e:
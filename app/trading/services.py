@@ -2,13 +2,22 @@
 from flask import current_app, request
 from flask_login import current_user
 import ccxt
-import requests
 import pandas as pd
+import math
+import threading
+import uuid
 from datetime import datetime, timedelta
 from decimal import Decimal,  ROUND_DOWN
-from app.models import Asset, ExchangeRate, AssetType, Holding, TradeOrder, OrderBook, Transaction, TransactionType
+from app.models import (Asset, ExchangeRate, AssetType, Holding, TradeOrder, OrderBook, Transaction, TransactionType,
+                        InsufficientBalanceError, TRANSACTION_SOURCE_ORDER_BOOK, SWAP_ROWS_CONDITION)
 from app.wallet.services import WalletService
-from app.extensions import db
+from app.pricing import RateService
+from app.pricing.client import get_coingecko_client
+from app.pricing.singleflight import SingleFlight
+from app.extensions import db, cache
+from app.trading.depth import build_snapshot, merge_snapshots, snapshot_view
+from app.trading.matching import Fill, PairBook, matching_engine
+from sqlalchemy import func, text, tuple_
 from typing import List, Dict, Optional, Tuple
 from app.config import BaseConfig
 
@@ -84,10 +93,37 @@ class ExchangeService:
 # Create a singleton instance
 exchange_service = ExchangeService()
 
+# Upstream order book fetches in flight per symbol, shared by all requests
+order_book_flights = SingleFlight()
+
+
+class StaleOrderBookError(Exception):
+    """The in-memory book disagrees with the order_book table"""
+    pass
+
+
 class OrderBookService:
+    DEFAULT_SNAPSHOT_MAX_AGE = 2  # seconds
+    DEFAULT_SNAPSHOT_STALE_TTL = 30  # seconds
+    DEFAULT_FETCH_DEPTH = 100  # levels per side fetched upstream, whatever the requested limit
+
+    @staticmethod
+    def _snapshot_key(symbol: str) -> str:
+        return f"orderbook:snapshot:{symbol}"
+
     @staticmethod
-    def get_order_book(base_asset_id: int, quote_asset_id: int, limit: int = 5) -> Dict:
-        """Get order book for a trading pair"""
+    def get_order_book(base_asset_id: int, quote_asset_id: int, limit: int = 5,
+                       tick: Optional[float] = None, source: str = 'exchange') -> Dict:
+        """
+        Get order book for a trading pair from a shared depth snapshot. A snapshot
+        younger than ORDER_BOOK_MAX_AGE is served as is; an older one is still served
+        (for up to ORDER_BOOK_STALE_TTL) while a single background fetch refreshes it,
+        so clients polling a pair cost one upstream fetch per interval. tick selects a
+        precomputed price-level aggregation instead of the raw levels.
+        source 'local' serves our own resting orders, 'merged' adds them to the
+        exchange levels; the exchange book falls back to the local one when it fails,
+        and keeps doing so without retrying upstream for ORDER_BOOK_MAX_AGE.
+        """
         # Get assets
         base_asset = Asset.query.get(base_asset_id)
         quote_asset = Asset.query.get(quote_asset_id)
@@ -95,187 +131,513 @@ class OrderBookService:
         if not base_asset or not quote_asset:
             raise ValueError("Invalid asset IDs")
             
+        if source == 'local':
+            return snapshot_view(OrderBookService.get_local_snapshot(base_asset_id, quote_asset_id), limit, tick)
+
         symbol = f"{base_asset.symbol.upper()}/{quote_asset.symbol.upper()}"
+        max_age = current_app.config.get('ORDER_BOOK_MAX_AGE', OrderBookService.DEFAULT_SNAPSHOT_MAX_AGE)
         
-        try:
-            # Get order book from exchange
-            exchange_order_book = exchange_service.get_order_book(symbol, limit)
-
-            # Calculate mid price
-            mid_price = (exchange_order_book['bids'][0][0] + exchange_order_book['asks'][0][0]) / 2
-
-            asks = []
-            max_amount = max([amount for price, amount in exchange_order_book['asks']] or [0])
-            for price, amount in exchange_order_book['asks']:
-                asks.append({
-                    'price': price,
-                    'amount': amount,
-                    'total': amount * price,
-                    'depth': 100 * float(amount) / float(max_amount) if max_amount else 0
-                })
-
-            bids = []
-            max_amount = max([amount for price, amount in exchange_order_book['bids']] or [0])
-            for price, amount in exchange_order_book['bids']:
-                bids.append({
-                    'price': price,
-                    'amount': amount,
-                    'total': amount * price,
-                    'depth': 100 * float(amount) / float(max_amount) if max_amount else 0    
-                })
-
-            # Format the response
-            return {
-                'bids': bids,
-                'asks': asks,
-                'mid_price': mid_price
-            }
-        except Exception as e:
-            print(f"Error getting order book from exchange: {e}")
-            # Fallback to database order book if exchange fails
-            return "Error in Order book service"
+        snapshot = cache.get(OrderBookService._snapshot_key(symbol))
+        if snapshot is None:
+            if cache.get(OrderBookService._unavailable_key(symbol)):
+                # The exchange failed moments ago, don't block every request on it again
+                return snapshot_view(OrderBookService.get_local_snapshot(base_asset_id, quote_asset_id), limit, tick)
+            try:
+                # Requests arriving while the book is fetched share the one fetch
+                snapshot, _ = order_book_flights.do(symbol, lambda: OrderBookService.refresh_snapshot(symbol))
+            except Exception as e:
+                OrderBookService._mark_unavailable(symbol, max_age)
+                current_app.logger.warning(f"Error getting order book from exchange, serving the local book: {e}")
+                return snapshot_view(OrderBookService.get_local_snapshot(base_asset_id, quote_asset_id), limit, tick)
+        elif (datetime.utcnow() - snapshot['fetched_at']).total_seconds() > max_age:
+            OrderBookService._revalidate_in_background(symbol, max_age)
+
+        if source == 'merged':
+            local = OrderBookService.get_local_snapshot(base_asset_id, quote_asset_id)
+            snapshot = merge_snapshots(snapshot, local)
+        return snapshot_view(snapshot, limit, tick)
+
+    @staticmethod
+    def _unavailable_key(symbol: str) -> str:
+        return f"orderbook:unavailable:{symbol}"
+
+    @staticmethod
+    def _mark_unavailable(symbol: str, max_age: float):
+        """Remember a failed upstream fetch for one interval, so the next fetch waits for it to pass"""
+        cache.set(OrderBookService._unavailable_key(symbol), True, timeout=max(1, math.ceil(max_age)))
+
+    @staticmethod
+    def _local_snapshot_key(base_asset_id: int, quote_asset_id: int) -> str:
+        return f"orderbook:local:{base_asset_id}:{quote_asset_id}"
+
+    @staticmethod
+    def get_local_depth(base_asset_id: int, quote_asset_id: int,
+                        depth: Optional[int] = None) -> Tuple[List[Tuple], List[Tuple]]:
+        """
+        (price, amount) levels of the pair's open orders, best first, aggregated by
+        price in one GROUP BY over idx_order_book_pair_side_status_price
+        """
+        rows = OrderBookService.local_depth_query(base_asset_id, quote_asset_id).all()
+
+        bids = sorted(((row.price, row.amount) for row in rows if row.side == 'buy'), reverse=True)
+        asks = sorted((row.price, row.amount) for row in rows if row.side == 'sell')
+        if depth is not None:
+            bids, asks = bids[:depth], asks[:depth]
+        return bids, asks
+
+    @staticmethod
+    def get_local_snapshot(base_asset_id: int, quote_asset_id: int) -> Dict:
+        """Depth snapshot of the pair's resting orders, cached until they change or ORDER_BOOK_MAX_AGE passes"""
+        key = OrderBookService._local_snapshot_key(base_asset_id, quote_asset_id)
+        snapshot = cache.get(key)
+        if snapshot is None:
+            depth = current_app.config.get('ORDER_BOOK_FETCH_DEPTH', OrderBookService.DEFAULT_FETCH_DEPTH)
+            bids, asks = OrderBookService.get_local_depth(base_asset_id, quote_asset_id, depth)
+            snapshot = build_snapshot(bids, asks, 'local')
+            max_age = current_app.config.get('ORDER_BOOK_MAX_AGE', OrderBookService.DEFAULT_SNAPSHOT_MAX_AGE)
+            cache.set(key, snapshot, timeout=max(1, math.ceil(max_age)))
+        return snapshot
+
+    @staticmethod
+    def invalidate_local_book(base_asset_id: int, quote_asset_id: int):
+        """Drop the cached local depth after the pair's resting orders changed"""
+        cache.delete(OrderBookService._local_snapshot_key(base_asset_id, quote_asset_id))
+
+    @staticmethod
+    def refresh_snapshot(symbol: str) -> Dict:
+        """Fetch a pair's book from the exchange and store its depth snapshot in the shared cache"""
+        depth = current_app.config.get('ORDER_BOOK_FETCH_DEPTH', OrderBookService.DEFAULT_FETCH_DEPTH)
+        exchange_order_book = exchange_service.get_order_book(symbol, depth)
+        snapshot = build_snapshot(exchange_order_book['bids'], exchange_order_book['asks'], 'exchange')
+        # The cache entry lives for the whole stale window, freshness is judged on read
+        stale_ttl = current_app.config.get('ORDER_BOOK_STALE_TTL', OrderBookService.DEFAULT_SNAPSHOT_STALE_TTL)
+        cache.set(OrderBookService._snapshot_key(symbol), snapshot, timeout=stale_ttl)
+        return snapshot
+
+    @staticmethod
+    def _revalidate_in_background(symbol: str, max_age: float):
+        """Refresh a stale snapshot off the request thread, once per interval across all workers"""
+        # add() only succeeds for the first caller until the marker expires
+        if not cache.add(f"orderbook:refreshing:{symbol}", True, timeout=max(1, math.ceil(max_age))):
+            return
+        app = current_app._get_current_object()
+
+        def revalidate():
+            with app.app_context():
+                try:
+                    order_book_flights.do(symbol, lambda: OrderBookService.refresh_snapshot(symbol))
+                except Exception as e:
+                    OrderBookService._mark_unavailable(symbol, max_age)
+                    app.logger.warning(f"Order book refresh failed for {symbol}, serving the stale snapshot: {str(e)}")
+
+        threading.Thread(target=revalidate, name='orderbook-revalidate', daemon=True).start()
+
+    MAX_MATCH_ATTEMPTS = 3  # Book reloads allowed when another process changed the pair meanwhile
+
+    @staticmethod
+    def batch_matching() -> bool:
+        """Whether limit orders are queued for the batch matcher instead of matched in the request"""
+        return current_app.config.get('ORDER_MATCHING_MODE', 'sync') == 'batch'
 
     @staticmethod
     def place_limit_order(user_id: int, base_asset: Asset, quote_asset: Asset,
                          amount: Decimal, price: Decimal, side: str) -> OrderBook:
-        """Place a limit order in the order book"""
+        """
+        Place a limit order and match it against the pair's book. In batch matching
+        mode the order is only queued (status 'pending') for the matching worker.
+        """
         if side not in ['buy', 'sell']:
             raise ValueError("Invalid order side. Must be 'buy' or 'sell'")
             
         if amount <= Decimal('0') or price <= Decimal('0'):
             raise ValueError("Amount and price must be positive")
 
-        # Create order book entry
-        order = OrderBook(
+        # The order must be covered at its limit price, fills can only be cheaper
+        funding_asset_id = quote_asset.id if side == 'buy' else base_asset.id
+        required = amount * price if side == 'buy' else amount
+        if CryptoSwapService.get_user_balance(user_id, funding_asset_id) < required:
+            raise ValueError("Insufficient balance")
+
+        order_fields = dict(
             user_id=user_id,
             base_asset_id=base_asset.id,
             quote_asset_id=quote_asset.id,
             order_type='limit',
             side=side,
             amount=amount,
-            price=price,
-            status='open'
+            price=price
         )
-        db.session.add(order)
-        db.session.commit()
-
-        # Try to match the order
-        OrderBookService.match_orders(base_asset.id, quote_asset.id)
-
-        return order
-
-    @staticmethod
-    def match_orders(base_asset_id: int, quote_asset_id: int):
-        """Match open orders in the order book"""
-        # Get highest buy order
-        buy_order = OrderBook.query.filter_by(
-            base_asset_id=base_asset_id,
-            quote_asset_id=quote_asset_id,
-            side='buy',
-            status='open'
-        ).order_by(OrderBook.price.desc()).first()
-
-        # Get lowest sell order
-        sell_order = OrderBook.query.filter_by(
-            base_asset_id=base_asset_id,
-            quote_asset_id=quote_asset_id,
-            side='sell',
-            status='open'
-        ).order_by(OrderBook.price.asc()).first()
-
-        # If no matching orders, return
-        if not buy_order or not sell_order or buy_order.price < sell_order.price:
-            return
+        if OrderBookService.batch_matching():
+            order = OrderBook(status='pending', **order_fields)
+            db.session.add(order)
+            db.session.commit()
+            return order
 
-        # Determine trade amount (minimum of both orders)
-        trade_amount = min(buy_order.amount, sell_order.amount)
-        trade_price = sell_order.price  # Use sell order price for execution
+        book = matching_engine.book(base_asset.id, quote_asset.id)
+        with book.lock:
+            for _ in range(OrderBookService.MAX_MATCH_ATTEMPTS):
+                # Held until commit, so the book is synced after any other process's order
+                OrderBookService._lock_pair(book)
+                OrderBookService._sync_book(book)
+                order = OrderBook(status='open', **order_fields)
+                try:
+                    db.session.add(order)
+                    fills, unfunded = OrderBookService._fill_order(book, order)
+                    db.session.commit()
+                except StaleOrderBookError:
+                    # A resting order was filled or cancelled by another process, reload and replan
+                    db.session.rollback()
+                    book.loaded = False
+                    continue
+                except Exception:
+                    db.session.rollback()
+                    raise
+                OrderBookService._apply_to_book(book, order, fills, unfunded)
+                OrderBookService.invalidate_local_book(book.base_asset_id, book.quote_asset_id)
+                return order
+        raise ValueError("Order book is busy, please try again")
+
+    @staticmethod
+    def match_pending_orders(limit: int = 200) -> Dict[str, int]:
+        """
+        Match up to limit queued orders, oldest first, and persist all of their fills
+        in one transaction. If that transaction fails, the orders are retried one by
+        one so a single bad order can't hold up the queue. Returns counts of orders
+        processed, fills made and orders rejected.
+        """
+        pending = OrderBookService.pending_orders_query(limit).with_for_update().all()
+        stats = {'orders': len(pending), 'fills': 0, 'rejected': 0}
+        if not pending:
+            db.session.rollback()
+            return stats
 
+        known = {order.id: order for order in pending}
+        available = {}
+        books = {}
         try:
-            # Execute the trade
-            tx_pair = WalletService.transfer(
-                user_id=buy_order.user_id,
-                from_asset_symbol=quote_asset.symbol,
-                to_asset_symbol=base_asset.symbol,
-                amount=trade_amount * trade_price
-            )
+            for order in pending:
+                book = books.get((order.base_asset_id, order.quote_asset_id))
+                if book is None:
+                    book = books[(order.base_asset_id, order.quote_asset_id)] = matching_engine.book(
+                        order.base_asset_id, order.quote_asset_id)
+                    OrderBookService._sync_book(book)
+                with book.lock:
+                    if not OrderBookService._reserve_order_funds(order, available):
+                        order.status = 'rejected'
+                        stats['rejected'] += 1
+                        continue
+                    order.status = 'open'
+                    fills, unfunded = OrderBookService._fill_order(book, order, available, known)
+                    # Later orders of the batch match against this one's result
+                    OrderBookService._apply_to_book(book, order, fills, unfunded)
+                    OrderBookService.invalidate_local_book(book.base_asset_id, book.quote_asset_id)
+                    stats['fills'] += len(fills)
+            db.session.commit()
+            for base_asset_id, quote_asset_id in books:
+                OrderBookService.invalidate_local_book(base_asset_id, quote_asset_id)
+            return stats
+        except Exception as e:
+            db.session.rollback()
+            for book in books.values():
+                book.loaded = False
+            current_app.logger.warning(f"Order batch of {len(pending)} failed, matching one by one: {str(e)}")
 
-            tx_pair = WalletService.transfer(
-                user_id=sell_order.user_id,
-                from_asset_symbol=base_asset.symbol,
-                to_asset_symbol=quote_asset.symbol,
-                amount=trade_amount
-            )
+        stats = {'orders': len(pending), 'fills': 0, 'rejected': 0}
+        for order_id in known:
+            order = OrderBook.query.filter_by(id=order_id, status='pending').first()
+            if order is None:
+                continue
+            book = matching_engine.book(order.base_asset_id, order.quote_asset_id)
+            with book.lock:
+                if not OrderBookService._reserve_order_funds(order, {}):
+                    order.status = 'rejected'
+                    db.session.commit()
+                    stats['rejected'] += 1
+                    current_app.logger.info(f"Order {order_id} rejected: its owner no longer covers it")
+                    continue
+                try:
+                    OrderBookService._sync_book(book)
+                    order.status = 'open'
+                    fills, unfunded = OrderBookService._fill_order(book, order)
+                    db.session.commit()
+                    OrderBookService._apply_to_book(book, order, fills, unfunded)
+                    OrderBookService.invalidate_local_book(book.base_asset_id, book.quote_asset_id)
+                    stats['fills'] += len(fills)
+                except Exception as e:
+                    db.session.rollback()
+                    book.loaded = False
+                    OrderBook.query.filter_by(id=order_id, status='pending').update({'status': 'rejected'})
+                    db.session.commit()
+                    stats['rejected'] += 1
+                    current_app.logger.warning(f"Order {order_id} rejected by the matcher: {str(e)}")
+        return stats
 
-            # Update order amounts
-            buy_order.amount -= trade_amount
-            sell_order.amount -= trade_amount
-
-            # Close orders if fully filled
-            if buy_order.amount == Decimal('0'):
-                buy_order.status = 'filled'
-            if sell_order.amount == Decimal('0'):
-                sell_order.status = 'filled'
-
-            # Create trade records
-            TradeOrder(
-                user_id=buy_order.user_id,
-                base_asset_id=base_asset_id,
-                quote_asset_id=quote_asset_id,
-                order_type='limit',
-                side='buy',
-                amount=trade_amount,
-                price=trade_price,
-                status='filled'
-            )
+    # ----- Order book queries -----
+    # Kept in one place so `flask explain-order-indexes` checks the plans of the exact
+    # statements the matcher and the cancel path run
 
-            TradeOrder(
-                user_id=sell_order.user_id,
-                base_asset_id=base_asset_id,
-                quote_asset_id=quote_asset_id,
-                order_type='limit',
-                side='sell',
-                amount=trade_amount,
-                price=trade_price,
-                status='filled'
+    @staticmethod
+    def open_orders_query(base_asset_id: int, quote_asset_id: int):
+        """A pair's open orders in time priority, as loaded into the matching engine"""
+        return db.session.query(
+            OrderBook.id, OrderBook.user_id, OrderBook.side, OrderBook.price, OrderBook.amount
+        ).filter(
+            OrderBook.base_asset_id == base_asset_id,
+            OrderBook.quote_asset_id == quote_asset_id,
+            OrderBook.status == 'open'
+        ).order_by(OrderBook.id)
+
+    @staticmethod
+    def newest_open_order_query(base_asset_id: int, quote_asset_id: int):
+        return db.session.query(func.max(OrderBook.id)).filter(
+            OrderBook.base_asset_id == base_asset_id,
+            OrderBook.quote_asset_id == quote_asset_id,
+            OrderBook.status == 'open'
+        )
+
+    @staticmethod
+    def local_depth_query(base_asset_id: int, quote_asset_id: int):
+        return db.session.query(
+            OrderBook.side,
+            OrderBook.price,
+            func.sum(OrderBook.amount).label('amount')
+        ).filter(
+            OrderBook.base_asset_id == base_asset_id,
+            OrderBook.quote_asset_id == quote_asset_id,
+            OrderBook.status == 'open'
+        ).group_by(OrderBook.side, OrderBook.price)
+
+    @staticmethod
+    def pending_orders_query(limit: int):
+        """The batch matcher's queue, oldest first"""
+        return OrderBook.query.filter_by(status='pending').order_by(OrderBook.id).limit(limit)
+
+    @staticmethod
+    def cancellable_order_query(user_id: int, order_id: int):
+        return OrderBook.query.filter(
+            OrderBook.id == order_id,
+            OrderBook.user_id == user_id,
+            OrderBook.status.in_(['open', 'pending'])
+        )
+
+    @staticmethod
+    def load_book(book: PairBook):
+        """Rebuild a pair's in-memory book from its open order_book rows, oldest first"""
+        rows = OrderBookService.open_orders_query(book.base_asset_id, book.quote_asset_id).all()
+        book.replace((row.id, row.user_id, row.side, Decimal(str(row.price)), Decimal(str(row.amount)))
+                     for row in rows)
+
+    @staticmethod
+    def _lock_pair(book: PairBook):
+        """
+        Serialize sync-mode matching of a pair across processes until the current
+        transaction ends: a transaction-scoped advisory lock on PostgreSQL, the base
+        asset's row elsewhere. Without it, two crossing orders placed at once in
+        different workers each miss the other's uncommitted row and both rest.
+        SQLite has no row locks, so several workers on SQLite need batch mode,
+        whose single matcher can't race itself.
+        """
+        if db.session.get_bind().dialect.name == 'postgresql':
+            db.session.execute(
+                text('SELECT pg_advisory_xact_lock(:base_asset_id, :quote_asset_id)'),
+                {'base_asset_id': book.base_asset_id, 'quote_asset_id': book.quote_asset_id}
             )
+        else:
+            db.session.query(Asset.id).filter(Asset.id == book.base_asset_id).with_for_update().first()
 
-            db.session.commit()
+    @staticmethod
+    def _sync_book(book: PairBook):
+        """Load the book on first use, and reload it when another process has placed an order since"""
+        if book.loaded:
+            newest = OrderBookService.newest_open_order_query(book.base_asset_id, book.quote_asset_id).scalar()
+            if newest is None or newest <= book.last_order_id:
+                return
+        OrderBookService.load_book(book)
 
-            # Recursively match remaining orders
-            OrderBookService.match_orders(base_asset_id, quote_asset_id)
+    @staticmethod
+    def _fill_order(book: PairBook, order: OrderBook, available: Optional[Dict] = None,
+                    known: Optional[Dict[int, OrderBook]] = None) -> Tuple[List[Fill], List[int]]:
+        """
+        Match an order against the book and write its fills, the maker updates and
+        its own remaining amount to the session, without committing. Resting orders
+        whose owner can no longer cover them are cancelled instead of filled.
+        Returns the fills and cancelled order ids, to apply to the book once persisted.
+        """
+        side, price, amount = order.side, order.price, order.amount
+        fills, unfunded = OrderBookService._plan_funded_fills(book, side, price, amount, available, known or ())
+        makers = OrderBookService._lock_makers(book, [fill.maker.order_id for fill in fills] + unfunded, known)
 
-        except Exception as e:
-            db.session.rollback()
-            raise e
+        for order_id in unfunded:
+            makers[order_id].status = 'cancelled'
+
+        filled = Decimal('0')
+        for fill in fills:
+            maker = makers[fill.maker.order_id]
+            maker.amount -= fill.amount
+            if maker.amount == Decimal('0'):
+                maker.status = 'filled'
+            if side == 'buy':
+                buyer_id, seller_id = order.user_id, maker.user_id
+            else:
+                buyer_id, seller_id = maker.user_id, order.user_id
+            OrderBookService._record_fill(book, buyer_id, seller_id, fill.amount, fill.price)
+            filled += fill.amount
+
+        # The order row keeps its unfilled amount, like the resting orders
+        order.amount = amount - filled
+        if order.amount == Decimal('0'):
+            order.status = 'filled'
+        return fills, unfunded
+
+    @staticmethod
+    def _apply_to_book(book: PairBook, order: OrderBook, fills: List[Fill], unfunded: List[int]):
+        for order_id in unfunded:
+            book.remove(order_id)
+        book.apply(fills)
+        book.add(order.id, order.user_id, order.side, order.price, order.amount)
+
+    @staticmethod
+    def _load_balances(available: Dict, user_ids, asset_id: int):
+        """Fill in the spendable balance of users not yet in available, in one query"""
+        missing = {user_id for user_id in user_ids if (user_id, asset_id) not in available}
+        if not missing:
+            return
+        balances = dict(db.session.query(Holding.user_id, Holding.balance).filter(
+            Holding.user_id.in_(missing),
+            Holding.asset_id == asset_id,
+            Holding.deleted_at.is_(None)
+        ).all())
+        for user_id in missing:
+            available[(user_id, asset_id)] = balances.get(user_id, Decimal('0'))
+
+    @staticmethod
+    def _reserve_order_funds(order: OrderBook, available: Dict) -> bool:
+        """Set aside what an order needs at its limit price, False if its owner can't cover it"""
+        asset_id = order.quote_asset_id if order.side == 'buy' else order.base_asset_id
+        needed = order.amount * order.price if order.side == 'buy' else order.amount
+        OrderBookService._load_balances(available, [order.user_id], asset_id)
+        if available[(order.user_id, asset_id)] < needed:
+            return False
+        available[(order.user_id, asset_id)] -= needed
+        return True
+
+    @staticmethod
+    def _plan_funded_fills(book: PairBook, side: str, price: Decimal, amount: Decimal,
+                           available: Optional[Dict] = None,
+                           reserved=()) -> Tuple[List[Fill], List[int]]:
+        """
+        Plan the fills, passing over resting orders their owners can no longer cover.
+        available maps (user_id, asset_id) to what is still spendable and is debited
+        with the planned fills; without it, balances are read fresh. Resting orders
+        in reserved already had their funds taken out of available when they were
+        queued, so they are filled without checking them again.
+        """
+        available = {} if available is None else available
+        # Makers sell base to a buyer, or pay quote to a seller
+        maker_asset_id = book.base_asset_id if side == 'buy' else book.quote_asset_id
+        unfunded = []
+        while True:
+            fills = book.plan(side, price, amount, skip=unfunded)
+            OrderBookService._load_balances(available, {fill.maker.user_id for fill in fills}, maker_asset_id)
+
+            remaining = {}
+            short = []
+            for fill in fills:
+                if fill.maker.order_id in reserved:
+                    continue
+                key = (fill.maker.user_id, maker_asset_id)
+                needed = fill.amount if side == 'buy' else fill.amount * fill.price
+                balance = remaining.get(key, available[key])
+                if balance < needed:
+                    short.append(fill.maker.order_id)
+                else:
+                    remaining[key] = balance - needed
+            if not short:
+                available.update(remaining)
+                return fills, unfunded
+            unfunded.extend(short)
+
+    @staticmethod
+    def _lock_makers(book: PairBook, order_ids: List[int],
+                     known: Optional[Dict[int, OrderBook]] = None) -> Dict[int, OrderBook]:
+        """Lock the resting orders about to change, checking the book still agrees with them"""
+        makers = {order_id: known[order_id] for order_id in order_ids if known and order_id in known}
+        missing = [order_id for order_id in order_ids if order_id not in makers]
+        if missing:
+            rows = OrderBook.query.filter(OrderBook.id.in_(missing)).order_by(OrderBook.id).with_for_update().all()
+            makers.update((row.id, row) for row in rows)
+        for order_id in order_ids:
+            row = makers.get(order_id)
+            resting = book.get(order_id)
+            if row is None or resting is None or row.status != 'open' or row.amount != resting.remaining:
+                raise StaleOrderBookError(f"Order {order_id} changed outside this book")
+        return makers
+
+    @staticmethod
+    def _record_fill(book: PairBook, buyer_id: int, seller_id: int, amount: Decimal, price: Decimal):
+        """Settle one fill: the buyer pays quote for base and the seller the reverse"""
+        now = datetime.utcnow()
+        cost = amount * price
+        for user_id, bought_id, bought, sold_id, sold, side in (
+            (buyer_id, book.base_asset_id, amount, book.quote_asset_id, cost, 'buy'),
+            (seller_id, book.quote_asset_id, cost, book.base_asset_id, amount, 'sell'),
+        ):
+            db.session.add(Transaction(
+                user_id=user_id,
+                asset_id=sold_id,
+                tx_type=TransactionType.TRADE_SELL,
+                amount=sold,
+                quote_asset_id=bought_id,
+                price=bought / sold,
+                timestamp=now,
+                source=TRANSACTION_SOURCE_ORDER_BOOK
+            ))
+            db.session.add(Transaction(
+                user_id=user_id,
+                asset_id=bought_id,
+                tx_type=TransactionType.TRADE_BUY,
+                amount=bought,
+                quote_asset_id=sold_id,
+                price=sold / bought,
+                timestamp=now,
+                source=TRANSACTION_SOURCE_ORDER_BOOK
+            ))
+            db.session.add(TradeOrder(
+                user_id=user_id,
+                base_asset_id=book.base_asset_id,
+                quote_asset_id=book.quote_asset_id,
+                order_type='limit',
+                side=side,
+                amount=amount,
+                price=price,
+                status='filled'
+            ))
 
     @staticmethod
     def cancel_order(user_id: int, order_id: int) -> bool:
         """Cancel an open order"""
-        order = OrderBook.query.filter_by(
-            id=order_id,
-            user_id=user_id,
-            status='open'
-        ).first()
+        order = OrderBookService.cancellable_order_query(user_id, order_id).first()
 
         if not order:
             return False
 
-        order.status = 'cancelled'
-        db.session.commit()
+        book = matching_engine.book(order.base_asset_id, order.quote_asset_id)
+        with book.lock:
+            order.status = 'cancelled'
+            db.session.commit()
+            book.remove(order.id)
+        OrderBookService.invalidate_local_book(order.base_asset_id, order.quote_asset_id)
         return True 
+
 class TradingService:
     @staticmethod
     def get_market_price(base_asset: Asset, quote_asset: Asset) -> Decimal:
         """Get latest market price from exchange rates"""
-        rate = ExchangeRate.query.filter_by(
-            base_asset_id=base_asset.id,
-            quote_asset_id=quote_asset.id
-        ).order_by(ExchangeRate.timestamp.desc()).first()
+        rate = RateService.get_rate(base_asset.id, quote_asset.id)
         
         if not rate:
             raise ValueError(f"No market price available for {base_asset.symbol}/{quote_asset.symbol}")
-        return rate.rate
+        return rate
 
     @staticmethod
     def execute_market_order(user_id: int, base_asset: Asset, quote_asset: Asset, 
@@ -384,6 +746,61 @@ class SwapError(Exception):
     pass
 
 
+# Live rate fetches in flight per (from_asset_id, to_asset_id), shared by all requests
+live_rate_flights = SingleFlight()
+
+
+class SwapPricing:
+    """
+    Assets and exchange rate of one swap request, resolved once and passed through
+    validate_swap, calculate_swap_preview and execute_swap so they all see the
+    same price without repeating the lookups
+    """
+
+    def __init__(self, from_asset_id: int, to_asset_id: int, rate: Optional[Decimal] = None,
+                 quote: Optional[Dict] = None):
+        self.from_asset_id = from_asset_id
+        self.to_asset_id = to_asset_id
+        self.from_asset = Asset.query.get(from_asset_id)
+        self.to_asset = Asset.query.get(to_asset_id)
+        self.resolved_at = datetime.utcnow()
+        # A locked quote, when the rate comes from (or was saved as) one
+        self.quote = quote
+        self._rate = rate
+        self._rate_resolved = rate is not None
+
+    @classmethod
+    def from_quote(cls, quote: Dict) -> 'SwapPricing':
+        return cls(quote['from_asset_id'], quote['to_asset_id'], rate=Decimal(quote['rate']), quote=quote)
+
+    @property
+    def quote_id(self) -> Optional[str]:
+        return self.quote['quote_id'] if self.quote else None
+
+    @property
+    def assets_found(self) -> bool:
+        return self.from_asset is not None and self.to_asset is not None
+
+    @property
+    def rate(self) -> Optional[Decimal]:
+        """The swap rate (live fetching if needed, then the demo fallback), resolved on first use"""
+        if not self._rate_resolved:
+            rate = None
+            if self.assets_found:
+                rate = CryptoSwapService.get_exchange_rate(
+                    self.from_asset_id, self.to_asset_id, fetch_live=True,
+                    from_asset=self.from_asset, to_asset=self.to_asset
+                )
+                if not rate:
+                    rate = CryptoSwapService._fallback_rate_for(self.from_asset, self.to_asset)
+            self._rate = rate
+            self._rate_resolved = True
+        return self._rate
+
+    def matches(self, from_asset_id: int, to_asset_id: int) -> bool:
+        return self.from_asset_id == from_asset_id and self.to_asset_id == to_asset_id
+
+
 class CryptoSwapService:
     """Service class for handling crypto swap operations"""
 
@@ -409,68 +826,31 @@ class CryptoSwapService:
             from_id = from_asset.coingecko_id
             to_id = to_asset.coingecko_id
             
-            # First attempt: Direct conversion
-            url = "https://api.coingecko.com/api/v3/simple/price"
-            params = {
-                'ids': from_id,
-                'vs_currencies': to_id,
-                'precision': 18
-            }
+            # One request covers both the direct quote and the USD legs for a cross rate
+            # (the shared client pools connections, rate-limits and coalesces duplicates)
+            vs_currencies = [to_id] if to_id == 'usd' else [to_id, 'usd']
+            # This runs inside a request, so it fails fast instead of queueing behind the rate limit
+            data = get_coingecko_client().simple_price(
+                [from_id, to_id], vs_currencies,
+                max_wait=current_app.config.get('COINGECKO_REQUEST_MAX_WAIT', 2), precision=18
+            )
             
-            try:
-                response = requests.get(url, params=params, timeout=10)
-                response.raise_for_status()
-                data = response.json()
-                
-                if from_id in data and to_id in data[from_id]:
-                    rate = Decimal(str(data[from_id][to_id]))
-                    current_app.logger.info(f"Fetched direct rate: {from_asset.symbol}/{to_asset.symbol} = {rate}")
-                    return rate
-            except Exception:
-                # We'll try alternative methods if direct fails
-                pass
+            # First attempt: Direct conversion
+            if from_id in data and to_id in data[from_id]:
+                rate = Decimal(str(data[from_id][to_id]))
+                current_app.logger.info(f"Fetched direct rate: {from_asset.symbol}/{to_asset.symbol} = {rate}")
+                return rate
             
             # Second attempt: Conversion via USD
-            usd_asset = Asset.query.filter_by(symbol='USD').first()
-            if usd_asset and usd_asset.coingecko_id:
-                # Get both rates against USD in a single API call
-                url_usd = "https://api.coingecko.com/api/v3/simple/price"
-                params_usd = {
-                    'ids': f"{from_id},{to_id}",
-                    'vs_currencies': 'usd',
-                    'precision': 18
-                }
+            if (from_id in data and 'usd' in data[from_id] and
+                to_id in data and 'usd' in data[to_id]):
+                from_usd_price = Decimal(str(data[from_id]['usd']))
+                to_usd_price = Decimal(str(data[to_id]['usd']))
                 
-                try:
-                    response_usd = requests.get(url_usd, params=params_usd, timeout=10)
-                    response_usd.raise_for_status()
-                    data_usd = response_usd.json()
-                    
-                    if (from_id in data_usd and 'usd' in data_usd[from_id] and 
-                        to_id in data_usd and 'usd' in data_usd[to_id]):
-                        
-                        from_usd_price = Decimal(str(data_usd[from_id]['usd']))
-                        to_usd_price = Decimal(str(data_usd[to_id]['usd']))
-                        
-                        if to_usd_price > 0:
-                            rate = from_usd_price / to_usd_price
-                            current_app.logger.info(f"Calculated cross rate via USD: {from_asset.symbol}/{to_asset.symbol} = {rate}")
-                            return rate
-                except Exception as e:
-                    current_app.logger.warning(f"USD conversion failed: {str(e)}")
-            
-            # Final fallback: Try recursive USD conversion
-            if usd_asset and usd_asset.coingecko_id and to_asset_id != usd_asset.id:
-                try:
-                    from_usd_rate = CryptoSwapService.fetch_live_exchange_rate(from_asset_id, usd_asset.id)
-                    to_usd_rate = CryptoSwapService.fetch_live_exchange_rate(to_asset_id, usd_asset.id)
-                    
-                    if from_usd_rate and to_usd_rate and to_usd_rate > 0:
-                        rate = from_usd_rate / to_usd_rate
-                        current_app.logger.info(f"Calculated recursive rate via USD: {from_asset.symbol}/{to_asset.symbol} = {rate}")
-                        return rate
-                except Exception as e:
-                    current_app.logger.warning(f"Recursive USD conversion failed: {str(e)}")
+                if to_usd_price > 0:
+                    rate = from_usd_price / to_usd_price
+                    current_app.logger.info(f"Calculated cross rate via USD: {from_asset.symbol}/{to_asset.symbol} = {rate}")
+                    return rate
             
             current_app.logger.warning(f"No rate data available for {from_asset.symbol}/{to_asset.symbol}")
             return None
@@ -482,6 +862,14 @@ class CryptoSwapService:
     @staticmethod
     def store_exchange_rate(from_asset_id: int, to_asset_id: int, rate: Decimal, source: str = "live_api"):
         """Store exchange rate in database for future use"""
+        from_asset = db.session.get(Asset, from_asset_id)
+        to_asset = db.session.get(Asset, to_asset_id)
+        if from_asset and to_asset and AssetType.FIAT not in (from_asset.asset_type, to_asset.asset_type):
+            # Crypto-to-crypto rates are triangulated from the stored fiat legs, a stored
+            # cross row would shadow them, so the fetched rate only lives in this process
+            RateService.record_cross_rate(from_asset_id, to_asset_id, rate, datetime.utcnow())
+            return
+        
         try:
             exchange_rate = ExchangeRate(
                 base_asset_id=from_asset_id,
@@ -497,7 +885,26 @@ class CryptoSwapService:
             db.session.rollback()
     
     @staticmethod
-    def get_exchange_rate(from_asset_id: int, to_asset_id: int, fetch_live: bool = True) -> Optional[Decimal]:
+    def _fetch_and_store_live_rate(from_asset_id: int, to_asset_id: int, recent_cutoff: datetime) -> Optional[Decimal]:
+        """Fetch and store a live rate, unless a flight that just finished already stored a recent one"""
+        latest_rate = RateService.get_latest_rate(from_asset_id, to_asset_id)
+        if latest_rate and latest_rate.timestamp >= recent_cutoff:
+            return latest_rate.rate
+        
+        live_rate = CryptoSwapService.fetch_live_exchange_rate(from_asset_id, to_asset_id)
+        if live_rate:
+            # Store the fetched rate for future use
+            CryptoSwapService.store_exchange_rate(from_asset_id, to_asset_id, live_rate, "coingecko_api")
+        return live_rate
+    
+    @staticmethod
+    def live_fetch_stats() -> Dict[str, int]:
+        """Issued vs coalesced live rate fetches since the process started"""
+        return live_rate_flights.stats()
+    
+    @staticmethod
+    def get_exchange_rate(from_asset_id: int, to_asset_id: int, fetch_live: bool = True,
+                          from_asset: Optional[Asset] = None, to_asset: Optional[Asset] = None) -> Optional[Decimal]:
         """
         Get exchange rate between two assets with live fetching capability
         Returns rate where 1 unit of from_asset = rate units of to_asset
@@ -505,8 +912,8 @@ class CryptoSwapService:
         if from_asset_id == to_asset_id:
             return Decimal('1')
         
-        from_asset = Asset.query.get(from_asset_id)
-        to_asset = Asset.query.get(to_asset_id)
+        from_asset = from_asset or Asset.query.get(from_asset_id)
+        to_asset = to_asset or Asset.query.get(to_asset_id)
         
         if not from_asset or not to_asset:
             return None
@@ -514,57 +921,42 @@ class CryptoSwapService:
         # Try to get recent rate from database first (within last 5 minutes)
         recent_cutoff = datetime.utcnow() - timedelta(minutes=5)
         
-        # Try direct rate
-        recent_rate = ExchangeRate.query.filter_by(
-            base_asset_id=from_asset_id,
-            quote_asset_id=to_asset_id
-        ).filter(
-            ExchangeRate.timestamp >= recent_cutoff
-        ).order_by(ExchangeRate.timestamp.desc()).first()
+        # Latest known rates in both directions
+        latest_rate = RateService.get_latest_rate(from_asset_id, to_asset_id)
+        latest_inverse = RateService.get_latest_rate(to_asset_id, from_asset_id)
         
-        if recent_rate:
-            current_app.logger.info(f"Using recent cached rate: {from_asset.symbol}/{to_asset.symbol} = {recent_rate.rate}")
-            return recent_rate.rate
+        # Try direct rate
+        if latest_rate and latest_rate.timestamp >= recent_cutoff:
+            current_app.logger.info(f"Using recent cached rate: {from_asset.symbol}/{to_asset.symbol} = {latest_rate.rate}")
+            return latest_rate.rate
         
         # Try inverse rate
-        recent_inverse = ExchangeRate.query.filter_by(
-            base_asset_id=to_asset_id,
-            quote_asset_id=from_asset_id
-        ).filter(
-            ExchangeRate.timestamp >= recent_cutoff
-        ).order_by(ExchangeRate.timestamp.desc()).first()
-        
-        if recent_inverse and recent_inverse.rate > 0:
-            rate = Decimal('1') / recent_inverse.rate
+        if latest_inverse and latest_inverse.timestamp >= recent_cutoff and latest_inverse.rate > 0:
+            rate = Decimal('1') / latest_inverse.rate
             current_app.logger.info(f"Using recent cached inverse rate: {from_asset.symbol}/{to_asset.symbol} = {rate}")
             return rate
         
-        # If no recent rate and live fetching is enabled, fetch from API
-        if fetch_live:
-            live_rate = CryptoSwapService.fetch_live_exchange_rate(from_asset_id, to_asset_id)
+        # If no recent rate and live fetching is enabled, fetch from API. Concurrent
+        # callers for the same pair share one fetch, which stores the rate once.
+        # With the price streamer running, rates are pushed and requests never fetch.
+        if fetch_live and not current_app.config.get('PRICE_STREAMER_ENABLED'):
+            live_rate, shared = live_rate_flights.do(
+                (from_asset_id, to_asset_id),
+                lambda: CryptoSwapService._fetch_and_store_live_rate(from_asset_id, to_asset_id, recent_cutoff)
+            )
             if live_rate:
-                # Store the fetched rate for future use
-                CryptoSwapService.store_exchange_rate(from_asset_id, to_asset_id, live_rate, "coingecko_api")
+                if shared:
+                    current_app.logger.info(f"Joined in-flight rate fetch: {from_asset.symbol}/{to_asset.symbol} = {live_rate}")
                 return live_rate
         
         # Fallback to any available rate (even if older)
-        fallback_rate = ExchangeRate.query.filter_by(
-            base_asset_id=from_asset_id,
-            quote_asset_id=to_asset_id
-        ).order_by(ExchangeRate.timestamp.desc()).first()
-        
-        if fallback_rate:
-            current_app.logger.warning(f"Using older cached rate: {from_asset.symbol}/{to_asset.symbol} = {fallback_rate.rate}")
-            return fallback_rate.rate
+        if latest_rate:
+            current_app.logger.warning(f"Using older cached rate: {from_asset.symbol}/{to_asset.symbol} = {latest_rate.rate}")
+            return latest_rate.rate
         
         # Try fallback inverse rate
-        fallback_inverse = ExchangeRate.query.filter_by(
-            base_asset_id=to_asset_id,
-            quote_asset_id=from_asset_id
-        ).order_by(ExchangeRate.timestamp.desc()).first()
-        
-        if fallback_inverse and fallback_inverse.rate > 0:
-            rate = Decimal('1') / fallback_inverse.rate
+        if latest_inverse and latest_inverse.rate > 0:
+            rate = Decimal('1') / latest_inverse.rate
             current_app.logger.warning(f"Using older cached inverse rate: {from_asset.symbol}/{to_asset.symbol} = {rate}")
             return rate
         
@@ -627,23 +1019,94 @@ class CryptoSwapService:
         
     #     return None
     
+    @staticmethod
+    def price_swap(from_asset_id: int, to_asset_id: int) -> SwapPricing:
+        """Start the pricing snapshot for a swap request"""
+        return SwapPricing(from_asset_id, to_asset_id)
+    
+    @staticmethod
+    def _quote_ttl() -> int:
+        return current_app.config.get('SWAP_QUOTE_TTL', 15)
+    
+    @staticmethod
+    def _quote_pair_key(from_asset_id: int, to_asset_id: int, fee_percentage: Decimal) -> str:
+        return f"swap:quote:pair:{from_asset_id}:{to_asset_id}:{fee_percentage.normalize()}"
+    
+    @staticmethod
+    def get_quote(quote_id: str) -> Optional[Dict]:
+        """A live swap quote by id, or None once it has expired"""
+        quote = cache.get(f"swap:quote:{quote_id}")
+        if quote and quote['expires_at'] > datetime.utcnow():
+            return quote
+        return None
+    
+    @staticmethod
+    def quote_swap(from_asset_id: int, to_asset_id: int,
+                   fee_percentage: Decimal = Decimal('0.001')) -> SwapPricing:
+        """
+        Pricing locked into a short-lived quote. Previews of the same pair and fee
+        share the quote for the first half of its lifetime, so repeated previews skip
+        rate resolution while every preview still leaves time to confirm, and
+        execute_swap honors the quote's rate when given its id.
+        """
+        ttl = CryptoSwapService._quote_ttl()
+        quote_id = cache.get(CryptoSwapService._quote_pair_key(from_asset_id, to_asset_id, fee_percentage))
+        quote = CryptoSwapService.get_quote(quote_id) if quote_id else None
+        if quote and quote['expires_at'] - datetime.utcnow() > timedelta(seconds=ttl / 2):
+            return SwapPricing.from_quote(quote)
+        
+        pricing = CryptoSwapService.price_swap(from_asset_id, to_asset_id)
+        if pricing.rate:
+            pricing.quote = {
+                'quote_id': uuid.uuid4().hex,
+                'from_asset_id': from_asset_id,
+                'to_asset_id': to_asset_id,
+                'rate': str(pricing.rate),
+                'fee_percentage': str(fee_percentage),
+                'expires_at': datetime.utcnow() + timedelta(seconds=ttl),
+            }
+            cache.set(f"swap:quote:{pricing.quote_id}", pricing.quote, timeout=ttl)
+            cache.set(
+                CryptoSwapService._quote_pair_key(from_asset_id, to_asset_id, fee_percentage),
+                pricing.quote_id, timeout=ttl
+            )
+        return pricing
+    
+    @staticmethod
+    def pricing_from_quote(quote_id: str, from_asset_id: int, to_asset_id: int,
+                           fee_percentage: Decimal) -> SwapPricing:
+        """Pricing for executing a previewed quote; the quote must still be live and match the swap"""
+        quote = CryptoSwapService.get_quote(quote_id)
+        if not quote:
+            raise SwapError("Swap quote has expired, please preview the swap again")
+        if (quote['from_asset_id'], quote['to_asset_id']) != (from_asset_id, to_asset_id) or \
+                Decimal(quote['fee_percentage']) != fee_percentage:
+            raise SwapError("Swap quote does not match this swap, please preview the swap again")
+        return SwapPricing.from_quote(quote)
+    
+    @staticmethod
+    def _pricing_for(from_asset_id: int, to_asset_id: int, pricing: Optional[SwapPricing]) -> SwapPricing:
+        if pricing is None or not pricing.matches(from_asset_id, to_asset_id):
+            return CryptoSwapService.price_swap(from_asset_id, to_asset_id)
+        return pricing
+    
     @staticmethod
     def calculate_swap_preview(from_asset_id: int, to_asset_id: int, 
-                             from_amount: Decimal, fee_percentage: Decimal = Decimal('0.001')) -> Dict:
+                             from_amount: Decimal, fee_percentage: Decimal = Decimal('0.001'),
+                             pricing: Optional[SwapPricing] = None) -> Dict:
         """Calculate swap preview including fees with live rate fetching"""
-        from_asset = Asset.query.get(from_asset_id)
-        to_asset = Asset.query.get(to_asset_id)
+        pricing = CryptoSwapService._pricing_for(from_asset_id, to_asset_id, pricing)
+        from_asset = pricing.from_asset
+        to_asset = pricing.to_asset
         
         if not from_asset or not to_asset:
             raise SwapError("Asset not found")
         
-        # Fetch live rate (this will try live API if no recent cached rate)
-        rate = CryptoSwapService.get_exchange_rate(from_asset_id, to_asset_id, fetch_live=True)
+        # Live rate (tries the live API if no recent cached rate, then a simulated
+        # rate for common pairs), resolved once per request
+        rate = pricing.rate
         if not rate:
-            # If live fetch fails, try with a simulated rate for common pairs
-            rate = CryptoSwapService._get_fallback_rate(from_asset_id, to_asset_id)
-            if not rate:
-                raise SwapError(f"Exchange rate not available for {from_asset.symbol}/{to_asset.symbol}")
+            raise SwapError(f"Exchange rate not available for {from_asset.symbol}/{to_asset.symbol}")
         
         # Calculate amounts
         fee_amount = from_amount * fee_percentage
@@ -658,6 +1121,8 @@ class CryptoSwapService:
             'fee_amount': fee_amount,
             'fee_percentage': fee_percentage * 100,
             'net_to_amount': net_to_amount,
+            'quote_id': pricing.quote_id,
+            'quote_expires_at': pricing.quote['expires_at'] if pricing.quote else None,
         }
     
     @staticmethod
@@ -666,9 +1131,12 @@ class CryptoSwapService:
         Provide fallback rates for common trading pairs when API fails
         This is just for demo purposes - in production you'd want better fallback logic
         """
-        from_asset = Asset.query.get(from_asset_id)
-        to_asset = Asset.query.get(to_asset_id)
-        
+        return CryptoSwapService._fallback_rate_for(
+            Asset.query.get(from_asset_id), Asset.query.get(to_asset_id)
+        )
+    
+    @staticmethod
+    def _fallback_rate_for(from_asset: Optional[Asset], to_asset: Optional[Asset]) -> Optional[Decimal]:
         if not from_asset or not to_asset:
             return None
         
@@ -695,7 +1163,7 @@ class CryptoSwapService:
     
     @staticmethod
     def validate_swap(user_id: int, from_asset_id: int, to_asset_id: int, 
-                     from_amount: Decimal) -> Tuple[bool, str]:
+                     from_amount: Decimal, pricing: Optional[SwapPricing] = None) -> Tuple[bool, str]:
         """Validate if swap can be executed"""
         if from_asset_id == to_asset_id:
             return False, "Cannot swap asset to itself"
@@ -704,8 +1172,9 @@ class CryptoSwapService:
             return False, "Amount must be positive"
         
         # Check assets exist
-        from_asset = Asset.query.get(from_asset_id)
-        to_asset = Asset.query.get(to_asset_id)
+        pricing = CryptoSwapService._pricing_for(from_asset_id, to_asset_id, pricing)
+        from_asset = pricing.from_asset
+        to_asset = pricing.to_asset
         
         if not from_asset or not to_asset:
             return False, "Asset not found"
@@ -718,23 +1187,25 @@ class CryptoSwapService:
         if user_balance < from_amount:
             return False, f"Insufficient {from_asset.symbol} balance"
         
-        # Check exchange rate (with live fetching)
-        rate = CryptoSwapService.get_exchange_rate(from_asset_id, to_asset_id, fetch_live=True)
-        if not rate:
-            # Try fallback rate
-            rate = CryptoSwapService._get_fallback_rate(from_asset_id, to_asset_id)
-            if not rate:
-                return False, f"Exchange rate not available for {from_asset.symbol}/{to_asset.symbol}"
+        # Check exchange rate (with live fetching, then the fallback rate)
+        if not pricing.rate:
+            return False, f"Exchange rate not available for {from_asset.symbol}/{to_asset.symbol}"
         
         return True, ""
     
     @staticmethod
     def execute_swap(user_id: int, from_asset_id: int, to_asset_id: int, 
-                    from_amount: Decimal, fee_percentage: Decimal = Decimal('0.001')) -> Dict:
-        """Execute the crypto swap transaction"""
+                    from_amount: Decimal, fee_percentage: Decimal = Decimal('0.001'),
+                    pricing: Optional[SwapPricing] = None, quote_id: Optional[str] = None) -> Dict:
+        """Execute the crypto swap transaction, at the quoted rate when a quote id is given"""
+        # Validation, preview and execution share one pricing snapshot
+        if quote_id:
+            pricing = CryptoSwapService.pricing_from_quote(quote_id, from_asset_id, to_asset_id, fee_percentage)
+        pricing = CryptoSwapService._pricing_for(from_asset_id, to_asset_id, pricing)
+        
         # Validate swap
         is_valid, error_msg = CryptoSwapService.validate_swap(
-            user_id, from_asset_id, to_asset_id, from_amount
+            user_id, from_asset_id, to_asset_id, from_amount, pricing=pricing
         )
         
         if not is_valid:
@@ -742,14 +1213,11 @@ class CryptoSwapService:
         
         # Calculate swap details
         swap_preview = CryptoSwapService.calculate_swap_preview(
-            from_asset_id, to_asset_id, from_amount, fee_percentage
+            from_asset_id, to_asset_id, from_amount, fee_percentage, pricing=pricing
         )
         
         try:
-            # Update holdings
-            CryptoSwapService._update_holding(user_id, from_asset_id, -from_amount)
-            CryptoSwapService._update_holding(user_id, to_asset_id, swap_preview['net_to_amount'])
-            
+            # Holdings are moved from the sell and buy transactions when they are flushed
             # Create sell transaction
             sell_transaction = Transaction(
                 user_id=user_id,
@@ -790,37 +1258,77 @@ class CryptoSwapService:
                 'rate': swap_preview['rate']
             }
             
+        except InsufficientBalanceError:
+            # Another request spent the balance after validation
+            db.session.rollback()
+            raise SwapError(f"Insufficient {swap_preview['from_asset'].symbol} balance")
         except Exception as e:
             db.session.rollback()
             current_app.logger.error(f"Swap execution failed: {str(e)}")
             raise SwapError(f"Swap execution failed: {str(e)}")
     
     @staticmethod
-    def _update_holding(user_id: int, asset_id: int, amount_change: Decimal):
-        """Update user holdings"""
-        holding = Holding.query.filter_by(user_id=user_id, asset_id=asset_id).first()
-        
-        if holding:
-            new_balance = holding.balance + amount_change
-            if new_balance < 0:
-                raise SwapError("Insufficient balance")
-            holding.balance = new_balance
-            holding.updated_at = datetime.utcnow()
+    def get_recent_swaps(user_id: int, limit: int = 10,
+                         before: Optional[Tuple[datetime, int]] = None,
+                         after: Optional[Tuple[datetime, int]] = None) -> list:
+        """
+        Get user's recent swap transactions, newest first. before/after are
+        (timestamp, id) keyset cursors: only swaps older than before, or newer than
+        after, are returned, so any page costs one range scan of limit rows on the
+        partial swap index (order book fills and wallet conversions are trades too,
+        but not swaps, and neither they nor other transactions are in it).
+        """
+        key = tuple_(Transaction.timestamp, Transaction.id)
+        query = Transaction.query.filter(
+            Transaction.user_id == user_id,
+            text(SWAP_ROWS_CONDITION)
+        )
+        if after is not None:
+            # Walk forward from the cursor, then put the page back in newest-first order
+            swaps = query.filter(key > tuple_(*after)).order_by(
+                Transaction.timestamp.asc(), Transaction.id.asc()
+            ).limit(limit).all()
+            return swaps[::-1]
+        if before is not None:
+            query = query.filter(key < tuple_(*before))
+        return query.order_by(Transaction.timestamp.desc(), Transaction.id.desc()).limit(limit).all()
+
+    @staticmethod
+    def get_swap_history_page(user_id: int, per_page: int = 20,
+                              before: Optional[Tuple[datetime, int]] = None,
+                              after: Optional[Tuple[datetime, int]] = None) -> Dict:
+        """
+        One page of swap history around a cursor. Fetches per_page + 1 rows, the
+        extra one only tells whether another page exists in that direction.
+        """
+        swaps = CryptoSwapService.get_recent_swaps(user_id, per_page + 1, before=before, after=after)
+        more = len(swaps) > per_page
+        if after is not None:
+            swaps = swaps[-per_page:] if more else swaps
+            has_prev, has_next = more, True
         else:
-            if amount_change < 0:
-                raise SwapError("No existing holding to deduct from")
-            
-            holding = Holding(
-                user_id=user_id,
-                asset_id=asset_id,
-                balance=amount_change
-            )
-            db.session.add(holding)
-    
+            swaps = swaps[:per_page]
+            has_prev, has_next = before is not None, more
+        return {
+            'transactions': swaps,
+            'has_prev': has_prev and bool(swaps),
+            'has_next': has_next and bool(swaps),
+            'prev_cursor': CryptoSwapService.format_swap_cursor(swaps[0]) if swaps else None,
+            'next_cursor': CryptoSwapService.format_swap_cursor(swaps[-1]) if swaps else None,
+        }
+
     @staticmethod
-    def get_recent_swaps(user_id: int, limit: int = 10) -> list:
-        """Get user's recent swap transactions"""
-        return Transaction.query.filter(
-            Transaction.user_id == user_id,
-            Transaction.tx_type.in_([TransactionType.TRADE_BUY, TransactionType.TRADE_SELL])
-        ).order_by(Transaction.timestamp.desc()).limit(limit).all()
+    def format_swap_cursor(transaction: Transaction) -> str:
+        """Opaque page cursor for a swap row, see parse_swap_cursor"""
+        return f"{transaction.timestamp.isoformat()}_{transaction.id}"
+
+    @staticmethod
+    def parse_swap_cursor(cursor: Optional[str]) -> Optional[Tuple[datetime, int]]:
+        """(timestamp, id) from a page cursor, None if missing or malformed"""
+        if not cursor:
+            return None
+        try:
+            timestamp, _, transaction_id = cursor.rpartition('_')
+            return datetime.fromisoformat(timestamp), int(transaction_id)
+        except ValueError:
+            return None
@@ -2,8 +2,9 @@ from datetime import datetime
 from sqlalchemy import desc
 from sqlalchemy.orm import joinedload
 from sqlalchemy.exc import IntegrityError
-from app.models import User, Transaction, Asset, Holding, TransactionType, AssetType, ExchangeRate, TransactionStatus
+from app.models import User, Transaction, Asset, Holding, TransactionType, AssetType, TransactionStatus, InsufficientBalanceError, TRANSACTION_SOURCE_CONVERSION
 from app.extensions import db
+from app.pricing import RateService
 import qrcode
 from io import BytesIO
 import logging
@@ -12,25 +13,6 @@ from decimal import Decimal
 logger = logging.getLogger(__name__)
 
 class WalletService:
-    @staticmethod
-    def _get_or_create_holding(user_id, asset_id):
-        """Get existing holding or create a new one if it doesn't exist"""
-        holding = Holding.query.filter_by(
-            user_id=user_id,
-            asset_id=asset_id,
-            deleted_at=None
-        ).first()
-        
-        if not holding:
-            holding = Holding(
-                user_id=user_id,
-                asset_id=asset_id,
-                balance=Decimal('0')
-            )
-            db.session.add(holding)
-        
-        return holding
-
     # TODO: Delete
     @staticmethod
     def generate_qr_png(data: str) -> BytesIO:
@@ -119,10 +101,7 @@ class WalletService:
                 notes="Cryptocurrency deposit"
             )
 
-            # Update or create holding
-            holding = WalletService._get_or_create_holding(user_id, asset.id)
-            holding.balance += amount
-
+            # The holding is credited from the transaction when it is flushed
             try:
                 db.session.add(transaction)
                 db.session.commit()
@@ -259,10 +238,7 @@ class WalletService:
             notes="Fiat currency deposit"
         )
 
-        # Update or create holding
-        holding = WalletService._get_or_create_holding(user_id, asset.id)
-        holding.balance += amount
-
+        # The holding is credited from the transaction when it is flushed
         try:
             db.session.add(transaction)
             db.session.commit()
@@ -317,13 +293,15 @@ class WalletService:
             timestamp=datetime.utcnow()
         )
 
-        # Update holding
-        holding.balance -= amount
-
+        # The holding is debited from the transaction when it is flushed
         try:
             db.session.add(transaction)
             db.session.commit()
             return transaction
+        except InsufficientBalanceError:
+            # Another request spent the balance after it was checked
+            db.session.rollback()
+            raise
         except IntegrityError:
             db.session.rollback()
             raise ValueError("Failed to record withdrawal transaction")
@@ -357,11 +335,7 @@ class WalletService:
             raise ValueError("Insufficient balance")
 
         # Get current exchange rate
-        exchange_rate = db.session.query(ExchangeRate).filter_by(
-            base_asset_id=from_asset.id,
-            quote_asset_id=to_asset.id,
-            deleted_at=None
-        ).order_by(ExchangeRate.timestamp.desc()).first()
+        exchange_rate = RateService.get_latest_rate(from_asset.id, to_asset.id)
 
         if not exchange_rate:
             raise ValueError("No exchange rate available for transfer")
@@ -369,37 +343,38 @@ class WalletService:
         # Calculate amount in target asset
         target_amount = amount * exchange_rate.rate
 
-        # Create transactions
+        # Create transactions, the holdings are moved from them when they are flushed
         withdraw_tx = Transaction(
             user_id=user_id,
             asset_id=from_asset.id,
-            tx_type=TransactionType.TRANSFER,
+            tx_type=TransactionType.TRADE_SELL,
             amount=amount,
             quote_asset_id=to_asset.id,
             price=exchange_rate.rate,
-            timestamp=datetime.utcnow()
+            timestamp=datetime.utcnow(),
+            source=TRANSACTION_SOURCE_CONVERSION
         )
 
         deposit_tx = Transaction(
             user_id=user_id,
             asset_id=to_asset.id,
-            tx_type=TransactionType.TRANSFER,
+            tx_type=TransactionType.TRADE_BUY,
             amount=target_amount,
             quote_asset_id=from_asset.id,
             price=1/exchange_rate.rate,
-            timestamp=datetime.utcnow()
+            timestamp=datetime.utcnow(),
+            source=TRANSACTION_SOURCE_CONVERSION
         )
 
-        # Update holdings
-        from_holding.balance -= amount
-        to_holding = WalletService._get_or_create_holding(user_id, to_asset.id)
-        to_holding.balance += target_amount
-
         try:
             db.session.add(withdraw_tx)
             db.session.add(deposit_tx)
             db.session.commit()
             return withdraw_tx, deposit_tx
+        except InsufficientBalanceError:
+            # Another request spent the balance after it was checked
+            db.session.rollback()
+            raise
         except IntegrityError:
             db.session.rollback()
             raise ValueError("Failed to process transfer")
@@ -417,13 +392,9 @@ class WalletService:
             if not transaction:
                 raise ValueError("Pending deposit not found")
             
-            # Update status
+            # Settling the transaction credits the holding when it is flushed
             transaction.status = TransactionStatus.SUCCESS
             
-            # NOW update holdings
-            holding = WalletService._get_or_create_holding(transaction.user_id, transaction.asset_id)
-            holding.balance += transaction.amount
-            
             db.session.commit()
             logger.info(f"Deposit confirmed: transaction_id={transaction_id}, amount={transaction.amount}")
             return transaction
@@ -481,27 +452,8 @@ class WalletService:
             if not sender_holding or sender_holding.balance < amount:
                 raise ValueError("Insufficient balance")
             
-            # Begin transaction
-            # Deduct from sender
-            sender_holding.balance -= amount
-            
-            # Add to recipient (create holding if doesn't exist)
-            recipient_holding = Holding.query.filter_by(
-                user_id=recipient.id,
-                asset_id=asset_id
-            ).first()
-            
-            if recipient_holding:
-                recipient_holding.balance += amount
-            else:
-                recipient_holding = Holding(
-                    user_id=recipient.id,
-                    asset_id=asset_id,
-                    balance=amount
-                )
-                db.session.add(recipient_holding)
-            
-            # Create transaction records
+            # Create transaction records, they debit the sender and credit the
+            # recipient (creating the holding if needed) when they are flushed
             # Outgoing transaction for sender
             sender_transaction = Transaction(
                 user_id=sender_id,
@@ -0,0 +1,62 @@
+"""Add latest exchange rates table
+
+Revision ID: a3f1c9d2e7b4
+Revises: df5085616622
+Create Date: 2026-10-17 09:12:41.208113
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'a3f1c9d2e7b4'
+down_revision = 'df5085616622'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('latest_exchange_rates',
+    sa.Column('base_asset_id', sa.Integer(), nullable=False),
+    sa.Column('quote_asset_id', sa.Integer(), nullable=False),
+    sa.Column('rate', sa.Numeric(precision=30, scale=18), nullable=False),
+    sa.Column('timestamp', sa.DateTime(), nullable=False),
+    sa.Column('source', sa.String(length=50), nullable=True),
+    sa.Column('created_at', sa.DateTime(), nullable=False),
+    sa.Column('updated_at', sa.DateTime(), nullable=True),
+    sa.ForeignKeyConstraint(['base_asset_id'], ['assets.id'], ),
+    sa.ForeignKeyConstraint(['quote_asset_id'], ['assets.id'], ),
+    sa.PrimaryKeyConstraint('base_asset_id', 'quote_asset_id')
+    )
+
+    # Backfill with the newest non-deleted rate of every pair
+    op.execute("""
+        INSERT INTO latest_exchange_rates
+            (base_asset_id, quote_asset_id, rate, timestamp, source, created_at, updated_at)
+        SELECT er.base_asset_id, er.quote_asset_id, er.rate, er.timestamp, er.source,
+               CURRENT_TIMESTAMP, CURRENT_TIMESTAMP
+        FROM exchange_rates er
+        JOIN (
+            SELECT base_asset_id, quote_asset_id, MAX(timestamp) AS timestamp
+            FROM exchange_rates
+            WHERE deleted_at IS NULL
+            GROUP BY base_asset_id, quote_asset_id
+        ) latest
+          ON latest.base_asset_id = er.base_asset_id
+         AND latest.quote_asset_id = er.quote_asset_id
+         AND latest.timestamp = er.timestamp
+        WHERE er.deleted_at IS NULL
+    """)
+
+    # Crypto-to-crypto rates are triangulated from the fiat legs on read. A stored
+    # cross row would be served ahead of them and never refreshed, so drop them.
+    op.execute("""
+        DELETE FROM latest_exchange_rates
+        WHERE base_asset_id NOT IN (SELECT id FROM assets WHERE asset_type = 'FIAT')
+          AND quote_asset_id NOT IN (SELECT id FROM assets WHERE asset_type = 'FIAT')
+    """)
+
+
+def downgrade():
+    op.drop_table('latest_exchange_rates')
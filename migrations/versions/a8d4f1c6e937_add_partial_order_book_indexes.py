@@ -0,0 +1,36 @@
+"""Add partial order book indexes
+
+Revision ID: a8d4f1c6e937
+Revises: f3c9a7e2b514
+Create Date: 2026-10-17 16:58:09.661472
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'a8d4f1c6e937'
+down_revision = 'f3c9a7e2b514'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    with op.batch_alter_table('order_book', schema=None) as batch_op:
+        batch_op.create_index('idx_order_book_open_pair_id', ['base_asset_id', 'quote_asset_id', 'id'], unique=False,
+                              postgresql_where=sa.text("status = 'open'"), sqlite_where=sa.text("status = 'open'"),
+                              postgresql_include=['user_id', 'side', 'price', 'amount'])
+        batch_op.create_index('idx_order_book_pending', ['id'], unique=False,
+                              postgresql_where=sa.text("status = 'pending'"), sqlite_where=sa.text("status = 'pending'"))
+        # Superseded by the pair/side/status/price index and the partial indexes above
+        batch_op.drop_index('idx_order_book_status')
+        batch_op.drop_index('idx_order_book_assets')
+
+
+def downgrade():
+    with op.batch_alter_table('order_book', schema=None) as batch_op:
+        batch_op.create_index('idx_order_book_assets', ['base_asset_id', 'quote_asset_id'], unique=False)
+        batch_op.create_index('idx_order_book_status', ['status'], unique=False)
+        batch_op.drop_index('idx_order_book_pending')
+        batch_op.drop_index('idx_order_book_open_pair_id')
@@ -0,0 +1,47 @@
+"""Add exchange rate buckets table
+
+Revision ID: b7d4e2a91c05
+Revises: a3f1c9d2e7b4
+Create Date: 2026-10-17 11:03:27.554310
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'b7d4e2a91c05'
+down_revision = 'a3f1c9d2e7b4'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('exchange_rate_buckets',
+    sa.Column('id', sa.Integer(), nullable=False),
+    sa.Column('base_asset_id', sa.Integer(), nullable=False),
+    sa.Column('quote_asset_id', sa.Integer(), nullable=False),
+    sa.Column('resolution', sa.String(length=4), nullable=False),
+    sa.Column('bucket_start', sa.DateTime(), nullable=False),
+    sa.Column('open', sa.Numeric(precision=30, scale=18), nullable=False),
+    sa.Column('high', sa.Numeric(precision=30, scale=18), nullable=False),
+    sa.Column('low', sa.Numeric(precision=30, scale=18), nullable=False),
+    sa.Column('close', sa.Numeric(precision=30, scale=18), nullable=False),
+    sa.Column('close_timestamp', sa.DateTime(), nullable=False),
+    sa.Column('sample_count', sa.Integer(), nullable=False),
+    sa.Column('created_at', sa.DateTime(), nullable=False),
+    sa.Column('updated_at', sa.DateTime(), nullable=True),
+    sa.ForeignKeyConstraint(['base_asset_id'], ['assets.id'], ),
+    sa.ForeignKeyConstraint(['quote_asset_id'], ['assets.id'], ),
+    sa.PrimaryKeyConstraint('id'),
+    sa.UniqueConstraint('resolution', 'base_asset_id', 'quote_asset_id', 'bucket_start', name='uq_rate_bucket')
+    )
+    with op.batch_alter_table('exchange_rate_buckets', schema=None) as batch_op:
+        batch_op.create_index('idx_rate_bucket_quote_start', ['resolution', 'quote_asset_id', 'bucket_start'], unique=False)
+
+
+def downgrade():
+    with op.batch_alter_table('exchange_rate_buckets', schema=None) as batch_op:
+        batch_op.drop_index('idx_rate_bucket_quote_start')
+
+    op.drop_table('exchange_rate_buckets')
@@ -0,0 +1,26 @@
+"""Add transaction source
+
+Revision ID: b9e2c4f7a1d3
+Revises: a8d4f1c6e937
+Create Date: 2026-10-17 18:02:37.194520
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'b9e2c4f7a1d3'
+down_revision = 'a8d4f1c6e937'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    with op.batch_alter_table('transactions', schema=None) as batch_op:
+        batch_op.add_column(sa.Column('source', sa.String(length=20), nullable=True))
+
+
+def downgrade():
+    with op.batch_alter_table('transactions', schema=None) as batch_op:
+        batch_op.drop_column('source')
@@ -0,0 +1,38 @@
+"""Add daily balances table
+
+Revision ID: c4e8f2a1d6b3
+Revises: b7d4e2a91c05
+Create Date: 2026-10-17 14:21:09.318842
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'c4e8f2a1d6b3'
+down_revision = 'b7d4e2a91c05'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('daily_balances',
+    sa.Column('id', sa.Integer(), nullable=False),
+    sa.Column('user_id', sa.Integer(), nullable=False),
+    sa.Column('asset_id', sa.Integer(), nullable=False),
+    sa.Column('day', sa.Date(), nullable=False),
+    sa.Column('delta', sa.Numeric(precision=30, scale=18), nullable=False),
+    sa.Column('balance', sa.Numeric(precision=30, scale=18), nullable=False),
+    sa.Column('tx_count', sa.Integer(), nullable=False),
+    sa.Column('created_at', sa.DateTime(), nullable=False),
+    sa.Column('updated_at', sa.DateTime(), nullable=True),
+    sa.ForeignKeyConstraint(['asset_id'], ['assets.id'], ),
+    sa.ForeignKeyConstraint(['user_id'], ['users.id'], ),
+    sa.PrimaryKeyConstraint('id'),
+    sa.UniqueConstraint('user_id', 'asset_id', 'day', name='uq_daily_balance_user_asset_day')
+    )
+
+
+def downgrade():
+    op.drop_table('daily_balances')
@@ -0,0 +1,32 @@
+"""Make transaction keyset index partial on swap rows
+
+Revision ID: c7f1a9e3b2d8
+Revises: b9e2c4f7a1d3
+Create Date: 2026-10-17 18:11:52.640913
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'c7f1a9e3b2d8'
+down_revision = 'b9e2c4f7a1d3'
+branch_labels = None
+depends_on = None
+
+SWAP_ROWS_CONDITION = "tx_type IN ('TRADE_BUY', 'TRADE_SELL') AND source IS NULL"
+
+
+def upgrade():
+    with op.batch_alter_table('transactions', schema=None) as batch_op:
+        batch_op.create_index('idx_transaction_swaps_user_timestamp_id', ['user_id', 'timestamp', 'id'], unique=False,
+                              postgresql_where=sa.text(SWAP_ROWS_CONDITION), sqlite_where=sa.text(SWAP_ROWS_CONDITION))
+        # Swap history is its only user, and it reads swap rows only
+        batch_op.drop_index('idx_transaction_user_timestamp_id')
+
+
+def downgrade():
+    with op.batch_alter_table('transactions', schema=None) as batch_op:
+        batch_op.create_index('idx_transaction_user_timestamp_id', ['user_id', 'timestamp', 'id'], unique=False)
+        batch_op.drop_index('idx_transaction_swaps_user_timestamp_id')
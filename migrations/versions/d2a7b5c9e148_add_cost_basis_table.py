@@ -0,0 +1,41 @@
+"""Add cost basis table
+
+Revision ID: d2a7b5c9e148
+Revises: c4e8f2a1d6b3
+Create Date: 2026-10-17 16:02:44.870215
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'd2a7b5c9e148'
+down_revision = 'c4e8f2a1d6b3'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('cost_basis',
+    sa.Column('id', sa.Integer(), nullable=False),
+    sa.Column('user_id', sa.Integer(), nullable=False),
+    sa.Column('asset_id', sa.Integer(), nullable=False),
+    sa.Column('book', sa.String(length=10), nullable=False),
+    sa.Column('day', sa.Date(), nullable=False),
+    sa.Column('quantity', sa.Numeric(precision=30, scale=18), nullable=False),
+    sa.Column('cost_basis', sa.Numeric(precision=30, scale=18), nullable=False),
+    sa.Column('invested', sa.Numeric(precision=30, scale=18), nullable=False),
+    sa.Column('net_deposits', sa.Numeric(precision=30, scale=18), nullable=False),
+    sa.Column('realized_pnl', sa.Numeric(precision=30, scale=18), nullable=False),
+    sa.Column('created_at', sa.DateTime(), nullable=False),
+    sa.Column('updated_at', sa.DateTime(), nullable=True),
+    sa.ForeignKeyConstraint(['asset_id'], ['assets.id'], ),
+    sa.ForeignKeyConstraint(['user_id'], ['users.id'], ),
+    sa.PrimaryKeyConstraint('id'),
+    sa.UniqueConstraint('user_id', 'book', 'asset_id', 'day', name='uq_cost_basis_user_book_asset_day')
+    )
+
+
+def downgrade():
+    op.drop_table('cost_basis')
@@ -0,0 +1,26 @@
+"""Add cost basis last fill timestamp
+
+Revision ID: e4b8d2f6a9c1
+Revises: c7f1a9e3b2d8
+Create Date: 2026-10-17 19:24:11.603817
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'e4b8d2f6a9c1'
+down_revision = 'c7f1a9e3b2d8'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    with op.batch_alter_table('cost_basis', schema=None) as batch_op:
+        batch_op.add_column(sa.Column('last_fill_at', sa.DateTime(), nullable=True))
+
+
+def downgrade():
+    with op.batch_alter_table('cost_basis', schema=None) as batch_op:
+        batch_op.drop_column('last_fill_at')
@@ -0,0 +1,26 @@
+"""Add transaction keyset pagination index
+
+Revision ID: e6b1c3d8a472
+Revises: d2a7b5c9e148
+Create Date: 2026-10-17 16:24:12.518306
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'e6b1c3d8a472'
+down_revision = 'd2a7b5c9e148'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    with op.batch_alter_table('transactions', schema=None) as batch_op:
+        batch_op.create_index('idx_transaction_user_timestamp_id', ['user_id', 'timestamp', 'id'], unique=False)
+
+
+def downgrade():
+    with op.batch_alter_table('transactions', schema=None) as batch_op:
+        batch_op.drop_index('idx_transaction_user_timestamp_id')
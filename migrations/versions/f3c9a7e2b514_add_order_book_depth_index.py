@@ -0,0 +1,27 @@
+"""Add order book depth index
+
+Revision ID: f3c9a7e2b514
+Revises: e6b1c3d8a472
+Create Date: 2026-10-17 16:41:37.204915
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'f3c9a7e2b514'
+down_revision = 'e6b1c3d8a472'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    with op.batch_alter_table('order_book', schema=None) as batch_op:
+        batch_op.create_index('idx_order_book_pair_side_status_price',
+                              ['base_asset_id', 'quote_asset_id', 'side', 'status', 'price'], unique=False)
+
+
+def downgrade():
+    with op.batch_alter_table('order_book', schema=None) as batch_op:
+        batch_op.drop_index('idx_order_book_pair_side_status_price')